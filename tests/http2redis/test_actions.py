@@ -206,3 +206,23 @@ class TestActions(AsyncTestCase):
         self.assertEqual(len(args), 0)
         actions = Actions(del_query_string_arg="foo2")
         actions.execute_input_actions(exchange)
+
+    def test_set_async_job(self):
+        request = HTTPServerRequest(method='GET', uri='/')
+        exchange = HTTPExchange(request)
+        actions = Actions(set_async_job=True)
+        actions.execute_input_actions(exchange)
+        self.assertEqual(exchange.async_job_ttl, 3600)
+        actions = Actions(set_async_job=60)
+        actions.execute_input_actions(exchange)
+        self.assertEqual(exchange.async_job_ttl, 60)
+
+    def test_set_mirror_queue(self):
+        request = HTTPServerRequest(method='GET', uri='/')
+        exchange = HTTPExchange(request)
+        actions = Actions(set_mirror_queue=('shadow', 0.0))
+        actions.execute_input_actions(exchange)
+        self.assertIsNone(exchange.mirror_queue)
+        actions = Actions(set_mirror_queue=('shadow', 1.0))
+        actions.execute_input_actions(exchange)
+        self.assertEqual(exchange.mirror_queue, 'shadow')
@@ -4,15 +4,26 @@
 # See the LICENSE file for more information.
 
 import os
+import time
 import json
+import base64
 import mock
 import tornado
 from tornado import gen
 from tornado.testing import AsyncHTTPTestCase, gen_test
 import tornadis
+from tornado.httputil import HTTPServerRequest
+from six import BytesIO
 
 from thr.http2redis import app
 from thr.http2redis.rules import add_rule, Criteria, Actions, Rules
+from thr.http2redis.concurrency import add_concurrency_limit
+from thr.http2redis.concurrency import ConcurrencyLimits, ConcurrencyLimit
+from thr.http2redis.consumers import Consumers
+from thr.http2redis.saturation import Saturation
+from thr.http2redis.exchange import HTTPExchange
+from thr.hashes import Hashes, add_hash
+from thr.utils import serialize_http_response
 
 
 class TestLoadConfigFile(AsyncHTTPTestCase):
@@ -37,6 +48,7 @@ class TestApp(AsyncHTTPTestCase):
         super(TestApp, self).setUp()
         self.redis = tornadis.Client()
         Rules.reset()
+        ConcurrencyLimits.reset()
         self.make_response_key_predictable()
 
     def make_response_key_predictable(self):
@@ -144,3 +156,388 @@ class TestApp(AsyncHTTPTestCase):
                  stop=1)
         response = yield self.http_client.fetch(self.get_url('/quux'))
         self.assertEqual(response.code, 202)
+
+    def test_release_concurrency_limit(self):
+        limit = ConcurrencyLimit("foo", initial_limit=10, min_limit=1,
+                                 target_latency_ms=1000)
+        for status in (200, 404, 500, 502, 503, 504, None):
+            limit.acquire()
+            before = limit.limit
+            limit.last_decrease = 0
+            app.release_concurrency_limit(limit, time.time(), status)
+            self.assertEqual(limit.limit < before,
+                             status not in (200, 404), status)
+        self.assertEqual(limit.in_flight, 0)
+
+    @gen_test
+    def test_concurrency_limit_exception(self):
+        add_concurrency_limit("test-limit", initial_limit=10)
+        add_rule(Criteria(path='/quux'),
+                 Actions(set_redis_queue='test-queue',
+                         set_concurrency_limit='test-limit'))
+        with mock.patch("thr.http2redis.app.Handler.push",
+                        side_effect=Exception("bus error")):
+            response = yield self.http_client.fetch(self.get_url('/quux'),
+                                                    raise_error=False)
+        self.assertEqual(response.code, 500)
+        limit = ConcurrencyLimits.limits['test-limit']
+        self.assertEqual(limit.in_flight, 0)
+        self.assertTrue(limit.limit < 10)
+
+    @gen_test
+    def test_concurrency_limit_503(self):
+        add_concurrency_limit("test-limit", initial_limit=0, min_limit=0,
+                              retry_after=2)
+        add_rule(Criteria(path='/quux'),
+                 Actions(set_redis_queue='test-queue',
+                         set_concurrency_limit='test-limit'))
+        response = yield self.http_client.fetch(self.get_url('/quux'),
+                                                raise_error=False)
+        self.assertEqual(response.code, 503)
+        self.assertEqual(response.headers['Retry-After'], "2")
+        self.assertEqual(ConcurrencyLimits.limits['test-limit'].shed, 1)
+
+    @gen_test
+    def test_async_job(self):
+        app.options.jobs_path = "/thr/jobs"
+        app.options.jobs_secret = "secret"
+        self.addCleanup(setattr, app.options, "jobs_path", None)
+        self.addCleanup(setattr, app.options, "jobs_secret", None)
+        add_rule(Criteria(path='/quux'),
+                 Actions(set_redis_queue='test-queue', set_async_job=60))
+        yield self.redis.connect()
+        yield self.redis.call('DEL', 'test-queue')
+        response = yield self.http_client.fetch(self.get_url('/quux'),
+                                                raise_error=False)
+        self.assertEqual(response.code, 202)
+        ticket = json.loads(response.body.decode())['ticket']
+        self.assertEqual(response.headers['Location'],
+                         "/thr/jobs/%s" % ticket)
+        result = yield self.redis.call('BRPOP', 'test-queue', 1)
+        data = json.loads(result[1].decode())
+        self.assertEqual(data['extra']['response_key'],
+                         "thr:job:%s" % self.response_key)
+        self.assertEqual(data['extra']['job_ttl'], 60)
+
+    @gen_test
+    def test_edge_hashes(self):
+        add_hash("method", lambda request: request.method)
+        add_hash("user", lambda request: request.headers.get("X-User"))
+        self.addCleanup(Hashes.reset)
+        add_rule(Criteria(path='/quux'),
+                 Actions(set_redis_queue='test-queue', set_async_job=60))
+        yield self.redis.connect()
+        yield self.redis.call('DEL', 'test-queue')
+        response = yield self.http_client.fetch(self.get_url('/quux'),
+                                                raise_error=False)
+        self.assertEqual(response.code, 202)
+        result = yield self.redis.call('BRPOP', 'test-queue', 1)
+        data = json.loads(result[1].decode())
+        self.assertEqual(data['extra']['hashes'],
+                         {"method": "GET", "user": None})
+
+    @gen_test
+    def test_zset_queue(self):
+        add_rule(Criteria(path='/urgent'), Actions(set_input_priority=1))
+        add_rule(Criteria(), Actions(set_redis_queue='test-zset',
+                                     set_redis_queue_type='zset',
+                                     set_async_job=60))
+        yield self.redis.connect()
+        yield self.redis.call('DEL', 'test-zset')
+        for path in ('/quux', '/urgent'):
+            response = yield self.http_client.fetch(self.get_url(path),
+                                                    raise_error=False)
+            self.assertEqual(response.code, 202)
+        result = yield self.redis.call('ZRANGE', 'test-zset', 0, -1)
+        paths = [json.loads(x.decode())['path'] for x in result]
+        self.assertEqual(paths, ['/urgent', '/quux'])
+
+    @gen_test
+    def test_mirror(self):
+        add_rule(Criteria(path='/quux'),
+                 Actions(set_redis_queue='test-queue',
+                         set_mirror_queue='shadow-queue'))
+        app.mirror_buffers.clear()
+        yield self.redis.connect()
+        yield self.redis.call('DEL', 'test-queue', 'shadow-queue')
+        future = self.http_client.fetch(self.get_url('/quux'),
+                                        raise_error=False)
+        result = yield self.redis.call('BRPOP', 'test-queue', 1)
+        response_key = json.loads(result[1].decode())['extra']['response_key']
+        response = tornado.httpclient.HTTPResponse(
+            tornado.httpclient.HTTPRequest("http://localhost/"), 201,
+            buffer=BytesIO(b"primary"))
+        yield self.redis.call('LPUSH', response_key,
+                              serialize_http_response(response))
+        response = yield future
+        self.assertEqual(response.code, 201)
+        self.assertEqual(response.body, b"primary")
+        # the copy is pushed by the (periodic) flusher
+        length = yield self.redis.call('LLEN', 'shadow-queue')
+        self.assertEqual(length, 0)
+        mirror_buffer = app.mirror_buffers["127.0.0.1:6379"]
+        yield app.flush_mirror_buffer("127.0.0.1:6379", mirror_buffer)
+        self.assertEqual(mirror_buffer.mirrored, 1)
+        result = yield self.redis.call('BRPOP', 'shadow-queue', 1)
+        data = json.loads(result[1].decode())
+        self.assertTrue(data['extra']['mirror'])
+        self.assertEqual(data['path'], '/quux')
+
+    @gen_test
+    def test_mirror_zset(self):
+        add_rule(Criteria(), Actions(set_redis_queue='test-zset',
+                                     set_redis_queue_type='zset',
+                                     set_mirror_queue='shadow-zset',
+                                     set_async_job=60))
+        app.mirror_buffers.clear()
+        yield self.redis.connect()
+        yield self.redis.call('DEL', 'test-zset', 'shadow-zset')
+        response = yield self.http_client.fetch(self.get_url('/quux'),
+                                                raise_error=False)
+        self.assertEqual(response.code, 202)
+        mirror_buffer = app.mirror_buffers["127.0.0.1:6379"]
+        yield app.flush_mirror_buffer("127.0.0.1:6379", mirror_buffer)
+        self.assertEqual(mirror_buffer.mirrored, 1)
+        result = yield self.redis.call('ZRANGE', 'shadow-zset', 0, -1)
+        self.assertEqual(len(result), 1)
+        self.assertTrue(json.loads(result[0].decode())['extra']['mirror'])
+        yield self.redis.call('DEL', 'test-zset', 'shadow-zset')
+
+    @gen_test
+    def test_no_live_consumer(self):
+        app.options.check_consumers = True
+        self.addCleanup(setattr, app.options, "check_consumers", False)
+        Consumers.reset()
+        add_rule(Criteria(path='/quux'),
+                 Actions(set_redis_queue='test-queue'))
+        yield self.redis.connect()
+        yield self.redis.call('DEL', 'test-queue',
+                              'thr:consumers:test-queue')
+        Consumers.update("127.0.0.1:6379", "test-queue", None)
+        yield app.refresh_consumers()
+        self.assertFalse(Consumers.is_alive("127.0.0.1:6379", "test-queue"))
+        response = yield self.http_client.fetch(self.get_url('/quux'),
+                                                raise_error=False)
+        self.assertEqual(response.code, 503)
+        length = yield self.redis.call('LLEN', 'test-queue')
+        self.assertEqual(length, 0)
+
+    def test_fallback_queue_spare_capacity(self):
+        app.options.check_consumers = True
+        self.addCleanup(setattr, app.options, "check_consumers", False)
+        Consumers.reset()
+        self.addCleanup(Consumers.reset)
+        exchange = HTTPExchange(HTTPServerRequest("GET", "/"),
+                                default_redis_host="127.0.0.1",
+                                default_redis_port=6379,
+                                default_redis_queue="test-queue")
+        exchange.fallback_redis_queue = "test-fallback-queue"
+        # live consumers without spare capacity
+        Consumers.update("127.0.0.1:6379", "test-queue", 2, 0)
+        Consumers.update("127.0.0.1:6379", "test-fallback-queue", 1, 0)
+        self.assertTrue(app.check_consumers(exchange))
+        self.assertEqual(exchange.redis_queue, "test-queue")
+        Consumers.update("127.0.0.1:6379", "test-fallback-queue", 1, 1)
+        self.assertTrue(app.check_consumers(exchange))
+        self.assertEqual(exchange.redis_queue, "test-fallback-queue")
+
+    @gen_test
+    def test_fallback_queue(self):
+        app.options.check_consumers = True
+        self.addCleanup(setattr, app.options, "check_consumers", False)
+        Consumers.reset()
+        add_rule(Criteria(path='/quux'),
+                 Actions(set_redis_queue='test-queue',
+                         set_fallback_redis_queue='test-fallback-queue'))
+        yield self.redis.connect()
+        yield self.redis.call('DEL', 'test-queue', 'test-fallback-queue')
+        yield self.redis.call('ZADD', 'thr:consumers:test-fallback-queue',
+                              "%.3f" % (time.time() + 10),
+                              'consumer')
+        Consumers.update("127.0.0.1:6379", "test-queue", None)
+        Consumers.update("127.0.0.1:6379", "test-fallback-queue", None)
+        yield app.refresh_consumers()
+        self.assertTrue(Consumers.is_alive("127.0.0.1:6379",
+                                           "test-fallback-queue"))
+        future = self.http_client.fetch(self.get_url('/quux'),
+                                        raise_error=False)
+        result = yield self.redis.call('BRPOP', 'test-fallback-queue', 1)
+        response_key = json.loads(result[1].decode())['extra']['response_key']
+        response = tornado.httpclient.HTTPResponse(
+            tornado.httpclient.HTTPRequest("http://localhost/"), 201,
+            buffer=BytesIO(b"fallback"))
+        yield self.redis.call('LPUSH', response_key,
+                              serialize_http_response(response))
+        response = yield future
+        self.assertEqual(response.code, 201)
+        self.assertEqual(response.body, b"fallback")
+        yield self.redis.call('DEL', 'thr:consumers:test-fallback-queue')
+
+    @gen_test
+    def test_refresh_saturation(self):
+        Saturation.reset()
+        self.addCleanup(Saturation.reset)
+        yield self.redis.connect()
+        yield self.redis.call('DEL', 'thr:saturation')
+        yield self.redis.call('DEL', 'thr:consumers:test-queue')
+        yield self.redis.call('ZADD', 'thr:consumers:test-queue',
+                              "%.3f" % (time.time() + 10), 'host:1')
+        yield self.redis.call('HSET', 'thr:saturation', 'limit_foo|host:1',
+                              "%.3f" % (time.time() + 10))
+        yield self.redis.call('HSET', 'thr:saturation', 'limit_foo|host:2',
+                              "%.3f" % (time.time() - 10))
+        yield self.redis.call('HSET', 'thr:saturation', 'limit_bar|host:2',
+                              "%.3f" % (time.time() - 10))
+        # the live consumers of the queue are refreshed at the next refresh
+        self.assertFalse(Saturation.is_saturated("limit_foo", "test-queue"))
+        yield app.refresh_saturation()
+        self.assertTrue(Saturation.is_saturated("limit_foo", "test-queue"))
+        self.assertFalse(Saturation.is_saturated("limit_bar", "test-queue"))
+        # the expired fields are purged
+        fields = yield self.redis.call('HKEYS', 'thr:saturation')
+        self.assertEqual(fields, [b"limit_foo|host:1"])
+        # a new live consumer which doesn't report the counter
+        yield self.redis.call('ZADD', 'thr:consumers:test-queue',
+                              "%.3f" % (time.time() + 10), 'host:3')
+        yield app.refresh_saturation()
+        self.assertFalse(Saturation.is_saturated("limit_foo", "test-queue"))
+        yield self.redis.call('DEL', 'thr:saturation')
+        yield self.redis.call('DEL', 'thr:consumers:test-queue')
+
+
+class TestJobs(AsyncHTTPTestCase):
+
+    def get_new_ioloop(self):
+        return tornado.ioloop.IOLoop.instance()
+
+    def get_app(self):
+        app.options.config = None
+        app.options.jobs_path = "/thr/jobs"
+        app.options.jobs_secret = "secret"
+        self.addCleanup(setattr, app.options, "jobs_path", None)
+        self.addCleanup(setattr, app.options, "jobs_secret", None)
+        return app.make_app()
+
+    def test_jobs_secret_required(self):
+        app.options.jobs_secret = None
+        self.addCleanup(setattr, app, "jobs_secret", None)
+        app.jobs_secret = None
+        self.assertRaises(Exception, app.make_app)
+
+    def test_job_ticket(self):
+        ticket = app.make_job_ticket("abc", "127.0.0.1:6379")
+        self.assertEqual(app.parse_job_ticket(ticket),
+                         ("abc", "127.0.0.1:6379"))
+        ticket = app.make_job_ticket("abc", "/tmp/redis.sock")
+        self.assertEqual(app.parse_job_ticket(ticket),
+                         ("abc", "/tmp/redis.sock"))
+        self.assertRaises(ValueError, app.parse_job_ticket, "foo")
+        # forged ticket (not signed)
+        job_id, encoded, signature = ticket.split('.')
+        forged = app.make_job_ticket("abc", "evil:6379").split('.')[1]
+        self.assertRaises(ValueError, app.parse_job_ticket,
+                          "%s.%s.%s" % (job_id, forged, signature))
+        self.assertRaises(ValueError, app.parse_job_ticket,
+                          "%s.%s" % (job_id, encoded))
+
+    @gen_test
+    def test_invalid_ticket(self):
+        response = yield self.http_client.fetch(
+            self.get_url('/thr/jobs/foo'), raise_error=False)
+        self.assertEqual(response.code, 400)
+
+
+class TestBatch(AsyncHTTPTestCase):
+
+    def setUp(self):
+        super(TestBatch, self).setUp()
+        Rules.reset()
+
+    def get_new_ioloop(self):
+        return tornado.ioloop.IOLoop.instance()
+
+    def get_app(self):
+        app.options.config = None
+        app.options.timeout = 1
+        app.options.batch_path = "/thr/batch"
+        self.addCleanup(setattr, app.options, "batch_path", None)
+        return app.make_app()
+
+    @gen.coroutine
+    def fake_backend(self, count):
+        redis = tornadis.Client()
+        yield redis.connect()
+        for i in range(0, count):
+            result = yield redis.call('BRPOP', 'test-queue', 1)
+            data = json.loads(result[1].decode())
+            response = tornado.httpclient.HTTPResponse(
+                tornado.httpclient.HTTPRequest("http://localhost/"), 200)
+            response.headers["X-Path"] = data['path']
+            yield redis.call('LPUSH', data['extra']['response_key'],
+                             serialize_http_response(response))
+        redis.disconnect()
+
+    @gen_test
+    def test_batch(self):
+        add_rule(Criteria(path='/local'), Actions(set_status_code=201),
+                 stop=1)
+        add_rule(Criteria(), Actions(set_redis_queue='test-queue'))
+        redis = tornadis.Client()
+        yield redis.connect()
+        yield redis.call('DEL', 'test-queue')
+        redis.disconnect()
+        backend = self.fake_backend(2)
+        body = {"requests": [{"path": "/foo"},
+                             {"path": "/local"},
+                             {"method": "POST", "path": "/bar",
+                              "body": base64.b64encode(b"x").decode()}]}
+        response = yield self.http_client.fetch(self.get_url('/thr/batch'),
+                                                method="POST",
+                                                body=json.dumps(body))
+        yield backend
+        responses = json.loads(response.body.decode())['responses']
+        self.assertEqual([x['status_code'] for x in responses],
+                         [200, 201, 200])
+        self.assertIn(["X-Path", "/foo"], responses[0]['headers'])
+        self.assertIn(["X-Path", "/bar"], responses[2]['headers'])
+
+    @gen_test
+    def test_batch_concurrency_limit(self):
+        ConcurrencyLimits.reset()
+        self.addCleanup(ConcurrencyLimits.reset)
+        add_concurrency_limit("test-limit", initial_limit=1, min_limit=1)
+        add_rule(Criteria(), Actions(set_redis_queue='test-queue',
+                                     set_concurrency_limit='test-limit'))
+        redis = tornadis.Client()
+        yield redis.connect()
+        yield redis.call('DEL', 'test-queue')
+        redis.disconnect()
+        backend = self.fake_backend(1)
+        body = {"requests": [{"path": "/foo"}, {"path": "/bar"}]}
+        response = yield self.http_client.fetch(self.get_url('/thr/batch'),
+                                                method="POST",
+                                                body=json.dumps(body))
+        yield backend
+        responses = json.loads(response.body.decode())['responses']
+        self.assertEqual([x['status_code'] for x in responses], [200, 503])
+        limit = ConcurrencyLimits.limits['test-limit']
+        self.assertEqual((limit.accepted, limit.shed, limit.in_flight),
+                         (1, 1, 0))
+        self.assertEqual(len(app.running_exchanges), 0)
+
+    @gen_test
+    def test_batch_timeout(self):
+        add_rule(Criteria(), Actions(set_redis_queue='test-queue'))
+        body = {"requests": [{"path": "/foo"}], "timeout": 0.5}
+        response = yield self.http_client.fetch(self.get_url('/thr/batch'),
+                                                method="POST",
+                                                body=json.dumps(body))
+        responses = json.loads(response.body.decode())['responses']
+        self.assertEqual(responses[0]['status_code'], 504)
+
+    @gen_test
+    def test_invalid_batch(self):
+        response = yield self.http_client.fetch(self.get_url('/thr/batch'),
+                                                method="POST", body="foo",
+                                                raise_error=False)
+        self.assertEqual(response.code, 400)
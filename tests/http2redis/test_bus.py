@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of thr library released under the MIT license.
+# See the LICENSE file for more information.
+
+from unittest import TestCase
+
+from thr.http2redis.bus import BusPool, BusPools, add_bus_pool
+
+
+class TestBusPool(TestCase):
+
+    def setUp(self):
+        BusPools.reset()
+
+    def test_add_bus_pool(self):
+        add_bus_pool("main", ["10.0.0.1:6380", "/tmp/redis.sock"])
+        members = BusPools.get("main").members
+        self.assertEqual((members[0].host, members[0].port, members[0].uds),
+                         ("10.0.0.1", 6380, None))
+        self.assertEqual(members[1].uds, "/tmp/redis.sock")
+
+    def test_choose_less_loaded(self):
+        pool = BusPool("main", ["redis1", "redis2"])
+        pool.members[0].report("queue", 10, 1000)
+        pool.members[1].report("queue", 10, 1)
+        for i in range(0, 10):
+            self.assertEqual(pool.choose("queue").address, "redis2")
+
+    def test_skip_down_members(self):
+        pool = BusPool("main", ["redis1", "redis2", "redis3"])
+        pool.members[0].report_failure()
+        pool.members[2].report_failure()
+        for i in range(0, 10):
+            self.assertEqual(pool.choose("queue").address, "redis2")
+        pool.members[1].report_failure()
+        self.assertIsNotNone(pool.choose("queue"))
+
+    def test_unknown_bus_pool(self):
+        self.assertIsNone(BusPools.get("unknown"))
+        self.assertEqual(BusPools.unknown, set(["unknown"]))
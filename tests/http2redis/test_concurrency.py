@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of thr library released under the MIT license.
+# See the LICENSE file for more information.
+
+from unittest import TestCase
+from tornado.httputil import HTTPServerRequest
+
+from thr.http2redis.concurrency import ConcurrencyLimit, ConcurrencyLimits
+from thr.http2redis.concurrency import add_concurrency_limit
+from thr.http2redis.concurrency import MAX_UNKNOWN_NAMES
+from thr.http2redis.exchange import HTTPExchange
+
+
+class TestConcurrencyLimit(TestCase):
+
+    def setUp(self):
+        ConcurrencyLimits.reset()
+
+    def test_acquire_release(self):
+        limit = ConcurrencyLimit("foo", initial_limit=2)
+        self.assertTrue(limit.acquire())
+        self.assertTrue(limit.acquire())
+        self.assertFalse(limit.acquire())
+        self.assertEqual(limit.shed, 1)
+        self.assertEqual(limit.in_flight, 2)
+        limit.release(10)
+        self.assertEqual(limit.in_flight, 1)
+        self.assertTrue(limit.acquire())
+
+    def test_additive_increase(self):
+        limit = ConcurrencyLimit("foo", initial_limit=2, max_limit=3)
+        for i in range(0, 20):
+            limit.acquire()
+            limit.acquire()
+            limit.release(10)
+            limit.release(10)
+        self.assertEqual(limit.limit, 3)
+
+    def test_multiplicative_decrease(self):
+        limit = ConcurrencyLimit("foo", initial_limit=100, min_limit=10,
+                                 target_latency_ms=100, backoff=0.5)
+        limit.acquire()
+        limit.acquire()
+        limit.release(500)
+        self.assertEqual(limit.limit, 50)
+        # only one decrease by latency window
+        limit.release(500)
+        self.assertEqual(limit.limit, 50)
+        limit.last_decrease = 0
+        limit.acquire()
+        limit.release(0, failed=True)
+        self.assertEqual(limit.limit, 25)
+
+    def test_get_for_exchange(self):
+        add_concurrency_limit("foo")
+        add_concurrency_limit("test-queue")
+        exchange = HTTPExchange(HTTPServerRequest(method='GET', uri='/'))
+        self.assertIsNone(ConcurrencyLimits.get_for_exchange(exchange))
+        exchange.set_redis_queue("test-queue")
+        self.assertEqual(ConcurrencyLimits.get_for_exchange(exchange).name,
+                         "test-queue")
+        exchange.set_concurrency_limit("foo")
+        self.assertEqual(ConcurrencyLimits.get_for_exchange(exchange).name,
+                         "foo")
+        # unknown limit => no limit
+        exchange.set_concurrency_limit("unknown")
+        self.assertIsNone(ConcurrencyLimits.get_for_exchange(exchange))
+        self.assertEqual(ConcurrencyLimits.unknown, set(["unknown"]))
+
+    def test_unknown_names_bounded(self):
+        exchange = HTTPExchange(HTTPServerRequest(method='GET', uri='/'))
+        for i in range(0, MAX_UNKNOWN_NAMES + 1):
+            exchange.set_concurrency_limit("unknown%i" % i)
+            ConcurrencyLimits.get_for_exchange(exchange)
+        self.assertEqual(len(ConcurrencyLimits.unknown), 1)
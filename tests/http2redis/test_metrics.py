@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of thr library released under the MIT license.
+# See the LICENSE file for more information.
+
+import tornado
+from tornado.testing import AsyncHTTPTestCase, gen_test
+
+from thr.http2redis import metrics
+from thr.utils import Histogram
+
+
+class TestMetrics(AsyncHTTPTestCase):
+
+    def get_new_ioloop(self):
+        return tornado.ioloop.IOLoop.instance()
+
+    def get_app(self):
+        return metrics.make_metrics_app()
+
+    def test_format_histogram(self):
+        histogram = Histogram((1, 10))
+        histogram.observe(0.5)
+        histogram.observe(5)
+        histogram.observe(50)
+        lines = []
+        metrics.format_histogram(lines, "foo", histogram,
+                                 labels='status="200"')
+        self.assertEqual(lines, ['foo_bucket{status="200",le="1"} 1',
+                                 'foo_bucket{status="200",le="10"} 2',
+                                 'foo_bucket{status="200",le="+Inf"} 3',
+                                 'foo_sum{status="200"} 55.5',
+                                 'foo_count{status="200"} 3'])
+
+    def test_render_prometheus(self):
+        metrics.observe_reply(299, 12, 100)
+        metrics.register_gauge("test_gauge{queue}", "test", lambda: {"q": 3})
+        result = metrics.render_prometheus()
+        self.assertIn('http2redis_total_time_ms_count{status="299"} 1',
+                      result)
+        self.assertIn('# TYPE http2redis_lpush_time_ms histogram', result)
+        self.assertIn('test_gauge{queue="q"} 3', result)
+        metrics.gauges.pop()
+        del(metrics.total_time[299])
+
+    @gen_test
+    def test_metrics_handler(self):
+        response = yield self.http_client.fetch(self.get_url('/metrics'))
+        self.assertEqual(response.code, 200)
+        self.assertIn(b'http2redis_response_bytes_total', response.body)
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of thr library released under the MIT license.
+# See the LICENSE file for more information.
+
+import unittest
+
+from thr.http2redis.mirror import MirrorBuffer
+
+
+class TestMirrorBuffer(unittest.TestCase):
+
+    def test_put(self):
+        mirror_buffer = MirrorBuffer(2)
+        self.assertTrue(mirror_buffer.put("q1", "m1"))
+        self.assertTrue(mirror_buffer.put("q2", "m2"))
+        self.assertFalse(mirror_buffer.has_room())
+        self.assertFalse(mirror_buffer.put("q1", "m3"))
+        self.assertEqual(mirror_buffer.dropped, 1)
+
+    def test_pop_all(self):
+        mirror_buffer = MirrorBuffer(10)
+        mirror_buffer.put("q1", "m1")
+        mirror_buffer.put("q2", "m2")
+        mirror_buffer.put("q1", "m3")
+        mirror_buffer.put("z1", "m4", score=1.5)
+        self.assertEqual(mirror_buffer.pop_all(),
+                         {"q1": [("m1", None), ("m3", None)],
+                          "q2": [("m2", None)], "z1": [("m4", 1.5)]})
+        self.assertEqual(len(mirror_buffer.messages), 0)
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of thr library released under the MIT license.
+# See the LICENSE file for more information.
+
+from unittest import TestCase
+from tornado.httputil import HTTPServerRequest, HTTPHeaders
+import mock
+
+from thr.http2redis.exchange import HTTPExchange
+from thr.http2redis.keys import make_key_func
+from thr.http2redis.ratelimit import RateLimit
+from thr.http2redis.rules import Actions
+
+
+def make_exchange(ip="10.0.0.1", headers=None):
+    request = HTTPServerRequest(method='GET', uri='/', headers=headers)
+    request.remote_ip = ip
+    return HTTPExchange(request)
+
+
+class TestKeys(TestCase):
+
+    def test_key_funcs(self):
+        headers = HTTPHeaders()
+        headers.add("X-User", "foo")
+        exchange = make_exchange(headers=headers)
+        self.assertEqual(make_key_func("remote_ip")(exchange), "10.0.0.1")
+        self.assertEqual(make_key_func("header:X-User")(exchange), "foo")
+        self.assertIsNone(make_key_func("header:X-Other")(exchange))
+        self.assertEqual(make_key_func(lambda x: "bar")(exchange), "bar")
+
+
+class TestRateLimit(TestCase):
+
+    @mock.patch('time.time')
+    def test_token_bucket(self, time_mock):
+        time_mock.return_value = 1000.0
+        limit = RateLimit(2, burst=3)
+        exchange = make_exchange()
+        for i in range(0, 3):
+            self.assertIsNone(limit.consume(exchange))
+        self.assertAlmostEqual(limit.consume(exchange), 0.5)
+        self.assertIsNone(limit.consume(make_exchange("10.0.0.2")))
+        time_mock.return_value = 1000.5
+        self.assertIsNone(limit.consume(exchange))
+        self.assertIsNotNone(limit.consume(exchange))
+        self.assertEqual(limit.rejected, 2)
+
+    @mock.patch('time.time')
+    def test_idle_eviction(self, time_mock):
+        time_mock.return_value = 1000.0
+        limit = RateLimit(1, burst=2)
+        limit.consume(make_exchange("10.0.0.1"))
+        limit.consume(make_exchange("10.0.0.2"))
+        self.assertEqual(len(limit.buckets), 2)
+        time_mock.return_value = 1003.0
+        limit.consume(make_exchange("10.0.0.3"))
+        self.assertEqual(list(limit.buckets.keys()), ["10.0.0.3"])
+
+    def test_max_keys(self):
+        limit = RateLimit(1, max_keys=2)
+        for i in range(0, 5):
+            limit.consume(make_exchange("10.0.0.%i" % i))
+        self.assertEqual(list(limit.buckets.keys()),
+                         ["10.0.0.3", "10.0.0.4"])
+
+    def test_rate_limit_action(self):
+        actions = Actions(rate_limit=RateLimit(1, burst=1),
+                          set_redis_queue="test-queue")
+        exchange = make_exchange()
+        actions.execute_input_actions(exchange)
+        self.assertIsNone(exchange.response.status_code)
+        exchange = make_exchange()
+        actions.execute_input_actions(exchange)
+        self.assertEqual(exchange.response.status_code, 429)
+        self.assertEqual(exchange.response.headers['Retry-After'], "1")
+        self.assertNotEqual(exchange.redis_queue, "test-queue")
@@ -9,6 +9,10 @@ class TestRules(TestCase):
 
     def setUp(self):
         Rules.reset()
+        Rules.enable_stats(False)
+
+    def tearDown(self):
+        Rules.enable_stats(False)
 
     def test_add_rule(self):
         add_rule(Criteria(), Actions())
@@ -64,3 +68,50 @@ class TestRules(TestCase):
         exchange = HTTPExchange(request)
         Rules.execute_input_actions(exchange)
         self.assertEqual(exchange.redis_queue, 'yes-this-one')
+
+    def test_rule_names(self):
+        add_rule(Criteria(path='/foo'), Actions(), name="foo")
+        add_rule(Criteria(path='/bar'), Actions())
+        self.assertEqual([x.name for x in Rules.rules], ["foo", "rule1"])
+        # the names are unique
+        self.assertRaises(Exception, add_rule, Criteria(path='/baz'),
+                          Actions(), name="foo")
+        add_rule(Criteria(path='/baz'), Actions(), name="rule3")
+        # (the default name of the next rule is "rule3" too)
+        self.assertRaises(Exception, add_rule, Criteria(path='/qux'),
+                          Actions())
+        self.assertEqual([x.name for x in Rules.rules],
+                         ["foo", "rule1", "rule3"])
+
+    def test_rules_stats(self):
+
+        def callback_true(exchange):
+            return True
+
+        def queue_callback(exchange):
+            return 'test-queue'
+
+        Rules.enable_stats()
+        add_rule(Criteria(path='/foo', custom=callback_true),
+                 Actions(set_redis_queue=queue_callback), name="foo")
+        add_rule(Criteria(path='/bar'), Actions(), name="bar")
+        for path in ('/foo', '/foo', '/bar'):
+            request = HTTPServerRequest(method='GET', uri=path)
+            Rules.execute_input_actions(HTTPExchange(request))
+        stats = Rules.get_stats()
+        self.assertEqual(stats['foo']['evaluations'], 3)
+        self.assertEqual(stats['foo']['matches'], 2)
+        self.assertEqual(stats['foo']['match_time_ms']['count'], 3)
+        self.assertEqual(stats['foo']['input_actions_time_ms']['count'], 2)
+        self.assertEqual(stats['bar']['matches'], 1)
+        callables = stats['foo']['callables']
+        self.assertEqual(callables['set_redis_queue:queue_callback']['calls'],
+                         2)
+        self.assertIn('custom:callback_true', callables)
+        self.assertIsNotNone(stats['foo']['slowest_callable'])
+
+    def test_rules_stats_disabled(self):
+        add_rule(Criteria(path='/foo'), Actions(), name="foo")
+        request = HTTPServerRequest(method='GET', uri='/foo')
+        Rules.execute_input_actions(HTTPExchange(request))
+        self.assertEqual(Rules.get_stats()['foo']['evaluations'], 0)
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of thr library released under the MIT license.
+# See the LICENSE file for more information.
+
+import time
+from unittest import TestCase
+from tornado.httputil import HTTPServerRequest
+
+from thr import DEFAULT_REDIS_QUEUE
+from thr.http2redis.exchange import HTTPExchange
+from thr.http2redis.rules import Actions
+from thr.http2redis.saturation import Saturation, SaturationCheck
+
+
+def make_exchange():
+    request = HTTPServerRequest(method='GET', uri='/')
+    return HTTPExchange(request)
+
+
+class TestSaturation(TestCase):
+
+    def setUp(self):
+        Saturation.reset()
+
+    def tearDown(self):
+        Saturation.reset()
+
+    def test_is_saturated(self):
+        now = time.time()
+        Saturation.update({"limit_foo": {"c1": now + 10, "c2": now + 10},
+                           "limit_bar": {"c1": now - 1, "c2": now + 10},
+                           "limit_qux": {"c1": now + 10}},
+                          {"q": set(["c1", "c2"])})
+        self.assertTrue(Saturation.is_saturated("limit_foo", "q"))
+        self.assertFalse(Saturation.is_saturated("limit_bar", "q"))
+        self.assertFalse(Saturation.is_saturated("limit_baz", "q"))
+        # not saturated in all the live consumers
+        self.assertFalse(Saturation.is_saturated("limit_qux", "q"))
+        self.assertEqual(Saturation.get_reporters("limit_bar", now),
+                         set(["c2"]))
+
+    def test_is_saturated_unknown_queue(self):
+        now = time.time()
+        Saturation.update({"limit_foo": {"c1": now + 10}}, {"q": set()})
+        # no live consumer
+        self.assertFalse(Saturation.is_saturated("limit_foo", "q"))
+        # the unknown queue is registered for the next refresh
+        self.assertFalse(Saturation.is_saturated("limit_foo", "q2"))
+        self.assertEqual(sorted(Saturation.get_queues()), ["q", "q2"])
+
+    def test_saturation_check(self):
+        Saturation.update({"limit_foo==bar": {"c1": time.time() + 10}},
+                          {DEFAULT_REDIS_QUEUE: set(["c1"])})
+        check = SaturationCheck(lambda x: "limit_foo==%s" % x.get_path())
+        exchange = make_exchange()
+        self.assertTrue(check.apply(exchange))
+        exchange.request.path = "bar"
+        self.assertFalse(check.apply(exchange))
+        self.assertEqual(exchange.response.status_code, 503)
+        self.assertEqual(exchange.response.headers["Retry-After"], "1")
+        self.assertEqual(check.rejected, 1)
+
+    def test_saturation_check_priority(self):
+        Saturation.update({"limit_foo": {"c1": time.time() + 10}},
+                          {DEFAULT_REDIS_QUEUE: set(["c1"])})
+        actions = Actions(set_input_priority=5,
+                          saturation_check=SaturationCheck(
+                              ["limit_bar", "limit_foo"], priority=90))
+        exchange = make_exchange()
+        actions.execute_input_actions(exchange)
+        self.assertEqual(exchange.priority, 90)
+        self.assertIsNone(exchange.response.status_code)
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of thr library released under the MIT license.
+# See the LICENSE file for more information.
+
+from unittest import TestCase
+from collections import Counter
+from tornado.httputil import HTTPServerRequest, HTTPHeaders
+
+from thr.http2redis.exchange import HTTPExchange
+from thr.http2redis.rules import Actions
+from thr.http2redis.sharding import ConsistentHashQueues
+
+
+class TestConsistentHashQueues(TestCase):
+
+    def test_stable_and_spread(self):
+        ring = ConsistentHashQueues(["q1", "q2", "q3"], key="real_ip")
+        keys = ["user%i" % i for i in range(0, 3000)]
+        first = [ring.get_queue(x) for x in keys]
+        self.assertEqual(first, [ring.get_queue(x) for x in keys])
+        counts = Counter(first)
+        self.assertEqual(len(counts), 3)
+        for count in counts.values():
+            self.assertTrue(count > 600)
+
+    def test_adding_a_queue_moves_few_keys(self):
+        ring3 = ConsistentHashQueues(["q1", "q2", "q3"], key="real_ip")
+        ring4 = ConsistentHashQueues(["q1", "q2", "q3", "q4"],
+                                     key="real_ip")
+        keys = ["user%i" % i for i in range(0, 4000)]
+        moved = [x for x in keys if ring3.get_queue(x) != ring4.get_queue(x)]
+        self.assertTrue(len(moved) < 1500)
+        for key in moved:
+            self.assertEqual(ring4.get_queue(key), "q4")
+
+    def test_action(self):
+        headers = HTTPHeaders()
+        headers.add("X-User", "foo")
+        ring = ConsistentHashQueues(["q1", "q2"], key="header:X-User")
+        exchange = HTTPExchange(HTTPServerRequest(method='GET', uri='/',
+                                                  headers=headers))
+        Actions(set_redis_queue=ring).execute_input_actions(exchange)
+        self.assertEqual(exchange.redis_queue, ring.get_queue("foo"))
+        exchange = HTTPExchange(HTTPServerRequest(method='GET', uri='/'),
+                                default_redis_queue="default")
+        Actions(set_redis_queue=ring).execute_input_actions(exchange)
+        self.assertEqual(exchange.redis_queue, "default")
@@ -3,6 +3,10 @@
 # This file is part of thr library released under the MIT license.
 # See the LICENSE file for more information.
 
+import os
+import json
+import time
+import tempfile
 import tornado
 from tornado.testing import AsyncTestCase, gen_test
 import tornadis
@@ -11,12 +15,17 @@ from mock import patch
 
 from six import BytesIO
 
+from thr.redis2http import app
 from thr.redis2http.app import process_request
-from thr.redis2http.limits import Limits
+from thr.redis2http.limits import Limits, add_max_limit
+from thr.redis2http.counter import set_counter, del_counter
+from thr.redis2http.counter import incr_conditions, decr_conditions
 from thr.redis2http.exchange import HTTPRequestExchange
+from thr.redis2http.lease import Leases
 from thr.redis2http.queue import Queue
 from thr.utils import serialize_http_request
 from thr.utils import unserialize_response_message
+from thr.utils import get_processing_key, get_processing_consumers_key
 
 
 def raise_exception(future=None):
@@ -27,6 +36,18 @@ def raise_exception(future=None):
         raise exc
 
 
+def url_hash_func(request):
+    return request.url
+
+
+def make_exchange(queue=None, **extra):
+    if queue is None:
+        queue = Queue(["foo"], host="localhost", port=6379)
+    req = tornado.httputil.HTTPServerRequest("GET", "/")
+    msg = serialize_http_request(req, dict_to_inject=extra)
+    return HTTPRequestExchange(msg, queue)
+
+
 class TestRedis2HttpApp(AsyncTestCase):
 
     def setUp(self):
@@ -72,3 +93,459 @@ class TestRedis2HttpApp(AsyncTestCase):
         self.assertEquals(status_code, 200)
         self.assertEquals(body, b"bar")
         client.disconnect()
+
+    @gen_test
+    def test_heartbeat(self):
+        client = tornadis.Client()
+        yield client.connect()
+        yield client.call('DEL', 'thr:consumers:foo')
+        queue = Queue(["foo"], host="localhost", port=6379)
+        yield app.heartbeat_handler(queue, single_iteration=True)
+        score = yield client.call('ZSCORE', 'thr:consumers:foo',
+                                  app.consumer_id)
+        self.assertTrue(float(score) > time.time())
+        score = yield client.call('ZSCORE', 'thr:available:foo',
+                                  app.consumer_id)
+        self.assertTrue(float(score) > time.time())
+        # no more spare capacity
+        with patch("thr.redis2http.app.is_queue_saturated",
+                   return_value=True):
+            yield app.heartbeat_handler(queue, single_iteration=True)
+        score = yield client.call('ZSCORE', 'thr:available:foo',
+                                  app.consumer_id)
+        self.assertIsNone(score)
+        yield client.call('DEL', 'thr:consumers:foo', 'thr:available:foo')
+        client.disconnect()
+
+    @gen_test
+    def test_saturation(self):
+        add_max_limit("limit_foo", lambda x: "foo", "foo", 1)
+        set_counter("limit_foo", 1)
+        self.addCleanup(del_counter, "limit_foo")
+        self.addCleanup(app.blocked_queues.pop, "limit_foo", None)
+        self.assertEquals(app.get_saturated_counters(), [])
+        for i in range(0, app.options.blocked_queue_max_size):
+            app.blocked_queue_put_nowait("limit_foo", 1,
+                                         make_exchange(request_id=str(i)))
+        self.assertEquals(app.get_saturated_counters(), ["limit_foo"])
+        client = tornadis.Client()
+        yield client.connect()
+        yield client.call('DEL', 'thr:saturation')
+        yield app.saturation_handler(host="localhost", port=6379,
+                                     single_iteration=True)
+        expiration = yield client.call('HGET', 'thr:saturation',
+                                       'limit_foo|%s' % app.consumer_id)
+        self.assertTrue(float(expiration) > time.time())
+        yield client.call('DEL', 'thr:saturation')
+        client.disconnect()
+
+    @gen_test
+    def test_pop_batch(self):
+        client = tornadis.Client()
+        yield client.connect()
+        yield client.call('DEL', 'foo')
+        for i in range(0, 3):
+            req = tornado.httputil.HTTPServerRequest("GET", "/foo%i" % i)
+            yield client.call('LPUSH', 'foo', serialize_http_request(req))
+        queue = Queue(["foo"], host="localhost", port=6379)
+        with patch("thr.redis2http.app.launch_exchange_or_queue_it") as m:
+            yield app.request_redis_handler(queue, single_iteration=True)
+        # all requests are popped in one round trip (in the push order)
+        paths = [x[0][0].request.url.split('/')[-1]
+                 for x in m.call_args_list]
+        self.assertEquals(paths, ["foo0", "foo1", "foo2"])
+        # static limit without headroom => one request by round trip
+        add_max_limit("limit_foo", lambda x: "foo", "foo", 1)
+        set_counter("limit_foo", 1)
+        self.addCleanup(del_counter, "limit_foo")
+        self.assertEquals(app.get_pop_batch_size(queue, "foo"), 1)
+        client.disconnect()
+
+    def test_pop_batch_size(self):
+        queue = Queue(["foo", "bar"], host="localhost", port=6379)
+        size = app.options.pop_batch_size
+        self.assertEquals(app.get_pop_batch_size(queue, "foo"), size)
+        # limits of another queue are ignored
+        add_max_limit("limit_bar", lambda x: "bar", "bar", 3, queues="bar")
+        set_counter("limit_bar", 1)
+        self.addCleanup(del_counter, "limit_bar")
+        self.assertEquals(app.get_pop_batch_size(queue, "foo"), size)
+        self.assertEquals(app.get_pop_batch_size(queue, "bar"), 2)
+        # cached until a counter changes
+        with patch("thr.redis2http.app.Limits.get_indexes") as m:
+            self.assertEquals(app.get_pop_batch_size(queue, "bar"), 2)
+        self.assertEquals(m.call_count, 0)
+        set_counter("limit_bar", 2)
+        self.assertEquals(app.get_pop_batch_size(queue, "bar"), 1)
+        # dynamic limits (the popped requests may share a hash value)
+        add_max_limit("limit_dyn", url_hash_func, url_hash_func, 4)
+        self.assertEquals(app.get_pop_batch_size(queue, "foo"), 4)
+
+    def test_workers_delta(self):
+        queue = Queue(["foo"], workers=1, max_workers=3)
+        queue.running_workers = 1
+        self.assertEquals(app.get_workers_delta(queue, 0), 0)
+        self.assertEquals(app.get_workers_delta(queue, 10), 1)
+        queue.running_workers = 3
+        self.assertEquals(app.get_workers_delta(queue, 10), 0)
+        self.assertEquals(app.get_workers_delta(queue, 0), -1)
+        queue.workers_to_stop = 2
+        self.assertEquals(app.get_workers_delta(queue, 0), 0)
+        # limits without headroom => no more workers
+        queue.workers_to_stop = 0
+        queue.running_workers = 1
+        add_max_limit("limit_foo", lambda x: "foo", "foo", 1)
+        set_counter("limit_foo", 1)
+        self.addCleanup(del_counter, "limit_foo")
+        # (only if they blocked requests of this queue)
+        self.assertEquals(app.get_workers_delta(queue, 10), 1)
+        queue.blocking_counters["limit_foo"] = time.time()
+        self.assertEquals(app.get_workers_delta(queue, 10), 0)
+        queue.running_workers = 2
+        self.assertEquals(app.get_workers_delta(queue, 10), -1)
+        # blocked requests of another queue
+        other = Queue(["bar"], workers=1, max_workers=3)
+        other.running_workers = 1
+        self.addCleanup(app.blocked_queues.pop, "limit_bar", None)
+        app.blocked_queue_put_nowait("limit_bar", 1, make_exchange())
+        self.assertEquals(app.get_workers_delta(other, 10), 1)
+        other.blocking_counters["limit_bar"] = time.time()
+        self.assertEquals(app.get_workers_delta(other, 10), 0)
+
+    @gen_test
+    def test_pause_consumption(self):
+        add_max_limit("limit_foo", lambda x: "foo", "foo", 1)
+        set_counter("limit_foo", 1)
+        self.addCleanup(del_counter, "limit_foo")
+        self.addCleanup(app.blocked_queues.pop, "limit_foo", None)
+        queue = Queue(["foo"], host="localhost", port=6379)
+        queue.blocking_counters["limit_foo"] = time.time()
+        self.assertFalse(app.is_queue_saturated(queue))
+        for i in range(0, app.options.blocked_queue_max_size):
+            app.blocked_queue_put_nowait("limit_foo", 1,
+                                         make_exchange(request_id=str(i)))
+        self.assertTrue(app.is_queue_saturated(queue))
+        before = app.consumption_pause_counter
+        tornado.ioloop.IOLoop.instance().call_later(
+            0.1, app.get_capacity_condition().notify_all)
+        with patch("thr.redis2http.app.launch_exchange_or_queue_it") as m:
+            yield app.request_redis_handler(queue, single_iteration=True)
+        self.assertEquals(m.call_count, 0)
+        self.assertEquals(app.consumption_pause_counter, before + 1)
+        # old blocking counters are forgotten
+        queue.blocking_counters["limit_foo"] = time.time() - 3600
+        self.assertFalse(app.is_queue_saturated(queue))
+        self.assertEquals(queue.blocking_counters, {})
+
+    @gen_test
+    def test_bus_reinject(self):
+        client = tornadis.Client()
+        yield client.connect()
+        yield client.call('DEL', 'foo')
+        yield client.call('LPUSH', 'foo', 'new')
+        queue = Queue(["foo"], host="localhost", port=6379)
+        for priority in (3, 1, 2):
+            req = tornado.httputil.HTTPServerRequest("GET", "/")
+            msg = serialize_http_request(req, dict_to_inject={
+                "priority": priority})
+            exchange = HTTPRequestExchange(msg, queue)
+            app.queue_for_bus_reinject("localhost", 6379, None,
+                                       exchange.priority, exchange,
+                                       remove_from_blocked_exchange=False)
+        before = app.reinject_batch_sizes.count
+        yield app.bus_reinject_handler(host="localhost", port=6379,
+                                       single_iteration=True)
+        self.assertEquals(app.reinject_batch_sizes.count, before + 1)
+        # reinjected requests are popped first (by priority)
+        priorities = []
+        for i in range(0, 3):
+            res = yield client.call('RPOP', 'foo')
+            exchange = HTTPRequestExchange(res, queue)
+            priorities.append(exchange.extra_dict['priority'])
+        self.assertEquals(priorities, [1, 2, 3])
+        res = yield client.call('RPOP', 'foo')
+        self.assertEquals(res, b"new")
+        client.disconnect()
+
+    @gen_test
+    def test_zset_queue(self):
+        client = tornadis.Client()
+        yield client.connect()
+        yield client.call('DEL', 'foo')
+        queue = Queue(["foo"], host="localhost", port=6379,
+                      queue_type="zset")
+        for priority in (3, 1, 2):
+            req = tornado.httputil.HTTPServerRequest("GET", "/")
+            msg = serialize_http_request(req, dict_to_inject={
+                "priority": priority, "creation_time": time.time()})
+            exchange = HTTPRequestExchange(msg, queue)
+            yield client.call('ZADD', 'foo', exchange.bus_score, msg)
+        with patch("thr.redis2http.app.launch_exchange_or_queue_it") as m:
+            yield app.request_redis_handler(queue, single_iteration=True)
+        exchanges = [x[0][0] for x in m.call_args_list]
+        self.assertEquals([x.extra_dict['priority'] for x in exchanges],
+                          [1, 2, 3])
+        # reinjected requests get back their score
+        for exchange in exchanges:
+            app.queue_for_bus_reinject("localhost", 6379, None,
+                                       exchange.priority, exchange,
+                                       remove_from_blocked_exchange=False)
+        yield app.bus_reinject_handler(host="localhost", port=6379,
+                                       single_iteration=True)
+        res = yield client.call('ZRANGE', 'foo', 0, -1)
+        self.assertEquals(res, [x.serialized_request for x in exchanges])
+        client.disconnect()
+
+    @gen_test
+    def test_reliable_queue(self):
+        @tornado.gen.coroutine
+        def test_fetch(request, **kwargs):
+            resp = tornado.httpclient.HTTPResponse(request, 200,
+                                                   buffer=BytesIO(b"bar"))
+            raise tornado.gen.Return(resp)
+
+        client = tornadis.Client()
+        yield client.connect()
+        processing_key = get_processing_key("foo", app.consumer_id)
+        yield client.call('DEL', 'foo', 'foobar', processing_key)
+        queue = Queue(["foo"], host="localhost", port=6379, reliable=True)
+        req = tornado.httputil.HTTPServerRequest("GET", "/foo")
+        msg = serialize_http_request(req, dict_to_inject={
+            "response_key": "foobar"})
+        yield client.call('LPUSH', 'foo', msg)
+        with patch("thr.redis2http.app.launch_exchange_or_queue_it") as m:
+            yield app.request_redis_handler(queue, single_iteration=True)
+        exchange = m.call_args_list[0][0][0]
+        self.assertEquals(exchange.processing_key, processing_key)
+        # the popped request is kept in the processing list...
+        res = yield client.call('LRANGE', processing_key, 0, -1)
+        self.assertEquals(res, [msg])
+        with patch("tornado.httpclient.AsyncHTTPClient.fetch") as fetch:
+            fetch.side_effect = test_fetch
+            yield process_request(exchange, datetime.now())
+        # ... until its response is pushed
+        res = yield client.call('LLEN', processing_key)
+        self.assertEquals(res, 0)
+        res = yield client.call('LLEN', 'foobar')
+        self.assertEquals(res, 1)
+        client.disconnect()
+
+    @gen_test
+    def test_janitor(self):
+        client = tornadis.Client()
+        yield client.connect()
+        dead_key = get_processing_key("foo", "dead:1")
+        alive_key = get_processing_key("foo", "alive:1")
+        consumers_key = get_processing_consumers_key("foo")
+        yield client.call('DEL', 'foo', dead_key, alive_key, consumers_key,
+                          'thr:consumers:foo')
+        yield client.call('SADD', consumers_key, "dead:1", "alive:1")
+        yield client.call('ZADD', 'thr:consumers:foo', int(time.time()) + 60,
+                          "alive:1")
+        yield client.call('LPUSH', dead_key, "req1", "req2")
+        yield client.call('LPUSH', alive_key, "req3")
+        queue = Queue(["foo"], host="localhost", port=6379, reliable=True)
+        before = app.recovered_request_counter
+        yield app.janitor_handler(queue, single_iteration=True)
+        self.assertEquals(app.recovered_request_counter, before + 2)
+        res = yield client.call('LRANGE', 'foo', 0, -1)
+        self.assertEquals(sorted(res), [b"req1", b"req2"])
+        res = yield client.call('LLEN', alive_key)
+        self.assertEquals(res, 1)
+        res = yield client.call('SMEMBERS', consumers_key)
+        self.assertEquals(res, [b"alive:1"])
+        client.disconnect()
+
+    @gen_test
+    def test_expiration(self):
+        self.addCleanup(app.blocked_exchanges.clear)
+        self.addCleanup(app.blocked_deadlines.pop_expired, float("inf"))
+        self.addCleanup(app.blocked_queues.pop, "limit_foo", None)
+        expired = make_exchange(request_id="expired",
+                                creation_time=time.time() - 3600)
+        old = make_exchange(request_id="old", creation_time=time.time())
+        old.local_queue_time -= 3600
+        young = make_exchange(request_id="young", creation_time=time.time())
+        for exchange in (expired, old, young):
+            app.blocked_queue_put_nowait("limit_foo", 1, exchange)
+            app.blocked_exchanges[exchange.request_id] = ("limit_foo",
+                                                          exchange)
+            app.push_blocked_deadline(exchange)
+        # stale deadline of an unblocked request
+        app.blocked_deadlines.push(0, "unblocked")
+        # stale deadline of a request blocked again since
+        app.blocked_deadlines.push(0, "young")
+        before = app.expired_request_counter
+        with patch("thr.redis2http.app.queue_for_bus_reinject") as m:
+            yield app.expiration_handler(single_iteration=True)
+        self.assertEquals(app.expired_request_counter, before + 1)
+        self.assertEquals(m.call_args[0][4], old)
+        self.assertEquals(list(app.blocked_exchanges.keys()), ["young"])
+        self.assertEquals(app.get_blocked_queue_size("limit_foo"), 1)
+        self.assertEquals(len(app.blocked_deadlines), 1)
+
+    def test_compact_blocked_deadlines(self):
+        self.addCleanup(app.blocked_exchanges.clear)
+        self.addCleanup(app.blocked_deadlines.pop_expired, float("inf"))
+        exchange = make_exchange(request_id="blocked")
+        app.blocked_exchanges["blocked"] = ("limit_foo", exchange)
+        app.push_blocked_deadline(exchange)
+        for i in range(0, app.BLOCKED_DEADLINES_COMPACT_MIN_SIZE):
+            app.blocked_deadlines.push(time.time() + 60, "unblocked%i" % i)
+        app.compact_blocked_deadlines()
+        self.assertEquals(len(app.blocked_deadlines), 1)
+
+    def test_reinject_blocking_queue(self):
+        self.addCleanup(app.blocked_exchanges.clear)
+        self.addCleanup(app.running_exchanges.clear)
+        self.addCleanup(app.blocked_deadlines.pop_expired, float("inf"))
+        for counter in ("a", "b"):
+            set_counter(counter, 1)
+            self.addCleanup(del_counter, counter)
+            self.addCleanup(app.blocked_queues.pop, counter, None)
+        exchanges = {}
+        a = ("a", 1, None, "a")
+        b = ("b", 1, None, "b")
+        for rid, priority, conditions in (("x1", 1, [a]),
+                                          ("x2", 0, [a, b]),
+                                          ("x3", 2, [a])):
+            exchange = make_exchange(request_id=rid)
+            exchange.conditions = conditions
+            exchanges[rid] = exchange
+            app.blocked_queue_put_nowait("a", priority, exchange)
+            app.blocked_exchanges[rid] = ("a", exchange)
+        # a slot of "a" is released
+        set_counter("a", 0)
+        with patch("thr.redis2http.app.process_request") as m:
+            m.return_value = tornado.concurrent.Future()
+            app.reinject_blocking_queue("a")
+        # x2 is still blocked by "b" => moved, x1 is launched, x3 waits
+        self.assertEquals(m.call_count, 1)
+        self.assertEquals(m.call_args[0][0], exchanges["x1"])
+        self.assertEquals(app.get_blocked_queue_size("a"), 1)
+        self.assertEquals(app.get_blocked_queue_size("b"), 1)
+        self.assertEquals(app.blocked_exchanges["x2"][0], "b")
+        self.assertEquals(app.blocked_exchanges["x3"][0], "a")
+
+    @gen_test
+    def test_lease_handler(self):
+        add_max_limit("dist", lambda x: "foo", "foo", 3, distributed=True)
+        self.addCleanup(Leases.reset)
+        self.addCleanup(del_counter, "dist")
+        client = tornadis.Client()
+        yield client.connect()
+        now_ms = int(time.time() * 1000)
+        yield client.call('DEL', 'thr:lease:dist')
+        yield client.call('HSET', 'thr:lease:dist', 'other',
+                          "1:%i" % (now_ms + 60000))
+        yield client.call('HSET', 'thr:lease:dist', 'dead',
+                          "2:%i" % (now_ms - 1000))
+        # 1 running request => 1 slot + 1 spare slot
+        set_counter("dist", 1)
+        yield app.lease_handler(single_iteration=True)
+        self.assertEquals(Leases.get("dist"), 2)
+        res = yield client.call('HGET', 'thr:lease:dist', app.consumer_id)
+        # (held slots:wanted slots:expiration)
+        self.assertTrue(res.startswith(b"2:2:"))
+        # the expired lease is released
+        res = yield client.call('HEXISTS', 'thr:lease:dist', 'dead')
+        self.assertEquals(res, 0)
+        # the other consumer needs more slots
+        yield client.call('HSET', 'thr:lease:dist', 'other',
+                          "2:%i" % (now_ms + 60000))
+        yield app.lease_handler(single_iteration=True)
+        self.assertEquals(Leases.get("dist"), 1)
+        # no more needed slots => the lease is released
+        set_counter("dist", 0)
+        yield app.lease_handler(single_iteration=True)
+        self.assertEquals(Leases.counters(), [])
+        res = yield client.call('HEXISTS', 'thr:lease:dist', app.consumer_id)
+        self.assertEquals(res, 0)
+        yield client.call('DEL', 'thr:lease:dist')
+        client.disconnect()
+
+    @gen_test
+    def test_lease_fair_share(self):
+        add_max_limit("dist", lambda x: "foo", "foo", 3, distributed=True)
+        self.addCleanup(Leases.reset)
+        self.addCleanup(del_counter, "dist")
+        self.addCleanup(setattr, app, "lease_script_sha", None)
+        client = tornadis.Client()
+        yield client.connect()
+        yield client.call('DEL', 'thr:lease:dist')
+        # another consumer holds all the slots and wants more
+        yield client.call('HSET', 'thr:lease:dist', 'other',
+                          "3:10:%i" % (int(time.time() * 1000) + 60000))
+        set_counter("dist", 1)
+        yield app.lease_handler(single_iteration=True)
+        self.assertEquals(Leases.get("dist"), 0)
+        # the other consumer renews its lease => its fair share only
+        result = yield app.call_lease_script(client, [
+            ('thr:lease:dist', ('other', 10, 3, int(time.time() * 1000),
+                                60000, 0))])
+        self.assertEquals(result, [2])
+        yield app.lease_handler(single_iteration=True)
+        self.assertEquals(Leases.get("dist"), 1)
+        # the script is loaded again after a redis flush
+        yield client.call('SCRIPT', 'FLUSH')
+        yield app.lease_handler(single_iteration=True)
+        self.assertEquals(Leases.get("dist"), 1)
+        yield client.call('DEL', 'thr:lease:dist')
+        client.disconnect()
+
+    @gen_test
+    def test_request_leases(self):
+        add_max_limit("dist", lambda x: "foo", "foo", 3, distributed=True)
+        self.addCleanup(Leases.reset)
+        self.addCleanup(app.lease_requests.clear)
+        client = tornadis.Client()
+        yield client.connect()
+        yield client.call('DEL', 'thr:lease:dist')
+        yield client.call('HSET', 'thr:lease:dist', 'other',
+                          "3:%i" % (int(time.time() * 1000) + 60000))
+        # a request is blocked by a counter without lease
+        app.request_leases(["dist", "unknown"])
+        self.assertEquals(app.lease_requests, set(["dist"]))
+        yield app.lease_handler(single_iteration=True)
+        self.assertEquals(app.lease_requests, set())
+        # nothing granted but still needed => no new immediate request
+        self.assertEquals(Leases.counters(), ["dist"])
+        self.assertEquals(Leases.get("dist"), 0)
+        app.request_leases(["dist"])
+        self.assertEquals(app.lease_requests, set())
+        yield client.call('DEL', 'thr:lease:dist')
+        client.disconnect()
+
+    def test_update_limit_overrides(self):
+        self.addCleanup(app.blocked_exchanges.clear)
+        self.addCleanup(app.running_exchanges.clear)
+        self.addCleanup(app.blocked_deadlines.pop_expired, float("inf"))
+        self.addCleanup(app.blocked_queues.pop, "uri==/a", None)
+        self.addCleanup(del_counter, "uri=====global")
+        add_max_limit("uri", "uri", "uri", 1, overrides={"/b": 3})
+        running = [("uri==/a", 1, "uri=====global", "uri")]
+        incr_conditions(running)
+        exchange = make_exchange(request_id="x1")
+        exchange.conditions = [("uri==/a", 1, "uri=====global", "uri")]
+        app.blocked_queue_put_nowait("uri==/a", 0, exchange)
+        app.blocked_exchanges["x1"] = ("uri==/a", exchange)
+        fd, path = tempfile.mkstemp()
+        self.addCleanup(os.remove, path)
+        with os.fdopen(fd, "w") as f:
+            f.write(json.dumps({"uri": {"/a": 2}}))
+        with patch("thr.redis2http.app.process_request") as m:
+            m.return_value = tornado.concurrent.Future()
+            app.load_limit_overrides(path)
+        # the blocked request gets the new limit and is launched
+        self.assertEqual(Limits.limits["uri"].overrides, {"/a": 2, "/b": 3})
+        self.assertEqual(exchange.conditions,
+                         [("uri==/a", 2, "uri=====global", "uri")])
+        self.assertEquals(m.call_count, 1)
+        self.assertEquals(app.get_blocked_queue_size("uri==/a"), 0)
+        decr_conditions(exchange.conditions)
+        decr_conditions(running)
+        # (the overrides of the configuration are restored)
+        with open(path, "w") as f:
+            f.write(json.dumps({}))
+        app.load_limit_overrides(path)
+        self.assertEqual(Limits.limits["uri"].overrides, {"/b": 3})
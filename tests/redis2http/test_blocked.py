@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of thr library released under the MIT license.
+# See the LICENSE file for more information.
+
+from unittest import TestCase
+from six.moves import queue as _queue
+
+from thr.redis2http.blocked import IndexedPriorityQueue, DeadlineHeap
+
+
+class TestIndexedPriorityQueue(TestCase):
+
+    def test_order(self):
+        queue = IndexedPriorityQueue()
+        for key, priority in (("a", 3), ("b", 1), ("c", 2), ("d", 1)):
+            queue.put_nowait(key, priority, key.upper())
+        self.assertEqual(queue.qsize(), 4)
+        items = [queue.get_nowait() for i in range(0, 4)]
+        # FIFO for equal priorities
+        self.assertEqual(items, [(1, "B"), (1, "D"), (2, "C"), (3, "A")])
+        self.assertRaises(_queue.Empty, queue.get_nowait)
+
+    def test_maxsize(self):
+        queue = IndexedPriorityQueue(2)
+        queue.put_nowait("a", 1, "A")
+        queue.put_nowait("b", 1, "B")
+        self.assertRaises(_queue.Full, queue.put_nowait, "c", 1, "C")
+        # same key => replaced
+        queue.put_nowait("a", 0, "A2")
+        self.assertEqual(queue.get_nowait(), (0, "A2"))
+        self.assertEqual(queue.qsize(), 1)
+
+    def test_remove(self):
+        queue = IndexedPriorityQueue()
+        for i in range(0, 100):
+            queue.put_nowait(i, (i * 37) % 100, i)
+        for i in range(0, 100, 3):
+            self.assertEqual(queue.remove(i), i)
+        self.assertIsNone(queue.remove(0))
+        self.assertFalse(3 in queue)
+        items = []
+        while queue.qsize() > 0:
+            items.append(queue.get_nowait())
+        expected = sorted(((i * 37) % 100, i) for i in range(0, 100)
+                          if i % 3 != 0)
+        self.assertEqual(items, expected)
+
+    def test_peek(self):
+        queue = IndexedPriorityQueue()
+        self.assertRaises(_queue.Empty, queue.peek_nowait)
+        queue.put_nowait("a", 2, "A")
+        queue.put_nowait("b", 1, "B")
+        self.assertEqual(queue.peek_nowait(), (1, "B"))
+        self.assertEqual(queue.qsize(), 2)
+
+
+class TestDeadlineHeap(TestCase):
+
+    def test_pop_expired(self):
+        heap = DeadlineHeap()
+        self.assertIsNone(heap.next_deadline())
+        heap.push(30, "c")
+        heap.push(10, "a")
+        heap.push(20, "b")
+        self.assertEqual(heap.next_deadline(), 10)
+        self.assertEqual(heap.pop_expired(5), [])
+        self.assertEqual(heap.pop_expired(20), [(10, "a"), (20, "b")])
+        self.assertEqual(len(heap), 1)
+
+    def test_compact(self):
+        heap = DeadlineHeap()
+        for i in range(0, 10):
+            heap.push(i, i % 3)
+        heap.compact(lambda deadline, key: key == 1)
+        self.assertEqual(len(heap), 3)
+        self.assertEqual(heap.pop_expired(10), [(1, 1), (4, 1), (7, 1)])
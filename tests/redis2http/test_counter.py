@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of thr library released under the MIT license.
+# See the LICENSE file for more information.
+
+from unittest import TestCase
+
+from thr.redis2http import counter
+from thr.redis2http.counter import make_condition, conditional_incr_counters
+from thr.redis2http.counter import decr_conditions, get_counter
+from thr.redis2http.counter import get_counter_blocks, set_max_dynamic_counters
+from thr.redis2http.counter import get_dynamic_counters_number, del_counter
+from thr.redis2http.counter import set_pinned_counters, bound_conditions
+from thr.redis2http.counter import set_overflow_limit, get_overflow_counter
+
+
+class TestCounter(TestCase):
+
+    def tearDown(self):
+        set_max_dynamic_counters(0)
+        set_overflow_limit(0)
+        set_pinned_counters([])
+        for name in ("foo", "foo=====global"):
+            del_counter(name)
+
+    def test_make_condition(self):
+        self.assertEqual(make_condition("foo", 2), ("foo", 2, None, "foo"))
+        condition = make_condition("foo", 2, "bar")
+        self.assertEqual(condition,
+                         ("foo==bar", 2, "foo=====global", "foo"))
+        # interned names
+        self.assertTrue(condition[0] is make_condition("foo", 2, "bar")[0])
+
+    def test_dynamic_counters(self):
+        before = get_dynamic_counters_number()
+        conditions = [make_condition("foo", 1, "bar")]
+        self.assertEqual(conditional_incr_counters(conditions),
+                         (True, ["foo==bar"]))
+        self.assertEqual(get_dynamic_counters_number(), before + 1)
+        self.assertEqual(conditional_incr_counters(conditions),
+                         (False, ["foo==bar"]))
+        self.assertEqual(get_counter_blocks("foo==bar"), 1)
+        self.assertEqual(get_counter_blocks("foo=====global"), 1)
+        decr_conditions(conditions)
+        # idle values are forgotten
+        self.assertEqual(get_dynamic_counters_number(), before)
+        self.assertFalse("foo==bar" in counter.counters)
+        self.assertFalse("foo==bar" in counter.counters_blocks)
+        self.assertEqual(get_counter("foo=====global"), 0)
+        del counter.counters_blocks["foo=====global"]
+
+    def test_max_dynamic_counters(self):
+        maximum = get_dynamic_counters_number() + 1
+        set_max_dynamic_counters(maximum)
+        overflows = get_overflow_counter()
+        bar = bound_conditions([make_condition("foo", 1, "bar")])
+        self.assertEqual(bar, [("foo==bar", 1, "foo=====global", "foo")])
+        # (the maximum is checked against the conditions themselves)
+        self.assertEqual(bound_conditions([make_condition("foo", 1, "bar"),
+                                           make_condition("foo2", 1, "bar")]),
+                         [("foo==bar", 1, "foo=====global", "foo"),
+                          ("foo2==__overflow__", maximum,
+                           "foo2=====global", "foo2")])
+        conditional_incr_counters(bar)
+        # the maximum is reached => new values share an overflow counter
+        # (with a scaled limit)
+        baz = bound_conditions([make_condition("foo", 1, "baz")])
+        self.assertEqual(baz, [("foo==__overflow__", maximum,
+                                "foo=====global", "foo")])
+        # (but not the values in use)
+        self.assertEqual(bound_conditions([make_condition("foo", 1, "bar")]),
+                         bar)
+        set_overflow_limit(5)
+        self.assertEqual(
+            bound_conditions([make_condition("foo", 1, "baz")])[0][1], 5)
+        conditional_incr_counters(baz)
+        self.assertEqual(get_overflow_counter(), overflows + 1)
+        self.assertEqual(get_counter("foo=====global"), 2)
+        decr_conditions(bar)
+        decr_conditions(baz)
+        self.assertEqual(bound_conditions([make_condition("foo", 1, "baz")]),
+                         [("foo==baz", 1, "foo=====global", "foo")])
+
+    def test_pinned_counters(self):
+        set_pinned_counters(["foo==pinned"])
+        set_max_dynamic_counters(get_dynamic_counters_number())
+        # a pinned counter never overflows
+        pinned = bound_conditions([make_condition("foo", 0, "pinned")])
+        self.assertEqual(pinned[0][0], "foo==pinned")
+        # and its blocks are kept when it is not in use
+        self.assertEqual(conditional_incr_counters(pinned),
+                         (False, ["foo==pinned"]))
+        self.assertEqual(get_counter_blocks("foo==pinned"), 1)
+        del counter.counters_blocks["foo==pinned"]
+        del counter.counters_blocks["foo=====global"]
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of thr library released under the MIT license.
+# See the LICENSE file for more information.
+
+import time
+from unittest import TestCase
+
+from thr.redis2http.counter import conditional_incr_counters
+from thr.redis2http.counter import set_limit_provider, del_counter
+from thr.redis2http.lease import Leases, leased_limit
+from thr.redis2http.lease import is_distributed, is_leased
+from thr.redis2http.limits import Limits, add_max_limit
+
+
+def foo_hash(request):
+    return "foo"
+
+
+class TestLeases(TestCase):
+
+    def setUp(self):
+        Limits.reset()
+        Leases.reset()
+        add_max_limit("local", lambda x: "foo", "foo", 3)
+        add_max_limit("dist", foo_hash, foo_hash, 3, distributed=True)
+
+    def tearDown(self):
+        set_limit_provider(None)
+        for counter in ("local", "dist==foo"):
+            del_counter(counter)
+
+    def test_is_leased(self):
+        self.assertTrue(is_distributed("dist==foo"))
+        self.assertFalse(is_distributed("local"))
+        # (global counters are never leased)
+        self.assertFalse(is_distributed("dist=====global"))
+        Leases.partitioned = True
+        self.assertTrue(is_leased("local"))
+        self.assertFalse(is_leased("dist=====global"))
+
+    def test_leased_limit(self):
+        self.assertEqual(leased_limit("local", 3), 3)
+        self.assertEqual(leased_limit("dist==foo", 3), 0)
+        Leases.update("dist==foo", 2, time.time() + 10)
+        self.assertEqual(leased_limit("dist==foo", 3), 2)
+        # expired lease
+        Leases.update("dist==foo", 2, time.time() - 1)
+        self.assertEqual(leased_limit("dist==foo", 3), 0)
+
+    def test_conditional_incr_counters(self):
+        set_limit_provider(leased_limit)
+        conditions = [("local", 3, None, "local"),
+                      ("dist==foo", 3, "dist=====global", "dist")]
+        self.assertEqual(conditional_incr_counters(conditions),
+                         (False, ["dist==foo"]))
+        Leases.update("dist==foo", 1, time.time() + 10)
+        self.assertEqual(conditional_incr_counters(conditions),
+                         (True, ["local", "dist==foo"]))
+        self.assertEqual(conditional_incr_counters(conditions),
+                         (False, ["dist==foo"]))
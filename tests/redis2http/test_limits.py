@@ -10,10 +10,12 @@ import mock
 from six import assertCountEqual
 
 from thr.redis2http.limits import Limits, Limit
-from thr.redis2http.limits import add_max_limit
+from thr.redis2http.limits import add_max_limit, set_limit_overrides
 from thr.redis2http.counter import set_counter, del_counter
 from thr.redis2http.counter import conditional_incr_counters
+from thr.redis2http.counter import set_max_dynamic_counters
 from thr.utils import glob, regexp, diff
+from thr.hashes import Hashes, add_hash
 
 
 def uri_hash_func(message):
@@ -29,6 +31,8 @@ class TestLimits(TestCase):
     def setUp(self):
         super(TestLimits, self).setUp()
         Limits.reset()
+        Hashes.reset()
+        self.addCleanup(Hashes.reset)
         self.make_uuid_predictable()
 
     def make_uuid_predictable(self):
@@ -147,3 +151,123 @@ class TestLimits(TestCase):
         self.assertEqual(counters, ['regexp'])
 
         del_counter('regexp')
+
+    def test_named_hash_limits(self):
+        add_hash("method", method_hash_func)
+        add_max_limit("get", "method", "GET", 1)
+        add_max_limit("method", "method", "method", 1)
+        add_max_limit("unknown", "unknown", "foo", 1)
+        get_request = mock.Mock(side_effect=Exception("not called"))
+        # precomputed hashes => the request is not unserialized
+        conditions = Limits.conditions(get_request,
+                                       hashes={"method": "GET"})
+        assertCountEqual(self, conditions,
+                         [("get", 1, None, "get"),
+                          ("method==GET", 1, "method=====global", "method")])
+        # no precomputed hash => the registered function is called
+        message = HTTPServerRequest("POST", "/foo")
+        conditions = Limits.conditions(lambda: message)
+        self.assertEqual(conditions,
+                         [("method==POST", 1, "method=====global", "method")])
+
+    def test_named_hash_request(self):
+        def user_hash(request):
+            return request.headers["X-User"]
+        add_hash("user", user_hash)
+        add_max_limit("user", "user", "user", 1)
+        server_message = HTTPServerRequest("GET", "/foo")
+        server_message.headers["X-User"] = "john"
+        get_request = mock.Mock(side_effect=Exception("not called"))
+        # the named hashes get the server-style request
+        conditions = Limits.conditions(get_request,
+                                       server_message=lambda: server_message)
+        self.assertEqual(conditions,
+                         [("user==john", 1, "user=====global", "user")])
+        # an exception in the hash function => no hash value
+        conditions = Limits.conditions(HTTPServerRequest("GET", "/foo"))
+        self.assertEqual(conditions, [])
+        self.assertEqual(Hashes.compute(HTTPServerRequest("GET", "/foo")),
+                         {"user": None})
+
+    def test_indexed_limits(self):
+        add_max_limit("foo", uri_hash_func, "/foo", 1)
+        add_max_limit("bar", uri_hash_func, "/bar", 2)
+        add_max_limit("foo2", uri_hash_func, "/foo", 3)
+        add_max_limit("glob", uri_hash_func, glob("/ba*"), 4)
+        add_max_limit("regexp", uri_hash_func, regexp("/f.o"), 5)
+        add_max_limit("uri", uri_hash_func, uri_hash_func, 6)
+        indexes = Limits.get_indexes()
+        self.assertEqual(len(indexes), 1)
+        self.assertEqual(sorted(indexes[0].exact.keys()), ["/bar", "/foo"])
+        self.assertIsNotNone(indexes[0].prefilter)
+        conditions = Limits.conditions(HTTPServerRequest("GET", "/foo"))
+        assertCountEqual(self, conditions,
+                         [("foo", 1, None, "foo"), ("foo2", 3, None, "foo2"),
+                          ("regexp", 5, None, "regexp"),
+                          ("uri==/foo", 6, "uri=====global", "uri")])
+        conditions = Limits.conditions(HTTPServerRequest("GET", "/baz"))
+        assertCountEqual(self, conditions,
+                         [("glob", 4, None, "glob"),
+                          ("uri==/baz", 6, "uri=====global", "uri")])
+
+    def test_queue_limits(self):
+        add_max_limit("foo", uri_hash_func, "/foo", 1)
+        add_max_limit("foo_q1", uri_hash_func, "/foo", 2, queues="q1")
+        add_max_limit("foo_q2", uri_hash_func, "/foo", 3,
+                      queues=["q2", "q3"])
+        message = HTTPServerRequest("GET", "/foo")
+        self.assertEqual(Limits.conditions(message), [("foo", 1, None, "foo")])
+        assertCountEqual(self, Limits.conditions(message, queue="q1"),
+                         [("foo", 1, None, "foo"),
+                          ("foo_q1", 2, None, "foo_q1")])
+        assertCountEqual(self, Limits.conditions(message, queue="q3"),
+                         [("foo", 1, None, "foo"),
+                          ("foo_q2", 3, None, "foo_q2")])
+        # the indexes are rebuilt when a limit is added
+        add_max_limit("foo_q1_bis", uri_hash_func, "/foo", 4, queues="q1")
+        assertCountEqual(self, Limits.conditions(message, queue="q1"),
+                         [("foo", 1, None, "foo"),
+                          ("foo_q1", 2, None, "foo_q1"),
+                          ("foo_q1_bis", 4, None, "foo_q1_bis")])
+
+    def test_overrides(self):
+        add_max_limit("uri", uri_hash_func, uri_hash_func, 2,
+                      overrides={"/a": 50, "/b": 10})
+        self.assertRaises(Exception, add_max_limit, "foo", uri_hash_func,
+                          "/foo", 1, overrides={"/foo": 2})
+        conditions = Limits.conditions(HTTPServerRequest("GET", "/a"))
+        self.assertEqual(conditions,
+                         [("uri==/a", 50, "uri=====global", "uri")])
+        conditions = Limits.conditions(HTTPServerRequest("GET", "/c"))
+        self.assertEqual(conditions, [("uri==/c", 2, "uri=====global", "uri")])
+        self.assertEqual(Limits.get_limit("uri==/b"), 10)
+        self.assertEqual(Limits.get_limit("uri==/c"), 2)
+        self.assertEqual(Limits.get_limit("uri"), 2)
+        self.assertIsNone(Limits.get_limit("unknown"))
+        # (scaled limit of the overflow counter)
+        set_max_dynamic_counters(10)
+        self.addCleanup(set_max_dynamic_counters, 0)
+        self.assertEqual(Limits.get_limit("uri==__overflow__"), 20)
+        # runtime update
+        set_limit_overrides("uri", {"/c": 5})
+        self.assertEqual(Limits.get_limit("uri==/a"), 2)
+        self.assertEqual(Limits.get_limit("uri==/c"), 5)
+        self.assertEqual(Limits.limits["uri"].initial_overrides,
+                         {"/a": 50, "/b": 10})
+
+    def test_prefilter(self):
+        add_max_limit("glob", uri_hash_func, glob("/foo*"), 1)
+        add_max_limit("regexp", uri_hash_func, regexp("/(b)ar"), 2)
+        index = Limits.get_indexes()[0]
+        self.assertIsNotNone(index.prefilter)
+        self.assertIsNotNone(index.prefilter.match("/foo/1"))
+        self.assertIsNotNone(index.prefilter.match("/bar"))
+        self.assertIsNone(index.prefilter.match("/baz"))
+        # a backreference would refer to another group once merged
+        add_max_limit("regexp2", uri_hash_func, regexp("/(a)\\1"), 3)
+        index = Limits.get_indexes()[0]
+        self.assertIsNone(index.prefilter)
+        conditions = Limits.conditions(HTTPServerRequest("GET", "/aa"))
+        self.assertEqual(conditions, [("regexp2", 3, None, "regexp2")])
+        conditions = Limits.conditions(HTTPServerRequest("GET", "/foo"))
+        self.assertEqual(conditions, [("glob", 1, None, "glob")])
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of thr library released under the MIT license.
+# See the LICENSE file for more information.
+
+from unittest import TestCase
+
+from thr.redis2http.queue import Queues, add_queue
+
+
+class TestQueue(TestCase):
+
+    def setUp(self):
+        Queues.reset()
+
+    def tearDown(self):
+        Queues.reset()
+
+    def test_add_queue(self):
+        add_queue("thr:queue:foo", http_port=8080, workers=2)
+        queues = list(Queues.queues)
+        self.assertEqual(len(queues), 1)
+        self.assertEqual(queues[0].queues, ["thr:queue:foo"])
+        self.assertEqual(queues[0].workers, 2)
+
+    def test_add_queue_with_bus_pool(self):
+        add_queue("thr:queue:foo", bus_pool=["10.0.0.1:6380",
+                                             "/tmp/redis.sock"])
+        queues = list(Queues.queues)
+        self.assertEqual(len(queues), 2)
+        self.assertEqual((queues[0].host, queues[0].port), ("10.0.0.1", 6380))
+        self.assertIsNone(queues[0].unix_domain_socket)
+        self.assertEqual(queues[1].unix_domain_socket, "/tmp/redis.sock")
+        self.assertEqual(queues[1].queues, ["thr:queue:foo"])
+
+    def test_add_queue_with_max_workers(self):
+        add_queue("thr:queue:foo", workers=2, max_workers=5)
+        add_queue("thr:queue:bar", workers=2, max_workers=1)
+        foo, bar = list(Queues.queues)
+        self.assertTrue(foo.autoscaled)
+        self.assertEqual(foo.max_workers, 5)
+        self.assertFalse(bar.autoscaled)
+        foo.workers_to_stop = 1
+        self.assertTrue(foo.should_stop_worker())
+        self.assertFalse(foo.should_stop_worker())
+
+    def test_add_reliable_queue(self):
+        add_queue("thr:queue:foo", reliable=True)
+        self.assertTrue(list(Queues.queues)[0].reliable)
+        self.assertRaises(Exception, add_queue, ["foo", "bar"], reliable=True)
+        self.assertRaises(Exception, add_queue, "foo", queue_type="zset",
+                          reliable=True)
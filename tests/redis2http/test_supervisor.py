@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of thr library released under the MIT license.
+# See the LICENSE file for more information.
+
+import socket
+from unittest import TestCase
+import tornado
+from tornado.iostream import IOStream
+from tornado.testing import AsyncTestCase, gen_test
+
+from thr.redis2http.supervisor import Budgets, BudgetChannel, fair_shares
+from thr.redis2http.supervisor import merge_stats, serve_worker
+
+
+class TestBudgets(TestCase):
+
+    def test_fair_shares(self):
+        self.assertEqual(fair_shares(3, {0: 5, 1: 5}), {0: 1, 1: 2})
+        self.assertEqual(fair_shares(10, {0: 1, 1: 2}), {0: 1, 1: 2})
+
+    def test_update(self):
+        budgets = Budgets()
+        # first come, first served
+        self.assertEqual(budgets.update(0, {"foo": (4, 3, 5)}), {"foo": 4})
+        self.assertEqual(budgets.update(1, {"foo": (4, 0, 5)}), {"foo": 0})
+        # worker 0 gets its fair share but its running requests still
+        # hold their slots...
+        self.assertEqual(budgets.update(0, {"foo": (4, 3, 5)}), {"foo": 2})
+        self.assertEqual(budgets.update(1, {"foo": (4, 0, 5)}), {"foo": 1})
+        # ... until they are done
+        self.assertEqual(budgets.update(0, {"foo": (4, 1, 5)}), {"foo": 2})
+        self.assertEqual(budgets.update(1, {"foo": (4, 0, 5)}), {"foo": 2})
+        # released slots
+        self.assertEqual(budgets.update(0, {"foo": (4, 0, 0)}), {"foo": 0})
+        self.assertEqual(budgets.update(1, {"foo": (4, 2, 5)}), {"foo": 4})
+        budgets.release(1)
+        self.assertEqual(budgets.granted, {})
+
+    def test_busy_workers(self):
+        budgets = Budgets()
+        used = {0: 0, 1: 0}
+        grants = {0: 0, 1: 0}
+        wanted = {0: 5, 1: 4}
+        for i in range(0, 10):
+            for worker in (0, 1):
+                # a busy worker refills its slots up to its grant (its
+                # short requests are done between two renewals)
+                used[worker] = grants[worker]
+                grants[worker] = budgets.update(worker, {
+                    "foo": (5, used[worker], wanted[worker])})["foo"]
+                self.assertTrue(sum(used.values()) <= 5)
+        self.assertEqual(grants, {0: 3, 1: 2})
+
+    def test_merge_stats(self):
+        total = {}
+        merge_stats(total, {"epoch": 10, "total": 1,
+                            "counters": {"foo_limit": 3, "foo_value": 1}})
+        merge_stats(total, {"epoch": 12, "total": 2,
+                            "counters": {"foo_limit": 3, "foo_value": 2}})
+        self.assertEqual(total, {"epoch": 12, "total": 3,
+                                 "counters": {"foo_limit": 3,
+                                              "foo_value": 3}})
+
+
+class TestBudgetChannel(AsyncTestCase):
+
+    @gen_test
+    def test_request(self):
+        supervisor_socket, worker_socket = socket.socketpair()
+        budgets = Budgets()
+        stream = IOStream(supervisor_socket)
+        loop = tornado.ioloop.IOLoop.current()
+        loop.spawn_callback(serve_worker, 0, stream, budgets)
+        channel = BudgetChannel(worker_socket)
+        grants = yield channel.request({"foo": (2, 0, 3)})
+        self.assertEqual(grants, {"foo": 2})
+        channel.stream.close()
+        yield tornado.gen.sleep(0.05)
+        self.assertEqual(budgets.granted, {})
+        supervisor_socket.close()
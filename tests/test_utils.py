@@ -9,7 +9,8 @@ import six
 
 from thr.utils import make_unique_id, serialize_http_request
 from thr.utils import unserialize_request_message, serialize_http_response
-from thr.utils import unserialize_response_message
+from thr.utils import unserialize_response_message, decode_request_message
+from thr.utils import server_request_from_decoded_message
 
 
 class TestUtils(TestCase):
@@ -128,3 +129,27 @@ class TestUtils(TestCase):
         self.assertEquals(len(list(headers.get_all())), 3)
         self.assertEquals(headers['Foo2'], "bar3")
         self.assertEquals(headers['Foo'], "bar,bar2")
+
+    def test_serialize_response_without_body(self):
+        response = HTTPResponse(HTTPRequest("http://foo.com"), 204)
+        msg = serialize_http_response(response)
+        (status_code, body, body_link, headers, extra_dict) = \
+            unserialize_response_message(msg)
+        self.assertEquals(status_code, 204)
+        self.assertEquals(body, b"")
+
+    def test_server_request_from_decoded_message(self):
+        req = HTTPServerRequest(method='POST', uri="/foo?bar=1&bar=2",
+                                body=b"baz", host="example.com")
+        req.headers["X-User"] = "john"
+        req.remote_ip = "10.0.0.1"
+        msg = serialize_http_request(req, proxy_ip="10.0.0.2")
+        sreq = server_request_from_decoded_message(
+            decode_request_message(msg))
+        self.assertEquals(sreq.method, "POST")
+        self.assertEquals(sreq.path, "/foo")
+        self.assertEquals(sreq.host, "example.com")
+        self.assertEquals(sreq.query_arguments, {"bar": [b"1", b"2"]})
+        self.assertEquals(sreq.headers["X-User"], "john")
+        self.assertEquals(sreq.body, b"baz")
+        self.assertEquals(sreq.remote_ip, "10.0.0.1")
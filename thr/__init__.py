@@ -15,3 +15,12 @@ DEFAULT_MAXIMUM_LIFETIME = 300
 DEFAULT_MAXIMUM_LOCAL_QUEUE_LIFETIME_MS = 1000
 BRPOP_TIMEOUT = 5
 REDIS_POOL_CLIENT_TIMEOUT = 60
+RULES_STATS_BUCKETS_MS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100)
+LATENCY_BUCKETS_MS = (1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000,
+                      10000, 30000, 60000)
+DEFAULT_JOB_RESULT_TTL = 3600
+SATURATION_KEY = "thr:saturation"
+BATCH_SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+BLOCKING_COUNTERS_LIFETIME = 10
+REINJECT_BATCH_MAX_SIZE = 1000
+BLOCKED_DEADLINES_COMPACT_MIN_SIZE = 1000
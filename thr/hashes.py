@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of thr library released under the MIT license.
+# See the LICENSE file for more information.
+
+import logging
+
+logger = logging.getLogger("thr.hashes")
+
+
+class Hashes(object):
+
+    hashes = {}
+
+    @classmethod
+    def reset(cls):
+        cls.hashes = {}
+
+    @classmethod
+    def add(cls, name, hash_func):
+        cls.hashes[name] = hash_func
+
+    @classmethod
+    def get(cls, name):
+        return cls.hashes.get(name, None)
+
+    @classmethod
+    def call(cls, name, request):
+        """
+        Computes a registered hash for the given request
+
+        Returns:
+            the hash value (None if the hash is unknown or if the hash
+            function raised an exception, which is logged)
+        """
+        hash_func = cls.hashes.get(name, None)
+        if hash_func is None:
+            return None
+        try:
+            return hash_func(request)
+        except Exception:
+            logger.exception("exception in the %s hash", name)
+            return None
+
+    @classmethod
+    def compute(cls, request):
+        """
+        Computes all the registered hashes for the given request
+
+        Returns:
+            a dict hash name => value (None values are kept)
+        """
+        return {name: cls.call(name, request) for name in cls.hashes}
+
+
+def add_hash(name, hash_func):
+    """
+    Register a named hash function (limit key extractor)
+
+    In http2redis, all registered hashes are computed on the incoming
+    request and the results are shipped in the message (so the hash
+    functions only need the request headers, method, path and query
+    arguments). In redis2http, the name can be used as ``hash_func``
+    (and ``hash_value`` for dynamic limits) in
+    :func:`~thr.redis2http.limits.add_max_limit`: the precomputed value is
+    used if available, else the locally registered hash function is
+    called on the unserialized request.
+
+    On both sides, the hash function gets a tornado ``HTTPServerRequest``
+    (in redis2http, it is rebuilt from the message: the ``remote_ip`` is
+    the first address of the X-Forwarded-For header). An exception raised
+    by the hash function is logged and the hash value is None.
+
+    Args:
+        name: a hash name (unique)
+        hash_func: a function taking the request (HTTPServerRequest) as
+            sole argument and returning a string (or None)
+
+    Examples:
+        >>> def user_hash(request):
+                return request.headers.get('X-User')
+        >>> add_hash("user", user_hash)
+        >>> add_max_limit("user_limit", "user", "user", 3)
+    """
+    if "==" in name:
+        raise Exception("'==' not allowed in hash names")
+    Hashes.add(name, hash_func)
@@ -7,6 +7,7 @@
 from tornado import ioloop
 from tornado import gen, httpserver, netutil
 from tornado.web import RequestHandler, Application, url
+from tornado.httputil import HTTPServerRequest, HTTPHeaders
 from tornado.options import define, options, parse_command_line
 import tornadis
 import time
@@ -15,13 +16,28 @@ import signal
 import functools
 import datetime
 import logging
+import json
+import os
+import base64
+import hashlib
+import hmac
+import re
 
 from thr.http2redis.rules import Rules
+from thr.http2redis import metrics
+from thr.http2redis.concurrency import ConcurrencyLimits
+from thr.http2redis.bus import BusPools
+from thr.http2redis.consumers import Consumers
+from thr.http2redis.saturation import Saturation
+from thr.http2redis.mirror import get_mirror_buffer, mirror_buffers
 from thr.http2redis.exchange import HTTPExchange
+from thr.hashes import Hashes
 from thr.utils import make_unique_id, serialize_http_request, \
-    unserialize_response_message
+    unserialize_response_message, parse_redis_address, get_consumers_key, \
+    make_priority_score, parse_saturation_field, get_available_consumers_key
 from thr import DEFAULT_REDIS_HOST, DEFAULT_REDIS_PORT, DEFAULT_REDIS_QUEUE
 from thr import DEFAULT_TIMEOUT, REDIS_POOL_CLIENT_TIMEOUT
+from thr import SATURATION_KEY
 
 
 define("timeout", type=int, help="Timeout in second for a request",
@@ -38,17 +54,90 @@ define("redis_queue", default=DEFAULT_REDIS_QUEUE,
        help="Default redis queue")
 define("unix_socket", default=None, help="Path to unix socket to bind")
 define("backlog", type=int, default=128, help="socket backlog")
+define("rules_stats", type=bool, default=False,
+       help="Record match counters and timings for each rule")
+define("stats_file", type=str, help="Complete path of the json stat file",
+       default="/tmp/http2redis_stats.json")
+define("stats_frequency_ms", type=int, help="Stats file write frequency "
+       "(in ms) (0 => no stats write)", default=0)
+define("jobs_path", default=None,
+       help="Path of the asynchronous jobs results endpoint "
+       "(for example: /thr/jobs) (None => disabled)")
+define("jobs_secret", default=None,
+       help="Secret key signing the asynchronous jobs tickets (must be "
+       "shared by all http2redis processes, mandatory if jobs_path is set)")
+define("batch_path", default=None,
+       help="Path of the batch endpoint (for example: /thr/batch) "
+       "(None => disabled)")
+define("batch_max_size", type=int, default=100,
+       help="Maximum number of sub-requests in a batch request")
+define("mirror_buffer_size", type=int, default=1000,
+       help="Maximum number of mirrored requests waiting to be pushed (by "
+       "redis instance), over this limit mirrored requests are dropped")
+define("mirror_flush_ms", type=int, default=50,
+       help="Push frequency (in ms) of mirrored requests")
+define("check_consumers", type=bool, default=False,
+       help="Reply immediately with a 503 (or use the fallback queue) when "
+       "the redis queue has no live consumer (redis2http heartbeats)")
+define("check_consumers_frequency_ms", type=int, default=1000,
+       help="Refresh frequency (in ms) of the live consumers cache")
+define("check_saturation", type=bool, default=False,
+       help="Refresh (in background) the saturated redis2http counters "
+       "(needed by saturation_check actions)")
+define("check_saturation_frequency_ms", type=int, default=1000,
+       help="Refresh frequency (in ms) of the saturated counters cache")
+define("metrics_port", type=int, default=0,
+       help="Listening port for the Prometheus metrics endpoint "
+       "(0 => disabled)")
+define("metrics_unix_socket", default=None,
+       help="Path to unix socket to bind for the Prometheus metrics endpoint")
 
 redis_pools = {}
 running_exchanges = {}
+jobs_secret = None
 
+metrics.register_gauge("http2redis_running_exchanges",
+                       "Number of running exchanges",
+                       lambda: len(running_exchanges))
+metrics.register_gauge(
+    "http2redis_concurrency_limit{limit}", "Adaptive concurrency limits",
+    lambda: {x: int(y.limit) for x, y in ConcurrencyLimits.limits.items()})
+metrics.register_gauge(
+    "http2redis_concurrency_in_flight{limit}",
+    "In-flight requests by concurrency limit",
+    lambda: {x: y.in_flight for x, y in ConcurrencyLimits.limits.items()})
+metrics.register_gauge(
+    "http2redis_concurrency_shed{limit}",
+    "Requests shed by concurrency limit",
+    lambda: {x: y.shed for x, y in ConcurrencyLimits.limits.items()})
+metrics.register_gauge(
+    "http2redis_mirrored{bus}", "Mirrored requests pushed on the bus",
+    lambda: {x: y.mirrored for x, y in mirror_buffers.items()})
+metrics.register_gauge(
+    "http2redis_mirror_dropped{bus}", "Dropped mirrored requests",
+    lambda: {x: y.dropped for x, y in mirror_buffers.items()})
+metrics.register_gauge(
+    "http2redis_saturated_counters",
+    "Redis2http counters saturated in one consumer at least",
+    lambda: len([x for x in Saturation.counters.keys()
+                 if len(Saturation.get_reporters(x)) > 0]))
+metrics.register_gauge(
+    "http2redis_bus_member_latency_ms{member}",
+    "Average LPUSH latency by bus pool member (ms)",
+    lambda: {x.address: x.latency_ms for pool in BusPools.pools.values()
+             for x in pool.members})
 
-def get_redis_pool(host=None, port=None, uds=None):
-    global redis_pools
+
+def get_redis_pool_key(host=None, port=None, uds=None):
     if uds is None:
-        key = "%s:%i" % (host, port)
+        return "%s:%i" % (host, port)
     else:
-        key = uds
+        return uds
+
+
+def get_redis_pool(host=None, port=None, uds=None):
+    global redis_pools
+    key = get_redis_pool_key(host, port, uds)
     if key not in redis_pools:
         kwargs = {"autoclose": True, "connect_timeout": options.timeout,
                   "client_timeout": REDIS_POOL_CLIENT_TIMEOUT,
@@ -63,9 +152,398 @@ def get_redis_pool(host=None, port=None, uds=None):
     return redis_pools[key]
 
 
+def get_jobs_secret():
+    global jobs_secret
+    if jobs_secret is None:
+        if not options.jobs_secret:
+            raise Exception("the jobs_secret option is mandatory with the "
+                            "jobs_path option")
+        jobs_secret = options.jobs_secret.encode('utf-8')
+    return jobs_secret
+
+
+def sign_job_ticket(payload):
+    digest = hmac.new(get_jobs_secret(), payload.encode('ascii'),
+                      hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).decode('ascii').rstrip("=")
+
+
+def compare_signatures(a, b):
+    # (constant time comparison, hmac.compare_digest is not available
+    # with all supported python versions)
+    if len(a) != len(b):
+        return False
+    result = 0
+    for x, y in zip(a, b):
+        result |= ord(x) ^ ord(y)
+    return result == 0
+
+
+def make_job_ticket(job_id, redis_pool_key):
+    encoded = base64.urlsafe_b64encode(redis_pool_key.encode('utf-8'))
+    payload = "%s.%s" % (job_id, encoded.decode('ascii').rstrip("="))
+    return "%s.%s" % (payload, sign_job_ticket(payload))
+
+
+def parse_job_ticket(ticket):
+    """Parses a job ticket.
+
+    The ticket is signed (see the jobs_secret option) so a client can't
+    make http2redis connect to another redis server than the one which
+    received the job.
+
+    Returns:
+        A tuple (job_id, redis_pool_key).
+
+    Raises:
+        ValueError: when the ticket is not valid.
+    """
+    if not re.match(r"^[a-zA-Z0-9]+\.[a-zA-Z0-9_-]+\.[a-zA-Z0-9_-]+$",
+                    ticket):
+        raise ValueError("invalid ticket")
+    payload, signature = ticket.rsplit('.', 1)
+    if not compare_signatures(signature, sign_job_ticket(payload)):
+        raise ValueError("invalid ticket")
+    job_id, encoded = payload.split('.', 1)
+    encoded = encoded + "=" * (-len(encoded) % 4)
+    try:
+        decoded = base64.urlsafe_b64decode(encoded.encode('ascii'))
+        return (job_id, decoded.decode('utf-8'))
+    except (TypeError, UnicodeDecodeError):
+        raise ValueError("invalid ticket")
+
+
+def get_job_key(job_id):
+    return "thr:job:%s" % job_id
+
+
+def select_bus_member(exchange):
+    """Chooses the redis instance of the bus pool set on the exchange
+    (if any) and updates the exchange redis_host/redis_port/redis_uds
+    attributes accordingly.
+
+    Returns:
+        The chosen BusMember object (or None if there is no bus pool or
+        if the bus pool is unknown, the exchange redis_host/redis_port/
+        redis_uds attributes are used in that case).
+    """
+    if exchange.redis_bus_pool is None:
+        return None
+    bus_pool = BusPools.get(exchange.redis_bus_pool)
+    if bus_pool is None:
+        return None
+    member = bus_pool.choose(exchange.redis_queue)
+    exchange.redis_host = member.host
+    exchange.redis_port = member.port
+    exchange.redis_uds = member.uds
+    return member
+
+
+def serialize_exchange_request(exchange, response_key, extra=None,
+                               proxy_ip="AUTO"):
+    dict_to_inject = {
+        'response_key': response_key,
+        'priority': exchange.priority,
+        'creation_time': time.time(),
+        'request_id': exchange.request_id
+    }
+    if len(Hashes.hashes) > 0:
+        dict_to_inject['hashes'] = Hashes.compute(exchange.request)
+    if extra is not None:
+        dict_to_inject.update(extra)
+    return serialize_http_request(exchange.request,
+                                  dict_to_inject=dict_to_inject,
+                                  proxy_ip=proxy_ip)
+
+
+def get_push_score(exchange):
+    """
+    Returns the score of the exchange in a sorted set queue (None if the
+    redis queue of the exchange is a list)
+    """
+    if exchange.redis_queue_type != "zset":
+        return None
+    return make_priority_score(exchange.priority, time.time())
+
+
+def stack_push_messages(pipeline, redis_queue, messages):
+    """
+    Stacks the push of (serialized request, score) tuples on a redis queue
+    (one LPUSH for the None scores, one ZADD for the others)
+    """
+    values = [x for x, score in messages if score is None]
+    if len(values) > 0:
+        pipeline.stack_call('LPUSH', redis_queue, *values)
+    args = []
+    for message, score in messages:
+        if score is not None:
+            args.extend([score, message])
+    if len(args) > 0:
+        pipeline.stack_call('ZADD', redis_queue, *args)
+
+
+def stack_push(pipeline, exchange, message):
+    """
+    Stacks the push of a serialized request on the redis queue of the
+    exchange (LPUSH for a list, ZADD for a sorted set)
+    """
+    stack_push_messages(pipeline, exchange.redis_queue,
+                        [(message, get_push_score(exchange))])
+
+
+@gen.coroutine
+def push_request(redis, exchange, message):
+    """
+    Pushes a serialized request on the redis queue of the exchange
+
+    Returns:
+        the queue length (int) or an error
+    """
+    if exchange.redis_queue_type != "zset":
+        result = yield redis.call('LPUSH', exchange.redis_queue, message)
+        raise gen.Return(result)
+    pipeline = tornadis.Pipeline()
+    stack_push(pipeline, exchange, message)
+    pipeline.stack_call('ZCARD', exchange.redis_queue)
+    result = yield redis.call(pipeline)
+    if isinstance(result, list) and len(result) == 2 and \
+            isinstance(result[0], six.integer_types):
+        raise gen.Return(result[1])
+    raise gen.Return(result)
+
+
+def mirror_exchange_request(exchange):
+    key = get_redis_pool_key(host=exchange.redis_host,
+                             port=exchange.redis_port,
+                             uds=exchange.redis_uds)
+    mirror_buffer = get_mirror_buffer(key, options.mirror_buffer_size)
+    if not mirror_buffer.has_room():
+        # (no need to serialize a dropped copy)
+        mirror_buffer.dropped += 1
+        return
+    # the X-Forwarded-For header has already been set by the serialization
+    # of the original request (so proxy_ip=None)
+    message = serialize_exchange_request(exchange, None,
+                                         extra={'mirror': True},
+                                         proxy_ip=None)
+    # (the mirror queue has the same type as the redis queue)
+    mirror_buffer.put(exchange.mirror_queue, message,
+                      score=get_push_score(exchange))
+
+
+@gen.coroutine
+def flush_mirror_buffer(key, mirror_buffer):
+    mirror_buffer.flushing = True
+    try:
+        messages = mirror_buffer.pop_all()
+        pipeline = tornadis.Pipeline()
+        count = 0
+        for queue, values in messages.items():
+            stack_push_messages(pipeline, queue, values)
+            count += len(values)
+        host, port, uds = parse_redis_address(key)
+        redis_pool = get_redis_pool(host=host, port=port, uds=uds)
+        with (yield redis_pool.connected_client()) as redis:
+            result = yield redis.call(pipeline)
+        if isinstance(result, list) and \
+                all([isinstance(x, six.integer_types) for x in result]):
+            mirror_buffer.mirrored += count
+        else:
+            logging.warning("can't push %i mirrored request(s) on %s "
+                            "=> dropping them", count, key)
+            mirror_buffer.dropped += count
+    finally:
+        mirror_buffer.flushing = False
+
+
+def flush_mirror_buffer_callback(key, future):
+    try:
+        future.result()
+    except Exception:
+        logging.exception("exception during mirrored requests push on %s",
+                          key)
+
+
+def flush_mirror_buffers():
+    io_loop = ioloop.IOLoop.current()
+    for key, mirror_buffer in list(mirror_buffers.items()):
+        if len(mirror_buffer.messages) > 0 and not mirror_buffer.flushing:
+            io_loop.add_future(flush_mirror_buffer(key, mirror_buffer),
+                               functools.partial(
+                                   flush_mirror_buffer_callback, key))
+
+
+def check_consumers(exchange):
+    """
+    Returns False if the redis queue of the exchange has no live consumer
+    (after switching to the fallback queue if any)
+
+    The fallback queue is also used when no live consumer of the redis
+    queue has spare capacity (and when the fallback queue has some).
+    """
+    if not options.check_consumers:
+        return True
+    key = get_redis_pool_key(host=exchange.redis_host,
+                             port=exchange.redis_port,
+                             uds=exchange.redis_uds)
+    alive = Consumers.is_alive(key, exchange.redis_queue)
+    if alive and Consumers.has_spare_capacity(key, exchange.redis_queue):
+        return True
+    fallback = exchange.fallback_redis_queue
+    if fallback is not None and Consumers.is_alive(key, fallback) and \
+            (not alive or Consumers.has_spare_capacity(key, fallback)):
+        logging.debug("no live consumer with spare capacity on %s => "
+                      "using %s", exchange.redis_queue, fallback)
+        exchange.redis_queue = fallback
+        return True
+    return alive
+
+
+@gen.coroutine
+def refresh_consumers():
+    now = time.time()
+    for key, queues in Consumers.get_queues().items():
+        pipeline = tornadis.Pipeline()
+        for queue in queues:
+            pipeline.stack_call('ZCOUNT', get_consumers_key(queue),
+                                "%.3f" % now, '+inf')
+            pipeline.stack_call('ZCOUNT', get_available_consumers_key(queue),
+                                "%.3f" % now, '+inf')
+        host, port, uds = parse_redis_address(key)
+        redis_pool = get_redis_pool(host=host, port=port, uds=uds)
+        with (yield redis_pool.connected_client()) as redis:
+            if isinstance(redis, tornadis.ConnectionError):
+                result = redis
+            else:
+                result = yield redis.call(pipeline)
+        if not isinstance(result, list):
+            logging.warning("can't refresh live consumers on %s", key)
+            continue
+        for queue, count, available_count in zip(queues, result[0::2],
+                                                 result[1::2]):
+            if isinstance(count, six.integer_types) and \
+                    isinstance(available_count, six.integer_types):
+                Consumers.update(key, queue, count, available_count)
+
+
+@gen.coroutine
+def consumers_handler():
+    while True:
+        try:
+            yield refresh_consumers()
+        except Exception:
+            logging.exception("exception during live consumers refresh")
+        yield gen.sleep(options.check_consumers_frequency_ms / 1000.0)
+
+
+@gen.coroutine
+def refresh_saturation():
+    keys = set(redis_pools.keys())
+    keys.add(get_redis_pool_key(host=options.redis_host,
+                                port=options.redis_port,
+                                uds=options.redis_uds))
+    queues = Saturation.get_queues()
+    counters = {}
+    consumers = dict([(x, set()) for x in queues])
+    now = time.time()
+    for key in keys:
+        host, port, uds = parse_redis_address(key)
+        redis_pool = get_redis_pool(host=host, port=port, uds=uds)
+        with (yield redis_pool.connected_client()) as redis:
+            if isinstance(redis, tornadis.ConnectionError):
+                logging.warning("can't refresh saturated counters on %s",
+                                key)
+                continue
+            pipeline = tornadis.Pipeline()
+            pipeline.stack_call('HGETALL', SATURATION_KEY)
+            for queue in queues:
+                # (live consumers, see the redis2http heartbeat)
+                pipeline.stack_call('ZRANGEBYSCORE', get_consumers_key(queue),
+                                    "%.3f" % now, '+inf')
+            result = yield redis.call(pipeline)
+            if not isinstance(result, list) or \
+                    not all([isinstance(x, list) for x in result]):
+                logging.warning("can't refresh saturated counters on %s",
+                                key)
+                continue
+            for queue, members in zip(queues, result[1:]):
+                for member in members:
+                    if not isinstance(member, str):
+                        member = member.decode('utf-8')
+                    consumers[queue].add(member)
+            expired = []
+            fields = result[0]
+            for i in range(0, len(fields) - 1, 2):
+                field = fields[i]
+                if not isinstance(field, str):
+                    field = field.decode('utf-8')
+                expiration = float(fields[i + 1])
+                if expiration < now:
+                    # (field of a stopped or crashed redis2http process)
+                    expired.append(field)
+                    continue
+                counter, consumer_id = parse_saturation_field(field)
+                counters.setdefault(counter, {})[consumer_id] = expiration
+            if len(expired) > 0:
+                yield redis.call('HDEL', SATURATION_KEY, *expired)
+    Saturation.update(counters, consumers)
+
+
+@gen.coroutine
+def saturation_handler():
+    while True:
+        try:
+            yield refresh_saturation()
+        except Exception:
+            logging.exception("exception during saturated counters refresh")
+        yield gen.sleep(options.check_saturation_frequency_ms / 1000.0)
+
+
+def update_exchange_from_response_message(exchange, message):
+    (status_code, body, body_link, headers, _) = \
+        unserialize_response_message(message)
+    exchange.response.status_code = status_code
+    # FIXME: body_link ???
+    exchange.response.body = body
+    exchange.response.headers = headers
+
+
+def acquire_concurrency_limit(exchange):
+    """Acquires the concurrency limit of the exchange (if any).
+
+    Returns:
+        A tuple (acquired, limit): acquired is False if the request must be
+        shed (a Retry-After header is set on the exchange response), limit
+        is the ConcurrencyLimit object to release (or None).
+    """
+    limit = ConcurrencyLimits.get_for_exchange(exchange)
+    if limit is None:
+        return (True, None)
+    if not limit.acquire():
+        exchange.set_output_header(("Retry-After", str(limit.retry_after)))
+        return (False, None)
+    return (True, limit)
+
+
+def release_concurrency_limit(limit, before, status):
+    """Releases a concurrency limit acquired at the before timestamp.
+
+    Args:
+        limit: the ConcurrencyLimit object (None => nothing is done).
+        before: timestamp of the push of the request.
+        status: the status code of the response (None => the request
+            failed with an exception).
+    """
+    if limit is None:
+        return
+    failed = status is None or status in (500, 502, 503, 504, 599)
+    limit.release((time.time() - before) * 1000, failed=failed)
+
+
 class Handler(RequestHandler):
 
     __request_id = None
+    __start_time = None
 
     def compute_etag(self, *args, **kwargs):
         return None
@@ -123,18 +601,18 @@ class Handler(RequestHandler):
         for name in exchange.response.headers.keys():
             value = exchange.response.headers[name]
             self.set_header(name, value)
+        if self.__start_time is not None:
+            elapsed_ms = (time.time() - self.__start_time) * 1000
+            metrics.observe_reply(self.get_status(), elapsed_ms,
+                                  len(body) if body else 0)
         self.finish(body)
 
     def update_exchange_from_response_message(self, exchange, message):
-        (status_code, body, body_link, headers, _) = \
-            unserialize_response_message(message)
-        exchange.response.status_code = status_code
-        # FIXME: body_link ???
-        exchange.response.body = body
-        exchange.response.headers = headers
+        update_exchange_from_response_message(exchange, message)
 
     @gen.coroutine
     def handle(self, *args, **kwargs):
+        self.__start_time = time.time()
         exchange = HTTPExchange(self.request,
                                 default_redis_host=options.redis_host,
                                 default_redis_port=options.redis_port,
@@ -143,6 +621,7 @@ class Handler(RequestHandler):
         self.__request_id = exchange.request_id
         running_exchanges[self.__request_id] = exchange
         yield Rules.execute_input_actions(exchange)
+        metrics.rules_time.observe((time.time() - self.__start_time) * 1000)
         if exchange.response.status_code is not None and \
                 exchange.response.status_code != "null":
             # so we don't push the request on redis
@@ -156,51 +635,360 @@ class Handler(RequestHandler):
             self.return_http_reply(exchange, force_status=404,
                                    force_body="no redis queue set")
         else:
-            redis_pool = get_redis_pool(host=exchange.redis_host,
-                                        port=exchange.redis_port,
-                                        uds=exchange.redis_uds)
-            with (yield redis_pool.connected_client()) as redis:
-                response_key = "thr:queue:response:%s" % make_unique_id()
-                serialized_request = serialize_http_request(
-                    exchange.request,
-                    dict_to_inject={
-                        'response_key': response_key,
-                        'priority': exchange.priority,
-                        'creation_time': time.time(),
-                        'request_id': exchange.request_id
-                    })
-                lpush_res = yield redis.call('LPUSH', exchange.redis_queue,
-                                             serialized_request)
-                if not isinstance(lpush_res, six.integer_types):
-                    yield Rules.execute_output_actions(exchange)
-                    self.return_http_reply(exchange, force_status=500,
-                                           force_body="can't connect to bus")
-                    return
-
-                before = datetime.datetime.now()
-                while True:
-                    result = yield redis.call('BRPOP', response_key, 1)
-                    if result and not isinstance(result,
-                                                 tornadis.ConnectionError):
-                        self.update_exchange_from_response_message(exchange,
-                                                                   result[1])
-                        yield Rules.execute_output_actions(exchange)
-                        self.return_http_reply(exchange)
-                        break
-                    after = datetime.datetime.now()
-                    delta = after - before
-                    if delta.total_seconds() > options.timeout:
-                        yield Rules.execute_output_actions(exchange)
-                        self.return_http_reply(exchange, force_status=504,
-                                               force_body="no reply from "
-                                               "the backend")
-                        break
+            acquired, limit = acquire_concurrency_limit(exchange)
+            if not acquired:
+                yield Rules.execute_output_actions(exchange)
+                self.return_http_reply(exchange, force_status=503,
+                                       force_body="too many requests in "
+                                       "flight")
+                return
+            before = time.time()
+            try:
+                yield self.push(exchange)
+            except Exception:
+                release_concurrency_limit(limit, before, None)
+                raise
+            release_concurrency_limit(limit, before, self.get_status())
+
+    @gen.coroutine
+    def push(self, exchange):
+        member = select_bus_member(exchange)
+        if not check_consumers(exchange):
+            yield Rules.execute_output_actions(exchange)
+            self.return_http_reply(exchange, force_status=503,
+                                   force_body="no live consumer for "
+                                   "this queue")
+            return
+        pool_key = get_redis_pool_key(host=exchange.redis_host,
+                                      port=exchange.redis_port,
+                                      uds=exchange.redis_uds)
+        redis_pool = get_redis_pool(host=exchange.redis_host,
+                                    port=exchange.redis_port,
+                                    uds=exchange.redis_uds)
+        with (yield redis_pool.connected_client()) as redis:
+            metrics.redis_pools_in_use[pool_key] += 1
+            try:
+                yield self.push_and_wait(exchange, redis, member=member)
+            finally:
+                metrics.redis_pools_in_use[pool_key] -= 1
+
+    @gen.coroutine
+    def push_and_wait(self, exchange, redis, member=None):
+        extra = None
+        if exchange.async_job_ttl is not None:
+            job_id = make_unique_id()
+            response_key = get_job_key(job_id)
+            extra = {'job_ttl': exchange.async_job_ttl}
+        else:
+            response_key = "thr:queue:response:%s" % make_unique_id()
+        serialized_request = serialize_exchange_request(exchange,
+                                                        response_key,
+                                                        extra=extra)
+        before_lpush = time.time()
+        lpush_future = push_request(redis, exchange, serialized_request)
+        if exchange.mirror_queue is not None:
+            # (serialized after the LPUSH of the original request is sent,
+            # so the mirroring doesn't add latency)
+            ioloop.IOLoop.current().add_callback(mirror_exchange_request,
+                                                 exchange)
+        lpush_res = yield lpush_future
+        lpush_ms = (time.time() - before_lpush) * 1000
+        metrics.lpush_time.observe(lpush_ms)
+        if member is not None:
+            if isinstance(lpush_res, six.integer_types):
+                member.report(exchange.redis_queue, lpush_ms, lpush_res)
+            else:
+                member.report_failure()
+        if not isinstance(lpush_res, six.integer_types):
+            yield Rules.execute_output_actions(exchange)
+            self.return_http_reply(exchange, force_status=500,
+                                   force_body="can't connect to bus")
+            return
+        if exchange.async_job_ttl is not None:
+            yield redis.call('SETEX', response_key + ":pending",
+                             exchange.async_job_ttl, "1")
+            pool_key = get_redis_pool_key(host=exchange.redis_host,
+                                          port=exchange.redis_port,
+                                          uds=exchange.redis_uds)
+            ticket = make_job_ticket(job_id, pool_key)
+            body = {"ticket": ticket}
+            if options.jobs_path is not None:
+                jobs_path = options.jobs_path.rstrip("/")
+                body["location"] = "%s/%s" % (jobs_path, ticket)
+                exchange.set_output_header(("Location", body["location"]))
+            exchange.set_status_code(202)
+            exchange.set_output_body(json.dumps(body))
+            yield Rules.execute_output_actions(exchange)
+            self.return_http_reply(exchange)
+            return
+
+        before = datetime.datetime.now()
+        before_wait = time.time()
+        while True:
+            result = yield redis.call('BRPOP', response_key, 1)
+            if result and not isinstance(result, tornadis.ConnectionError):
+                metrics.wait_time.observe((time.time() - before_wait) * 1000)
+                self.update_exchange_from_response_message(exchange,
+                                                           result[1])
+                yield Rules.execute_output_actions(exchange)
+                self.return_http_reply(exchange)
+                break
+            after = datetime.datetime.now()
+            delta = after - before
+            if delta.total_seconds() > options.timeout:
+                metrics.wait_time.observe((time.time() - before_wait) * 1000)
+                yield Rules.execute_output_actions(exchange)
+                self.return_http_reply(exchange, force_status=504,
+                                       force_body="no reply from "
+                                       "the backend")
+                break
+
+
+class JobHandler(RequestHandler):
+    """
+    Returns the result of an asynchronous job (202 if the job is still
+    pending, 404 if the ticket is unknown or expired). The wait query
+    string argument (in seconds) can be used to long-poll the result.
+    """
+
+    @gen.coroutine
+    def get(self, ticket):
+        try:
+            job_id, redis_pool_key = parse_job_ticket(ticket)
+            wait = min(int(self.get_argument("wait", "0")), options.timeout)
+        except ValueError:
+            self.set_status(400)
+            self.finish("invalid ticket or wait argument")
+            return
+        host, port, uds = parse_redis_address(redis_pool_key)
+        redis_pool = get_redis_pool(host=host, port=port, uds=uds)
+        job_key = get_job_key(job_id)
+        with (yield redis_pool.connected_client()) as redis:
+            if wait > 0:
+                # non destructive blocking read
+                result = yield redis.call('BRPOPLPUSH', job_key, job_key,
+                                          wait)
+            else:
+                result = yield redis.call('LINDEX', job_key, 0)
+            if isinstance(result, tornadis.ConnectionError):
+                self.set_status(500)
+                self.finish("can't connect to bus")
+                return
+            if result is None:
+                pending = yield redis.call('EXISTS', job_key + ":pending")
+                if pending == 1:
+                    self.set_status(202)
+                    self.finish(json.dumps({"ticket": ticket,
+                                            "status": "pending"}))
+                else:
+                    self.set_status(404)
+                    self.finish("unknown or expired job")
+                return
+        (status_code, body, _, headers, _) = \
+            unserialize_response_message(result)
+        self.set_status(504 if status_code == 599 else status_code)
+        for name in headers.keys():
+            self.set_header(name, headers[name])
+        self.finish(body)
+
+
+def make_batch_response(exchange):
+    status = exchange.response.status_code
+    body = exchange.response.body
+    if body is None and exchange.output_default_body is not None and \
+            exchange.output_default_body != "null":
+        body = exchange.output_default_body
+    if body is None:
+        body = b""
+    elif isinstance(body, six.text_type):
+        body = body.encode('utf-8')
+    return {"status_code": 504 if status == 599 else status,
+            "headers": list(exchange.response.headers.get_all()),
+            "body": base64.standard_b64encode(body).decode('ascii')}
+
+
+class BatchHandler(RequestHandler):
+    """
+    Runs many sub-requests (json body) through the rules and the bus and
+    returns all the responses in a single json reply.
+
+    Request body::
+
+        {"requests": [{"method": "POST", "path": "/foo?bar=1",
+                       "headers": [["X-Foo", "bar"]],
+                       "body": "<base64 encoded body>"}],
+         "timeout": 10}
+
+    Response body::
+
+        {"responses": [{"status_code": 200, "headers": [["X-Foo", "bar"]],
+                        "body": "<base64 encoded body>"}]}
+
+    Sub-requests are pushed with one pipeline per redis instance and the
+    responses are popped together. Sub-requests without response at the
+    deadline get a 504 status code. Like other requests, sub-requests are
+    mirrored, count as running exchanges and are subject to concurrency
+    limits (503 when shed). Asynchronous jobs actions are ignored for
+    sub-requests.
+    """
+
+    def make_sub_exchange(self, sub_request):
+        headers = HTTPHeaders()
+        for name, value in sub_request.get('headers', []):
+            headers.add(name, value)
+        body = sub_request.get('body', None)
+        if body is not None:
+            body = base64.standard_b64decode(body.encode('ascii'))
+        request = HTTPServerRequest(method=sub_request.get('method', 'GET'),
+                                    uri=sub_request['path'], headers=headers,
+                                    body=body, host=self.request.host)
+        request.remote_ip = self.request.remote_ip
+        return HTTPExchange(request,
+                            default_redis_host=options.redis_host,
+                            default_redis_port=options.redis_port,
+                            default_redis_queue=options.redis_queue,
+                            default_redis_uds=options.redis_uds)
+
+    @gen.coroutine
+    def post(self):
+        try:
+            decoded = json.loads(self.request.body.decode('utf-8'))
+            timeout = min(float(decoded.get('timeout', options.timeout)),
+                          options.timeout)
+            exchanges = [self.make_sub_exchange(x)
+                         for x in decoded['requests']]
+        except (ValueError, KeyError, TypeError, AttributeError):
+            self.set_status(400)
+            self.finish("invalid batch request")
+            return
+        if len(exchanges) > options.batch_max_size:
+            self.set_status(413)
+            self.finish("too many sub-requests")
+            return
+        for exchange in exchanges:
+            running_exchanges[exchange.request_id] = exchange
+        try:
+            yield self.run(exchanges, timeout)
+        finally:
+            for exchange in exchanges:
+                running_exchanges.pop(exchange.request_id, None)
+        responses = []
+        for exchange in exchanges:
+            yield Rules.execute_output_actions(exchange)
+            responses.append(make_batch_response(exchange))
+        self.set_header("Content-Type", "application/json")
+        self.finish(json.dumps({"responses": responses}))
+
+    @gen.coroutine
+    def run(self, exchanges, timeout):
+        before = time.time()
+        deadline = before + timeout
+        # redis pool key => (first exchange, pipeline, response_key =>
+        #                    exchange)
+        targets = {}
+        # (exchange, acquired concurrency limit) tuples
+        limits = []
+        for exchange in exchanges:
+            yield Rules.execute_input_actions(exchange)
+            if exchange.response.status_code is not None and \
+                    exchange.response.status_code != "null":
+                continue
+            if exchange.redis_queue == "null":
+                exchange.response.status_code = 404
+                exchange.response.body = b"no redis queue set"
+                continue
+            select_bus_member(exchange)
+            if not check_consumers(exchange):
+                exchange.response.status_code = 503
+                exchange.response.body = b"no live consumer for this queue"
+                continue
+            acquired, limit = acquire_concurrency_limit(exchange)
+            if not acquired:
+                exchange.response.status_code = 503
+                exchange.response.body = b"too many requests in flight"
+                continue
+            if limit is not None:
+                limits.append((exchange, limit))
+            key = get_redis_pool_key(host=exchange.redis_host,
+                                     port=exchange.redis_port,
+                                     uds=exchange.redis_uds)
+            if key not in targets:
+                targets[key] = (exchange, tornadis.Pipeline(), {})
+            pipeline, pending = targets[key][1:]
+            response_key = "thr:queue:response:%s" % make_unique_id()
+            stack_push(pipeline, exchange,
+                       serialize_exchange_request(exchange, response_key))
+            pending[response_key] = exchange
+        try:
+            yield [self.push_and_wait(x[0], x[1], x[2], deadline)
+                   for x in targets.values()]
+        except Exception:
+            for exchange, limit in limits:
+                release_concurrency_limit(limit, before, None)
+            raise
+        for exchange, limit in limits:
+            release_concurrency_limit(limit, before,
+                                      exchange.response.status_code)
+
+    @gen.coroutine
+    def push_and_wait(self, exchange, pipeline, pending, deadline):
+        redis_pool = get_redis_pool(host=exchange.redis_host,
+                                    port=exchange.redis_port,
+                                    uds=exchange.redis_uds)
+        with (yield redis_pool.connected_client()) as redis:
+            future = redis.call(pipeline)
+            for tmp in pending.values():
+                if tmp.mirror_queue is not None:
+                    ioloop.IOLoop.current().add_callback(
+                        mirror_exchange_request, tmp)
+            results = yield future
+            if not isinstance(results, list) or \
+                    not all([isinstance(x, six.integer_types)
+                             for x in results]):
+                for tmp in pending.values():
+                    tmp.response.status_code = 500
+                    tmp.response.body = b"can't connect to bus"
+                return
+            while len(pending) > 0 and time.time() < deadline:
+                result = yield redis.call('BRPOP', *(list(pending.keys()) +
+                                                     [1]))
+                if result and not isinstance(result,
+                                             tornadis.ConnectionError):
+                    response_key = result[0]
+                    if not isinstance(response_key, str):
+                        response_key = response_key.decode('utf-8')
+                    tmp = pending.pop(response_key, None)
+                    if tmp is not None:
+                        update_exchange_from_response_message(tmp,
+                                                              result[1])
+        for tmp in pending.values():
+            tmp.response.status_code = 504
+            tmp.response.body = b"no reply from the backend"
+
+
+def write_stats():
+    stats = {"epoch": time.time(),
+             "running_exchanges": len(running_exchanges)}
+    if Rules.stats_enabled:
+        stats["rules"] = Rules.get_stats()
+    stats["concurrency_limits"] = ConcurrencyLimits.get_stats()
+    with open(options.stats_file, "w") as f:
+        f.write(json.dumps(stats, indent=4))
 
 
 def make_app():
     if options.config is not None:
         exec(open(options.config).read(), {})
-    return Application([url(r"/.*", Handler)])
+    handlers = []
+    if options.jobs_path is not None:
+        # (fail at startup rather than on the first job ticket)
+        get_jobs_secret()
+        handlers.append(url(r"%s/([^/]+)" % options.jobs_path.rstrip('/'),
+                            JobHandler))
+    if options.batch_path is not None:
+        handlers.append(url(options.batch_path, BatchHandler))
+    handlers.append(url(r"/.*", Handler))
+    return Application(handlers)
 
 
 def sig_handler(server, sig, frame):
@@ -238,6 +1026,31 @@ def main():
         sockets = netutil.bind_sockets(options.port,
                                        backlog=options.backlog)
         server.add_sockets(sockets)
+    if options.metrics_port != 0 or options.metrics_unix_socket:
+        metrics_server = httpserver.HTTPServer(metrics.make_metrics_app())
+        if options.metrics_unix_socket:
+            socket = netutil.bind_unix_socket(options.metrics_unix_socket)
+            metrics_server.add_socket(socket)
+        if options.metrics_port != 0:
+            metrics_server.listen(options.metrics_port)
+    if options.rules_stats:
+        Rules.enable_stats()
+    if options.check_consumers:
+        ioloop.IOLoop.instance().spawn_callback(consumers_handler)
+    if options.check_saturation:
+        ioloop.IOLoop.instance().spawn_callback(saturation_handler)
+    mirror_pc = ioloop.PeriodicCallback(flush_mirror_buffers,
+                                        options.mirror_flush_ms)
+    mirror_pc.start()
+    if options.stats_frequency_ms > 0:
+        stats_pc = ioloop.PeriodicCallback(write_stats,
+                                           options.stats_frequency_ms)
+        stats_pc.start()
     signal.signal(signal.SIGTERM, functools.partial(sig_handler, server))
     ioloop.IOLoop.instance().set_blocking_log_threshold(1)
     ioloop.IOLoop.instance().start()
+    if options.stats_frequency_ms > 0:
+        try:
+            os.remove(options.stats_file)
+        except OSError:
+            pass
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of thr library released under the MIT license.
+# See the LICENSE file for more information.
+
+import random
+import time
+import logging
+
+from thr.utils import parse_redis_address
+
+logger = logging.getLogger("thr.http2redis.bus")
+# max number of unknown pool names remembered (to log them only once)
+MAX_UNKNOWN_NAMES = 1000
+
+
+class BusMember(object):
+    """
+    A redis instance of a bus pool with its observed load
+
+    Attributes:
+        latency_ms: exponentially weighted moving average of LPUSH latency
+        lengths: a dict redis queue => length (returned by the last LPUSH)
+        down_until: timestamp until which the instance is considered down
+    """
+
+    def __init__(self, address, down_time=5, alpha=0.2):
+        self.address = address
+        self.host, self.port, self.uds = parse_redis_address(address)
+        self.down_time = down_time
+        self.alpha = alpha
+        self.latency_ms = 0.0
+        self.lengths = {}
+        self.down_until = 0
+
+    def is_up(self, now):
+        return now >= self.down_until
+
+    def load(self, queue):
+        return self.latency_ms * (1 + self.lengths.get(queue, 0))
+
+    def report(self, queue, latency_ms, length):
+        self.latency_ms += self.alpha * (latency_ms - self.latency_ms)
+        self.lengths[queue] = length
+
+    def report_failure(self):
+        self.down_until = time.time() + self.down_time
+
+
+class BusPool(object):
+    """
+    A pool of redis instances backing the same queues
+
+    The target instance is chosen for each request with the "power of two
+    choices" algorithm: two random instances (which are not down) are
+    compared and the less loaded one (LPUSH latency and queue length) is
+    chosen.
+    """
+
+    def __init__(self, name, addresses, down_time=5):
+        if len(addresses) == 0:
+            raise Exception("you must provide at least one redis address")
+        self.name = name
+        self.members = [BusMember(x, down_time=down_time) for x in addresses]
+
+    def choose(self, queue):
+        now = time.time()
+        members = [x for x in self.members if x.is_up(now)]
+        if len(members) == 0:
+            # everything is down, let's try anyway
+            members = self.members
+        if len(members) == 1:
+            return members[0]
+        first, second = random.sample(members, 2)
+        if second.load(queue) < first.load(queue):
+            return second
+        return first
+
+
+class BusPools(object):
+
+    pools = {}
+    # unknown pool names already logged
+    unknown = set()
+
+    @classmethod
+    def reset(cls):
+        cls.pools = {}
+        cls.unknown = set()
+
+    @classmethod
+    def add(cls, pool):
+        cls.pools[pool.name] = pool
+
+    @classmethod
+    def get(cls, name):
+        """
+        Returns:
+            the :class:`BusPool` with the given name (None if there is no
+            such pool, it is logged once)
+        """
+        pool = cls.pools.get(name, None)
+        if pool is None and name not in cls.unknown:
+            if len(cls.unknown) >= MAX_UNKNOWN_NAMES:
+                cls.unknown = set()
+            cls.unknown.add(name)
+            logger.warning("unknown bus pool: %s", name)
+        return pool
+
+
+def add_bus_pool(name, addresses, down_time=5):
+    """
+    Register a pool of redis instances to use as a single bus
+
+    Requests which matched a rule with the ``set_redis_bus_pool=name``
+    action are pushed on one of these instances (the response is read on
+    the same instance). At redis2http side, use the same list as
+    ``bus_pool`` argument of :func:`~thr.redis2http.queue.add_queue`.
+
+    Args:
+        name: a pool name (unique)
+        addresses: a list of redis addresses ("host:port" or unix domain
+            socket path)
+
+    Keyword Args:
+        down_time: number of seconds an instance is skipped after
+            a connection error
+
+    Examples:
+        >>> add_bus_pool("main", ["10.0.0.1:6379", "10.0.0.2:6379"])
+        >>> add_rule(Criteria(), Actions(set_redis_bus_pool="main"))
+    """
+    BusPools.add(BusPool(name, addresses, down_time=down_time))
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of thr library released under the MIT license.
+# See the LICENSE file for more information.
+
+import time
+import logging
+
+logger = logging.getLogger("thr.http2redis.concurrency")
+# max number of unknown limit names remembered (names can be computed
+# from the requests)
+MAX_UNKNOWN_NAMES = 1000
+
+
+class ConcurrencyLimit(object):
+    """
+    Adaptive (AIMD) limit of in-flight requests
+
+    The limit grows slowly (additive increase) while responses come back
+    faster than ``target_latency_ms`` and shrinks quickly (multiplicative
+    decrease) when they are slower or when they fail.
+
+    Attributes:
+        limit: current (float) limit of in-flight requests
+        in_flight: current number of in-flight requests
+        accepted: number of accepted requests
+        shed: number of rejected requests (because of the limit)
+    """
+
+    def __init__(self, name, initial_limit=100, min_limit=1,
+                 max_limit=1000, target_latency_ms=1000, backoff=0.9,
+                 retry_after=1):
+        self.name = name
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.target_latency_ms = target_latency_ms
+        self.backoff = backoff
+        self.retry_after = retry_after
+        self.in_flight = 0
+        self.accepted = 0
+        self.shed = 0
+        self.last_decrease = 0
+
+    def acquire(self):
+        """
+        Returns:
+            True if the request can be pushed (False if it must be shed)
+        """
+        if self.in_flight >= int(self.limit):
+            self.shed += 1
+            return False
+        self.in_flight += 1
+        self.accepted += 1
+        return True
+
+    def release(self, latency_ms, failed=False):
+        """
+        Args:
+            latency_ms: observed latency (in ms) of the released request
+            failed: True if the request failed (timeout, bus error...)
+        """
+        in_flight = self.in_flight
+        self.in_flight -= 1
+        if failed or latency_ms > self.target_latency_ms:
+            now = time.time()
+            # only one decrease by latency window (all requests in flight
+            # during a slowdown will be slow, we don't want to collapse)
+            if (now - self.last_decrease) * 1000 > self.target_latency_ms:
+                self.limit = max(self.min_limit, self.limit * self.backoff)
+                self.last_decrease = now
+        elif in_flight * 2 >= self.limit:
+            # we increase the limit only if it is (at least half) used
+            self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+
+    def to_dict(self):
+        return {"limit": int(self.limit), "in_flight": self.in_flight,
+                "accepted": self.accepted, "shed": self.shed}
+
+
+class ConcurrencyLimits(object):
+
+    limits = {}
+    # unknown limit names already logged
+    unknown = set()
+
+    @classmethod
+    def reset(cls):
+        cls.limits = {}
+        cls.unknown = set()
+
+    @classmethod
+    def add(cls, limit):
+        cls.limits[limit.name] = limit
+
+    @classmethod
+    def get_for_exchange(cls, exchange):
+        """
+        Returns:
+            the :class:`ConcurrencyLimit` to apply on the exchange (the one
+            set by the ``set_concurrency_limit`` action or the one named
+            as the redis queue of the exchange) or None
+        """
+        if exchange.concurrency_limit is not None:
+            name = exchange.concurrency_limit
+            limit = cls.limits.get(name, None)
+            if limit is None and name not in cls.unknown:
+                # (logged once, the exchange is not limited)
+                if len(cls.unknown) >= MAX_UNKNOWN_NAMES:
+                    cls.unknown = set()
+                cls.unknown.add(name)
+                logger.warning("unknown concurrency limit: %s", name)
+            return limit
+        return cls.limits.get(exchange.redis_queue, None)
+
+    @classmethod
+    def get_stats(cls):
+        return {name: limit.to_dict() for name, limit in cls.limits.items()}
+
+
+def add_concurrency_limit(name, initial_limit=100, min_limit=1,
+                          max_limit=1000, target_latency_ms=1000,
+                          backoff=0.9, retry_after=1):
+    """
+    Add an adaptive limit of in-flight requests
+
+    When the limit is reached, requests are rejected immediately with
+    a 503 status code (and a Retry-After header) instead of being pushed
+    on the bus.
+
+    The limit applies to requests pushed on the redis queue with the same
+    name or to requests which matched a rule with the
+    ``set_concurrency_limit=name`` action.
+
+    Args:
+        name: a limit name (unique), a redis queue name to apply the limit
+            on all requests pushed on this queue
+
+    Keyword Args:
+        initial_limit: initial number of in-flight requests
+        min_limit: the limit will never be lower
+        max_limit: the limit will never be bigger
+        target_latency_ms: above this latency (in ms), the limit is
+            decreased
+        backoff: multiplicative decrease factor
+        retry_after: value (in seconds) of the Retry-After header sent
+            with 503 responses
+
+    Examples:
+        >>> add_concurrency_limit("thr:queue:slow", initial_limit=50,
+                                  target_latency_ms=2000)
+    """
+    ConcurrencyLimits.add(ConcurrencyLimit(
+        name, initial_limit=initial_limit, min_limit=min_limit,
+        max_limit=max_limit, target_latency_ms=target_latency_ms,
+        backoff=backoff, retry_after=retry_after))
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of thr library released under the MIT license.
+# See the LICENSE file for more information.
+
+
+class Consumers(object):
+    """
+    In memory cache of the number of live consumers (redis2http processes)
+    by redis instance and queue (and of the number of live consumers with
+    spare capacity)
+
+    The cache is refreshed in background. A queue is considered as served
+    (with spare capacity) until the first refresh (so we fail open).
+    """
+
+    counts = {}
+    available_counts = {}
+
+    @classmethod
+    def reset(cls):
+        cls.counts = {}
+        cls.available_counts = {}
+
+    @classmethod
+    def is_alive(cls, redis_pool_key, queue):
+        """
+        Returns:
+            False if the queue (on the given redis instance) has no live
+            consumer (at the last refresh)
+        """
+        key = (redis_pool_key, queue)
+        if key not in cls.counts:
+            # let's refresh it at the next refresh
+            cls.counts[key] = None
+            return True
+        return cls.counts[key] != 0
+
+    @classmethod
+    def has_spare_capacity(cls, redis_pool_key, queue):
+        """
+        Returns:
+            False if no consumer of the queue (on the given redis instance)
+            has spare capacity (at the last refresh)
+        """
+        return cls.available_counts.get((redis_pool_key, queue), None) != 0
+
+    @classmethod
+    def update(cls, redis_pool_key, queue, count, available_count=None):
+        cls.counts[(redis_pool_key, queue)] = count
+        cls.available_counts[(redis_pool_key, queue)] = available_count
+
+    @classmethod
+    def get_queues(cls):
+        """
+        Returns:
+            a dict redis pool key => list of queues to refresh
+        """
+        result = {}
+        for (redis_pool_key, queue) in cls.counts.keys():
+            if redis_pool_key not in result:
+                result[redis_pool_key] = []
+            result[redis_pool_key].append(queue)
+        return result
@@ -4,9 +4,12 @@
 # This file is part of thr library released under the MIT license.
 # See the LICENSE file for more information.
 
+import random
+import six
 from tornado.httputil import HTTPHeaders
 from tornado.escape import parse_qs_bytes
 from thr import DEFAULT_REDIS_HOST, DEFAULT_REDIS_PORT, DEFAULT_REDIS_QUEUE
+from thr import DEFAULT_JOB_RESULT_TTL
 from thr.utils import make_unique_id
 
 
@@ -39,6 +42,20 @@ class HTTPExchange(object):
         request_id: a unique id for the request
         priority: a value between 1 (high) and 99 (low) which will be the
             queue priority at redis2http side.
+        concurrency_limit: the name of the concurrency limit to apply
+            (see :func:`~thr.http2redis.concurrency.add_concurrency_limit`)
+        redis_bus_pool: the name of the bus pool where to push the request
+            (see :func:`~thr.http2redis.bus.add_bus_pool`), if set,
+            overrides redis_host/redis_port/redis_uds attributes
+        async_job_ttl: if not None, the request is processed as an
+            asynchronous job (immediate 202 reply with a ticket) and the
+            result is kept this number of seconds
+        mirror_queue: if not None, a copy of the request is also pushed on
+            this redis queue (and the response of the copy is discarded)
+        fallback_redis_queue: if not None, the request is pushed on this
+            redis queue when the redis_queue has no live consumer
+        redis_queue_type: "list" (default, FIFO) or "zset" (sorted set
+            by priority and creation time)
     """
 
     def __init__(self, request, default_redis_host=DEFAULT_REDIS_HOST,
@@ -56,6 +73,12 @@ class HTTPExchange(object):
         self.request_id = make_unique_id()
         self.priority = 50
         self.matched_rules = None
+        self.concurrency_limit = None
+        self.redis_bus_pool = None
+        self.async_job_ttl = None
+        self.mirror_queue = None
+        self.fallback_redis_queue = None
+        self.redis_queue_type = "list"
 
     def set_custom_value(self, key, value):
         """
@@ -141,6 +164,59 @@ class HTTPExchange(object):
         """
         self.redis_queue = value
 
+    def set_redis_queue_type(self, value):
+        """
+        Set type of the redis queue: "list" (default) or "zset" (the
+        queue is a sorted set by priority and creation time, it must be
+        consumed by a redis2http queue with the same type)
+        """
+        self.redis_queue_type = value
+
+    def set_fallback_redis_queue(self, value):
+        """
+        Set name of the redis queue where to push the request if the
+        redis queue has no live consumer (when consumers are checked)
+        """
+        self.fallback_redis_queue = value
+
+    def set_concurrency_limit(self, value):
+        """
+        Set name of the concurrency limit to apply on the request
+        """
+        self.concurrency_limit = value
+
+    def set_redis_bus_pool(self, value):
+        """
+        Set name of the bus pool where to push the request
+        """
+        self.redis_bus_pool = value
+
+    def set_async_job(self, value):
+        """
+        Process the request as an asynchronous job: http2redis replies
+        immediately with a 202 status code and a ticket to get the result
+        later (value: True or the lifetime in seconds of the result)
+        """
+        if value is True:
+            self.async_job_ttl = DEFAULT_JOB_RESULT_TTL
+        elif value:
+            self.async_job_ttl = int(value)
+        else:
+            self.async_job_ttl = None
+
+    def set_mirror_queue(self, value):
+        """
+        Set name of the redis queue where to push a copy of the request
+        (value: a queue name or a tuple (queue name, fraction of the
+        requests to mirror))
+        """
+        if isinstance(value, six.string_types):
+            self.mirror_queue = value
+        else:
+            queue, fraction = value
+            if random.random() < fraction:
+                self.mirror_queue = queue
+
     def set_redis_host(self, value):
         """
         Set host of the Redis instance where to push the request
@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of thr library released under the MIT license.
+# See the LICENSE file for more information.
+
+import six
+
+
+def make_key_func(key):
+    """
+    Build a function returning a key (string) from an exchange
+
+    Args:
+        key: a callable taking an
+            :class:`~thr.http2redis.exchange.HTTPExchange` as its sole
+            argument, the name of an exchange getter (``real_ip``,
+            ``remote_ip``, ``path``, ``method``...) or ``header:Name`` to
+            use the value of the ``Name`` header
+
+    Returns:
+        A function taking an exchange and returning a key (or None if the
+        key can't be computed)
+    """
+    if callable(key):
+        return key
+    if not isinstance(key, six.string_types):
+        raise Exception("key must be a callable or a string")
+    if key.startswith("header:"):
+        header_name = key.split(":", 1)[1]
+        return lambda exchange: exchange.request.headers.get(header_name,
+                                                             None)
+    getter_name = "get_%s" % key
+    return lambda exchange: getattr(exchange, getter_name)()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of thr library released under the MIT license.
+# See the LICENSE file for more information.
+
+import six
+from collections import defaultdict
+from tornado.web import RequestHandler, Application, url
+
+from thr.http2redis.rules import Rules
+from thr.utils import Histogram
+from thr import LATENCY_BUCKETS_MS, RULES_STATS_BUCKETS_MS
+
+
+rules_time = Histogram(RULES_STATS_BUCKETS_MS)
+lpush_time = Histogram(LATENCY_BUCKETS_MS)
+wait_time = Histogram(LATENCY_BUCKETS_MS)
+total_time = {}
+response_bytes = 0
+redis_pools_in_use = defaultdict(int)
+gauges = []
+
+
+def register_gauge(name, help, callback):
+    """
+    Register a gauge computed when the metrics are rendered
+
+    Args:
+        name: the metric name
+        help: the metric description
+        callback: a function without argument returning a number or a dict
+            label value => number (in this case, the label name is given
+            by the name argument with the ``name{label}`` syntax)
+    """
+    gauges.append((name, help, callback))
+
+
+def observe_reply(status, elapsed_ms, body_length):
+    global response_bytes
+    histogram = total_time.get(status, None)
+    if histogram is None:
+        histogram = Histogram(LATENCY_BUCKETS_MS)
+        total_time[status] = histogram
+    histogram.observe(elapsed_ms)
+    response_bytes += body_length
+
+
+def format_histogram(lines, name, histogram, labels=""):
+    sep = "," if labels else ""
+    cumulative_counts = histogram.cumulative_counts()
+    for bucket, count in zip(histogram.buckets, cumulative_counts):
+        lines.append('%s_bucket{%s%sle="%s"} %i' % (name, labels, sep, bucket,
+                                                    count))
+    lines.append('%s_bucket{%s%sle="+Inf"} %i' % (name, labels, sep,
+                                                  cumulative_counts[-1]))
+    suffix = "{%s}" % labels if labels else ""
+    lines.append("%s_sum%s %s" % (name, suffix, histogram.sum))
+    lines.append("%s_count%s %i" % (name, suffix, histogram.count))
+
+
+def format_header(lines, name, help, metric_type):
+    lines.append("# HELP %s %s" % (name, help))
+    lines.append("# TYPE %s %s" % (name, metric_type))
+
+
+def render_prometheus():
+    """
+    Returns:
+        All metrics (string) in Prometheus text format.
+    """
+    lines = []
+    for name, help, histogram in (
+            ("http2redis_rules_time_ms", "Input rules evaluation time (ms)",
+             rules_time),
+            ("http2redis_lpush_time_ms", "LPUSH latency (ms)", lpush_time),
+            ("http2redis_wait_time_ms",
+             "Time waiting for the response on the bus (ms)", wait_time)):
+        format_header(lines, name, help, "histogram")
+        format_histogram(lines, name, histogram)
+    name = "http2redis_total_time_ms"
+    format_header(lines, name, "Total latency by final status (ms)",
+                  "histogram")
+    for status in sorted(total_time.keys()):
+        format_histogram(lines, name, total_time[status],
+                         labels='status="%s"' % status)
+    name = "http2redis_response_bytes_total"
+    format_header(lines, name, "Response body bytes", "counter")
+    lines.append("%s %i" % (name, response_bytes))
+    name = "http2redis_redis_pool_clients_in_use"
+    format_header(lines, name, "Redis clients in use by pool", "gauge")
+    for pool, value in sorted(six.iteritems(redis_pools_in_use)):
+        lines.append('%s{pool="%s"} %i' % (name, pool, value))
+    for name, help, callback in gauges:
+        value = callback()
+        if "{" in name:
+            name, label = name[:-1].split("{", 1)
+        format_header(lines, name, help, "gauge")
+        if isinstance(value, dict):
+            for key, tmp in sorted(six.iteritems(value)):
+                lines.append('%s{%s="%s"} %s' % (name, label, key, tmp))
+        else:
+            lines.append("%s %s" % (name, value))
+    if Rules.stats_enabled:
+        rules = Rules.rules
+        name = "http2redis_rule_evaluations_total"
+        format_header(lines, name, "Rule evaluations", "counter")
+        for rule in rules:
+            lines.append('%s{rule="%s"} %i' % (name, rule.name,
+                                               rule.stats.evaluations))
+        name = "http2redis_rule_matches_total"
+        format_header(lines, name, "Rule matches", "counter")
+        for rule in rules:
+            lines.append('%s{rule="%s"} %i' % (name, rule.name,
+                                               rule.stats.matches))
+        name = "http2redis_rule_match_time_ms"
+        format_header(lines, name, "Rule criteria evaluation time (ms)",
+                      "histogram")
+        for rule in rules:
+            format_histogram(lines, name, rule.stats.match_time,
+                             labels='rule="%s"' % rule.name)
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(RequestHandler):
+
+    def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4")
+        self.finish(render_prometheus())
+
+
+def make_metrics_app():
+    return Application([url(r"/metrics", MetricsHandler)])
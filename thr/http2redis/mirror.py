@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of thr library released under the MIT license.
+# See the LICENSE file for more information.
+
+from collections import deque
+
+
+class MirrorBuffer(object):
+    """
+    Bounded buffer of mirrored messages for a redis instance
+
+    Messages are pushed on the bus in batches by a periodic flusher (off
+    the request path). When the buffer is full, new messages are dropped.
+
+    Attributes:
+        mirrored: number of messages pushed on the bus
+        dropped: number of dropped messages (full buffer or bus error)
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.messages = deque()
+        self.mirrored = 0
+        self.dropped = 0
+        self.flushing = False
+
+    def has_room(self):
+        """
+        Returns:
+            True if a new message can be put in the buffer
+        """
+        return len(self.messages) < self.max_size
+
+    def put(self, queue, message, score=None):
+        """
+        Args:
+            queue: the name of the redis queue
+            message: the serialized request
+            score: the score of the message for a sorted set queue (None
+                for a list queue)
+
+        Returns:
+            False if the message is dropped (because the buffer is full)
+        """
+        if not self.has_room():
+            self.dropped += 1
+            return False
+        self.messages.append((queue, message, score))
+        return True
+
+    def pop_all(self):
+        """
+        Returns:
+            a dict queue => list of (message, score) tuples (and empty the
+            buffer)
+        """
+        result = {}
+        messages = self.messages
+        while len(messages) > 0:
+            queue, message, score = messages.popleft()
+            if queue not in result:
+                result[queue] = []
+            result[queue].append((message, score))
+        return result
+
+
+mirror_buffers = {}
+
+
+def get_mirror_buffer(key, max_size):
+    if key not in mirror_buffers:
+        mirror_buffers[key] = MirrorBuffer(max_size)
+    return mirror_buffers[key]
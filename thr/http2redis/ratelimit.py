@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of thr library released under the MIT license.
+# See the LICENSE file for more information.
+
+import math
+import time
+import six
+from collections import OrderedDict
+
+from thr.http2redis.keys import make_key_func
+
+
+class RateLimit(object):
+    """
+    Token bucket rate limit (one bucket per key) to use with the
+    ``rate_limit`` action
+
+    Buckets are kept in an ordered dict sorted by last update, so buckets
+    which are full again (idle for more than ``burst / rate`` seconds) can
+    be evicted cheaply from the head of the dict.
+
+    Args:
+        rate: number of allowed requests per second (for each key)
+
+    Keyword Args:
+        burst: size of the bucket (default: rate)
+        key: a key callable or name (see
+            :func:`~thr.http2redis.keys.make_key_func`), requests with
+            a None key are not limited
+        status_code: the status code of rejected requests
+        max_keys: maximum number of stored buckets (if reached, the least
+            recently updated buckets are forgotten)
+
+    Attributes:
+        rejected: number of rejected requests
+    """
+
+    def __init__(self, rate, burst=None, key="real_ip", status_code=429,
+                 max_keys=1000000):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else rate)
+        self.idle_time = self.burst / self.rate
+        self.key_func = make_key_func(key)
+        self.status_code = status_code
+        self.max_keys = max_keys
+        self.buckets = OrderedDict()
+        self.rejected = 0
+
+    def evict(self, now):
+        buckets = self.buckets
+        while len(buckets) > 0:
+            key, (tokens, last_update) = next(six.iteritems(buckets))
+            if now - last_update < self.idle_time and \
+                    len(buckets) < self.max_keys:
+                break
+            del(buckets[key])
+
+    def consume(self, exchange):
+        """
+        Take a token in the bucket of the exchange key
+
+        Args:
+            exchange: An :class:`~thr.http2redis.exchange.HTTPExchange`
+                instance
+
+        Returns:
+            None if the request is allowed, else the number of seconds
+            to wait for the next token
+        """
+        key = self.key_func(exchange)
+        if key is None:
+            return None
+        now = time.time()
+        bucket = self.buckets.pop(key, None)
+        self.evict(now)
+        if bucket is None:
+            tokens = self.burst
+        else:
+            tokens = min(self.burst,
+                         bucket[0] + (now - bucket[1]) * self.rate)
+        if tokens >= 1:
+            self.buckets[key] = (tokens - 1, now)
+            return None
+        self.buckets[key] = (tokens, now)
+        self.rejected += 1
+        return (1 - tokens) / self.rate
+
+    def apply(self, exchange):
+        """
+        Take a token for the exchange or set the response status code (and
+        the Retry-After header) if there is no token available
+
+        Returns:
+            True if the request is allowed
+        """
+        wait = self.consume(exchange)
+        if wait is None:
+            return True
+        exchange.set_status_code(self.status_code)
+        exchange.set_output_header(("Retry-After",
+                                    str(int(math.ceil(wait)))))
+        return False
@@ -4,15 +4,76 @@
 # This file is part of thr library released under the MIT license.
 # See the LICENSE file for more information.
 
+import time
 from tornado import gen
 from tornado import concurrent
 from thr.http2redis.exchange import HTTPExchange
-from thr.utils import glob, regexp
+from thr.utils import glob, regexp, Histogram
+from thr import RULES_STATS_BUCKETS_MS
 
 
 ruleset = []
 
 
+class RuleStats(object):
+    """
+    Match counters and timings of a rule (only updated if stats are enabled
+    with :meth:`Rules.enable_stats`).
+
+    Attributes:
+        evaluations: number of times the criteria have been evaluated.
+        matches: number of times the criteria matched.
+        match_time: histogram of criteria evaluation times (in ms).
+        input_actions_time: histogram of input actions execution times
+            (in ms).
+        output_actions_time: histogram of output actions execution times
+            (in ms).
+        callables: a dict "kind:callable_name" => [calls, total_ms, max_ms]
+            for user-supplied callables.
+    """
+
+    def __init__(self):
+        self.evaluations = 0
+        self.matches = 0
+        self.match_time = Histogram(RULES_STATS_BUCKETS_MS)
+        self.input_actions_time = Histogram(RULES_STATS_BUCKETS_MS)
+        self.output_actions_time = Histogram(RULES_STATS_BUCKETS_MS)
+        self.callables = {}
+
+    def record_callable(self, kind, callback, before):
+        elapsed_ms = (time.time() - before) * 1000
+        name = getattr(callback, '__name__', type(callback).__name__)
+        label = "%s:%s" % (kind, name)
+        if label not in self.callables:
+            self.callables[label] = [0, 0, 0]
+        tmp = self.callables[label]
+        tmp[0] += 1
+        tmp[1] += elapsed_ms
+        tmp[2] = max(tmp[2], elapsed_ms)
+
+    def slowest_callable(self):
+        """
+        Return:
+            the label of the callable with the biggest total time (or None)
+        """
+        if len(self.callables) == 0:
+            return None
+        return max(self.callables, key=lambda x: self.callables[x][1])
+
+    def to_dict(self):
+        callables = {}
+        for label, (calls, total_ms, max_ms) in self.callables.items():
+            callables[label] = {"calls": calls, "total_ms": total_ms,
+                                "max_ms": max_ms}
+        return {"evaluations": self.evaluations,
+                "matches": self.matches,
+                "match_time_ms": self.match_time.to_dict(),
+                "input_actions_time_ms": self.input_actions_time.to_dict(),
+                "output_actions_time_ms": self.output_actions_time.to_dict(),
+                "callables": callables,
+                "slowest_callable": self.slowest_callable()}
+
+
 class Criteria(object):
     """
     A set of criteria which may be satisfied or not. Each criterion is
@@ -54,11 +115,13 @@ class Criteria(object):
         else:
             return self.eval_single_criterion_value(criterion, value)
 
-    def match(self, exchange):
+    def match(self, exchange, stats=None):
         """Check a request against the criteria
 
         Args:
             exchange: A HTTPExchange object
+            stats: A :class:`RuleStats` object to record the time spent
+                in the custom callable (optional)
 
         Returns:
             bool
@@ -72,7 +135,12 @@ class Criteria(object):
                 callback = self.criteria['custom']
                 if not callable(callback):
                     raise Exception("custom criteria must be callable")
-                tmp = callback(exchange)
+                if stats is None:
+                    tmp = callback(exchange)
+                else:
+                    before = time.time()
+                    tmp = callback(exchange)
+                    stats.record_callable("custom", callback, before)
                 if tmp is False:
                     return False
         return True
@@ -98,6 +166,15 @@ class Actions(object):
         set_input_header: a pair of header name and value
         set_status_code: and HTTP response status code
         set_redis_queue: the name of a Redis queue in which to push the request
+        rate_limit: a :class:`~thr.http2redis.ratelimit.RateLimit` instance,
+            requests over the limit are answered locally (429 by default)
+            and the other input actions of the rule are not executed
+        saturation_check: a
+            :class:`~thr.http2redis.saturation.SaturationCheck` instance,
+            requests hitting a saturated redis2http counter are answered
+            locally (503 by default) or deprioritized (executed after the
+            set_* input actions, the custom input action is not executed
+            for rejected requests)
         [...]
     """
 
@@ -116,8 +193,12 @@ class Actions(object):
                                self.is_output_action_name(x)}
         self.action_names.append("custom_input")
         self.action_names.append("custom_output")
+        self.action_names.append("rate_limit")
+        self.action_names.append("saturation_check")
         self.custom_input_action = kwargs.get('custom_input', None)
         self.custom_output_action = kwargs.get('custom_output', None)
+        self.rate_limit = kwargs.get('rate_limit', None)
+        self.saturation_check = kwargs.get('saturation_check', None)
 
     def execute_output_actions(self, exchange):
         return self._execute(exchange, "output")
@@ -129,7 +210,7 @@ class Actions(object):
         return action_name.endswith('_output') or '_output_' in action_name
 
     @gen.coroutine
-    def _execute(self, exchange, mode):
+    def _execute(self, exchange, mode, stats=None):
         """
         Apply actions to the HTTP exchange.
 
@@ -138,6 +219,8 @@ class Actions(object):
                 instance
             mode (string): input for executing input actions,
                 output for executing output actions
+            stats: A :class:`RuleStats` object to record the time spent
+                in callables (optional)
         """
         if mode not in ("input", "output"):
             raise Exception("mode must be input or output")
@@ -147,22 +230,37 @@ class Actions(object):
         else:
             actions = self.input_actions
             custom_action = self.custom_input_action
+            if self.rate_limit is not None:
+                if not self.rate_limit.apply(exchange):
+                    return
         for action_name, action in actions.items():
             if action:
                 if callable(action):
-                    value = action(exchange)
+                    if stats is None:
+                        value = action(exchange)
+                    else:
+                        before = time.time()
+                        value = action(exchange)
+                        stats.record_callable(action_name, action, before)
                     value_to_set = value
                 else:
                     value_to_set = action
                 if value_to_set is not None:
                     set_value = getattr(exchange, action_name)
                     set_value(value_to_set)
+        if mode == 'input' and self.saturation_check is not None:
+            if not self.saturation_check.apply(exchange):
+                return
         if custom_action is not None:
             if callable(custom_action):
+                before = time.time()
                 value = custom_action(exchange)
                 if isinstance(value, concurrent.Future):
                     if not value.done():
                         yield value
+                if stats is not None:
+                    stats.record_callable("custom_%s" % mode, custom_action,
+                                          before)
             else:
                 raise Exception("custom_ actions must be callable")
 
@@ -173,11 +271,14 @@ class Rule(object):
         self.criteria = criteria
         self.actions = actions
         self.stop = kwargs.get('stop', False)
+        self.name = kwargs.get('name', None)
+        self.stats = RuleStats()
 
 
 class Rules(object):
 
     rules = []
+    stats_enabled = False
 
     @classmethod
     def reset(cls):
@@ -185,7 +286,25 @@ class Rules(object):
 
     @classmethod
     def add(cls, criteria, actions, **kwargs):
-        cls.rules.append(Rule(criteria, actions, **kwargs))
+        rule = Rule(criteria, actions, **kwargs)
+        if rule.name is None:
+            rule.name = "rule%i" % len(cls.rules)
+        if any([x.name == rule.name for x in cls.rules]):
+            # (the stats are reported by rule name)
+            raise Exception("duplicate rule name: %s" % rule.name)
+        cls.rules.append(rule)
+
+    @classmethod
+    def enable_stats(cls, enabled=True):
+        cls.stats_enabled = enabled
+
+    @classmethod
+    def get_stats(cls):
+        """
+        Returns:
+            a dict rule name => :meth:`RuleStats.to_dict` result
+        """
+        return {rule.name: rule.stats.to_dict() for rule in cls.rules}
 
     @classmethod
     def count(cls):
@@ -209,13 +328,29 @@ class Rules(object):
             test = False
         else:
             rules = cls.rules
+        stats_enabled = cls.stats_enabled
         for rule in rules:
+            stats = rule.stats if stats_enabled else None
             if test:
-                match = rule.criteria.match(exchange)
+                if stats is None:
+                    match = rule.criteria.match(exchange)
+                else:
+                    before = time.time()
+                    match = rule.criteria.match(exchange, stats=stats)
+                    stats.match_time.observe((time.time() - before) * 1000)
+                    stats.evaluations += 1
+                    if match:
+                        stats.matches += 1
             else:
                 match = True
             if match:
-                yield rule.actions._execute(exchange, mode)
+                if stats is None:
+                    yield rule.actions._execute(exchange, mode)
+                else:
+                    before = time.time()
+                    yield rule.actions._execute(exchange, mode, stats=stats)
+                    histogram = getattr(stats, "%s_actions_time" % mode)
+                    histogram.observe((time.time() - before) * 1000)
                 matched_rules.append(rule)
                 if rule.stop:
                     break
@@ -233,6 +368,8 @@ def add_rule(criteria, actions, **kwargs):
     Keyword Args:
         stop: if True, don't execute subsequent rules if this one matches
         (default False)
+        name: a name for the rule (used in stats, default: "rule" followed
+        by the rule index), unique
 
     Returns:
         None
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of thr library released under the MIT license.
+# See the LICENSE file for more information.
+
+import time
+import six
+
+
+class Saturation(object):
+    """
+    In memory cache of the saturated redis2http counters (published by
+    redis2http processes in the ``thr:saturation`` redis hash)
+
+    A counter is saturated in a redis2http process when its limit is
+    reached and its blocked queue is full (so a new request would be
+    reuploaded on the bus until it expires). Counters are local to each
+    process, so a counter is saturated for a queue only when all the live
+    consumers of the queue report it.
+    """
+
+    # counter name => {consumer id: expiration timestamp}
+    counters = {}
+    # queue name => set of live consumer ids (None => not refreshed yet)
+    consumers = {}
+
+    @classmethod
+    def reset(cls):
+        cls.counters = {}
+        cls.consumers = {}
+
+    @classmethod
+    def update(cls, counters, consumers):
+        """
+        Replace the cache content
+
+        Args:
+            counters: a dict counter name => {consumer id: expiration
+                timestamp}
+            consumers: a dict queue name => set of live consumer ids
+        """
+        cls.counters = counters
+        cls.consumers = consumers
+
+    @classmethod
+    def get_queues(cls):
+        """
+        Returns:
+            the list of queues whose live consumers have to be refreshed
+        """
+        return list(cls.consumers.keys())
+
+    @classmethod
+    def get_reporters(cls, counter, now=None):
+        """
+        Returns:
+            the set of consumer ids which report the counter as saturated
+        """
+        if now is None:
+            now = time.time()
+        return set([x for x, y in cls.counters.get(counter, {}).items()
+                    if y > now])
+
+    @classmethod
+    def is_saturated(cls, counter, queue, now=None):
+        """
+        Returns:
+            True if all the live consumers of the queue report the counter
+            as saturated (False until the first refresh of the queue)
+        """
+        if queue not in cls.consumers:
+            # let's refresh it at the next refresh
+            cls.consumers[queue] = None
+            return False
+        live = cls.consumers[queue]
+        if not live:
+            return False
+        return live.issubset(cls.get_reporters(counter, now))
+
+
+class SaturationCheck(object):
+    """
+    Early rejection (or deprioritization) of requests which would hit a
+    saturated redis2http counter, to use with the ``saturation_check``
+    action (http2redis must be launched with the ``--check_saturation``
+    option)
+
+    Args:
+        counters: a redis2http counter name (for example ``limit_foo`` or
+            ``limit_foo_header==bar`` for a dynamic limit), a list of
+            counter names or a callable (taking the exchange as argument)
+            which returns a counter name, a list of names or None
+
+    Keyword Args:
+        status_code: the status code of rejected requests
+        priority: if not None, requests hitting a saturated counter are
+            not rejected but pushed with this priority (between 1 and 99)
+        retry_after: value of the Retry-After header of rejected requests
+            (None => no header)
+
+    Attributes:
+        rejected: number of rejected (or deprioritized) requests
+    """
+
+    def __init__(self, counters, status_code=503, priority=None,
+                 retry_after=1):
+        self.counters = counters
+        self.status_code = status_code
+        self.priority = priority
+        self.retry_after = retry_after
+        self.rejected = 0
+
+    def get_counters(self, exchange):
+        counters = self.counters
+        if callable(counters):
+            counters = counters(exchange)
+        if counters is None:
+            return []
+        if isinstance(counters, six.string_types):
+            return [counters]
+        return counters
+
+    def apply(self, exchange):
+        """
+        Set the response status code (or the priority) of the exchange if
+        one of its counters is saturated
+
+        Returns:
+            False if the request is rejected
+        """
+        now = time.time()
+        for counter in self.get_counters(exchange):
+            if Saturation.is_saturated(counter, exchange.redis_queue, now):
+                break
+        else:
+            return True
+        self.rejected += 1
+        if self.priority is not None:
+            exchange.set_input_priority(self.priority)
+            return True
+        exchange.set_status_code(self.status_code)
+        if self.retry_after is not None:
+            exchange.set_output_header(("Retry-After",
+                                        str(self.retry_after)))
+        return False
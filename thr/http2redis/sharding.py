@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of thr library released under the MIT license.
+# See the LICENSE file for more information.
+
+import hashlib
+from bisect import bisect_right
+
+from thr.http2redis.keys import make_key_func
+
+
+def hash_point(value):
+    if not isinstance(value, bytes):
+        value = u"%s" % value
+        value = value.encode('utf-8')
+    return int(hashlib.md5(value).hexdigest()[:16], 16)
+
+
+class ConsistentHashQueues(object):
+    """
+    Map a request key on a list of redis queues with a consistent-hash ring
+
+    Instances are callables to use as ``set_redis_queue`` action value.
+    The ring (with ``vnodes`` virtual nodes per queue) is computed once at
+    config load, so a lookup is a bisect. Adding a queue to the list moves
+    only about 1/N of the keys.
+
+    Args:
+        queues: a list of redis queue names
+        key: a key callable or name (see
+            :func:`~thr.http2redis.keys.make_key_func`), requests with
+            a None key keep their redis queue
+
+    Keyword Args:
+        vnodes: number of virtual nodes per queue
+
+    Examples:
+        >>> add_rule(Criteria(path=glob("/api/*")),
+                     Actions(set_redis_queue=ConsistentHashQueues(
+                         ["thr:queue:api1", "thr:queue:api2"],
+                         key="header:X-User-Id")))
+    """
+
+    def __init__(self, queues, key, vnodes=100):
+        if len(queues) == 0:
+            raise Exception("you must provide at least one queue")
+        points = []
+        for queue in queues:
+            for i in range(0, vnodes):
+                points.append((hash_point("%s#%i" % (queue, i)), queue))
+        points.sort()
+        self.points = [x[0] for x in points]
+        self.queues = [x[1] for x in points]
+        self.key_func = make_key_func(key)
+
+    def get_queue(self, key):
+        """
+        Returns:
+            the redis queue name for the given key
+        """
+        index = bisect_right(self.points, hash_point(key))
+        if index == len(self.points):
+            index = 0
+        return self.queues[index]
+
+    def __call__(self, exchange):
+        key = self.key_func(exchange)
+        if key is None:
+            return None
+        return self.get_queue(key)
@@ -15,23 +15,46 @@ import toro
 import six
 import logging
 import signal
+import socket
 import os
 from datetime import timedelta, datetime
 
-from thr.redis2http.limits import Limits
+from thr.redis2http.limits import Limits, set_limit_overrides
 from thr.redis2http.exchange import HTTPRequestExchange
+from thr.redis2http.blocked import IndexedPriorityQueue, DeadlineHeap
 from thr.redis2http.queue import Queues
-from thr.redis2http.counter import decr_counters
+from thr.redis2http.counter import decr_conditions
 from thr.redis2http.counter import get_counter, get_counter_blocks
 from thr.redis2http.counter import get_global_counter_name
 from thr.redis2http.counter import conditional_incr_counters
+from thr.redis2http.counter import get_blocking_counters
+from thr.redis2http.counter import get_effective_limit, set_limit_provider
+from thr.redis2http.counter import get_used_counters
+from thr.redis2http.counter import get_dynamic_counters_number
+from thr.redis2http.counter import get_overflow_counter
+from thr.redis2http.counter import get_counters_version
+from thr.redis2http.counter import set_max_dynamic_counters
+from thr.redis2http.counter import set_overflow_limit, bound_conditions
+from thr.redis2http.lease import Leases, LEASE_SCRIPT, get_lease_key
+from thr.redis2http.lease import is_distributed, is_leased, leased_limit
+from thr.redis2http.supervisor import BudgetChannel, fork_workers, supervise
+from thr.redis2http.supervisor import get_worker_stats_file
 from thr.utils import serialize_http_response, timedelta_total_ms
 from thr.utils import UnixResolver, format_future_exception
+from thr.utils import parse_redis_address
+from thr.utils import get_consumers_key, Histogram
+from thr.utils import get_available_consumers_key
+from thr.utils import get_processing_key, get_processing_consumers_key
+from thr.utils import get_saturation_field
 from thr import DEFAULT_TIMEOUT
 from thr import DEFAULT_MAXIMUM_LIFETIME, BRPOP_TIMEOUT
 from thr import DEFAULT_MAXIMUM_LOCAL_QUEUE_LIFETIME_MS
 from thr import DEFAULT_BLOCKED_QUEUE_MAX_SIZE
 from thr import REDIS_POOL_CLIENT_TIMEOUT
+from thr import SATURATION_KEY, BATCH_SIZE_BUCKETS, LATENCY_BUCKETS_MS
+from thr import REINJECT_BATCH_MAX_SIZE
+from thr import BLOCKING_COUNTERS_LIFETIME
+from thr import BLOCKED_DEADLINES_COMPACT_MIN_SIZE
 
 try:
     define("config", help="Path to config file")
@@ -40,6 +63,15 @@ try:
 except:
     # already defined (probably because we are launching unit tests)
     pass
+try:
+    define("stats_file", type=str,
+           help="Complete path of the json stat file",
+           default="/tmp/redis2http_stats.json")
+    define("stats_frequency_ms", type=int, help="Stats file write frequency "
+           "(in ms) (0 => no stats write)", default=2000)
+except:
+    # already defined (probably because we are launching unit tests)
+    pass
 define("max_lifetime", help="Maximum lifetime (in second) for a request on "
        "buses/queues", type=int, default=DEFAULT_MAXIMUM_LIFETIME)
 define("blocked_queue_max_size", help="Blocked queue (in process) max size",
@@ -47,19 +79,73 @@ define("blocked_queue_max_size", help="Blocked queue (in process) max size",
 define("max_local_queue_lifetime_ms", help="Maximum lifetime (in ms) for a "
        "request on local queue before reuploading on bus (min precision "
        "100ms)", type=int, default=DEFAULT_MAXIMUM_LOCAL_QUEUE_LIFETIME_MS)
-define("stats_file", type=str, help="Complete path of the json stat file",
-       default="/tmp/redis2http_stats.json")
-define("stats_frequency_ms", type=int, help="Stats file write frequency "
-       "(in ms) (0 => no stats write)", default=2000)
 define("add_thr_extra_headers", type=bool, default=False,
        help="Add X-Thr-* extra headers")
+define("pop_batch_size", type=int, default=10,
+       help="Maximum number of requests popped from the bus in one round "
+       "trip (reduced to the available headroom of the static limits)")
+define("pause_consumption", type=bool, default=True,
+       help="Stop popping requests from a queue while all the counters "
+       "which recently blocked its requests are saturated (limit reached "
+       "and full blocked queue)")
+define("autoscale_frequency_ms", type=int, default=1000,
+       help="Check frequency (in ms) of the number of workers for queues "
+       "with max_workers")
+define("saturation_publish_ms", type=int, default=1000,
+       help="Publish frequency (in ms) of the saturated counters (limit "
+       "reached and full blocked queue) (0 => no publication)")
+define("heartbeat_ttl", type=int, default=10,
+       help="Lifetime (in seconds) of the liveness heartbeat published for "
+       "each consumed queue (refreshed every ttl/3) (0 => no heartbeat)")
+define("max_dynamic_counters", type=int, default=0,
+       help="Maximum number of dynamic counters (limits by hash value) in "
+       "use, the new values share an overflow counter by limit "
+       "(name==__overflow__) when it is reached (0 => no maximum)")
+define("overflow_limit", type=int, default=0,
+       help="Limit of the overflow counters shared by the new values when "
+       "max_dynamic_counters is reached (0 => the limit of a value "
+       "multiplied by max_dynamic_counters)")
+define("processes", type=int, default=1,
+       help="Number of worker processes (> 1 => a supervisor process forks "
+       "the workers and partitions the limits between them)")
+define("lease_redis", type=str, default="localhost:6379",
+       help="Redis server (host:port or unix socket path) of the slot "
+       "leases of the distributed limits")
+define("lease_ttl_ms", type=int, default=5000,
+       help="Lifetime (in ms) of the slots leased for the distributed "
+       "limits (slots of a crashed process are released after this delay)")
+define("lease_sync_ms", type=int, default=200,
+       help="Renewal frequency (in ms) of the slots leased for the "
+       "distributed limits (and for all limits in multi-process mode)")
+define("limit_overrides_file", type=str, default=None,
+       help="JSON file ({limit name: {hash value: limit}}) overriding the "
+       "limits of some values of the limits by hash value (reloaded when "
+       "modified)")
+define("limit_overrides_check_ms", type=int, default=1000,
+       help="Check frequency (in ms) of the modification of the "
+       "limit_overrides_file")
 
 redis_pools = {}
 running_request_redis_handler_number = 0
 running_bus_reinject_handler_number = 0
+running_heartbeat_handler_number = 0
 total_request_counter = 0
 expired_request_counter = 0
 bus_reinject_counter = 0
+mirrored_request_counter = 0
+recovered_request_counter = 0
+pop_batch_sizes = Histogram(BATCH_SIZE_BUCKETS)
+reinject_batch_sizes = Histogram(BATCH_SIZE_BUCKETS)
+reinject_latency = Histogram(LATENCY_BUCKETS_MS)
+consumption_pause_counter = 0
+capacity_condition = None
+lease_condition = None
+# leased counters without lease which blocked a request
+lease_requests = set()
+# sha1 of the lease script loaded on the lease redis (None => not loaded)
+lease_script_sha = None
+consumer_id = "%s:%i" % (socket.gethostname(), os.getpid())
+mirrored_status_counters = {}
 
 # stopping mode
 # (0 => not stopping, 1 => stopping request_redis_handler,
@@ -72,29 +158,78 @@ bus_reinject_queues = {}
 running_exchanges = {}
 blocked_exchanges = {}
 blocked_queues = {}
+blocked_deadlines = DeadlineHeap()
 
 logger = logging.getLogger("thr.redis2http")
 
 async_client_impl = "tornado.simple_httpclient.SimpleAsyncHTTPClient"
-resolver = UnixResolver(resolver=tornado.netutil.Resolver())
-tornado.httpclient.AsyncHTTPClient.configure(async_client_impl,
-                                             max_clients=100000,
-                                             resolver=resolver)
+resolver = None
+budget_channel = None
+
+
+def init_http_client():
+    global resolver
+    resolver = UnixResolver(resolver=tornado.netutil.Resolver())
+    tornado.httpclient.AsyncHTTPClient.configure(async_client_impl,
+                                                 max_clients=100000,
+                                                 resolver=resolver)
+
+
+init_http_client()
+
+
+def init_worker(worker, sock):
+    """
+    Initializes a (forked) worker process
+    """
+    global consumer_id, budget_channel
+    # the ioloop (and the resolver bound to it) of the supervisor can't be
+    # shared
+    tornado.ioloop.IOLoop.instance().close()
+    tornado.ioloop.IOLoop.clear_instance()
+    tornado.ioloop.IOLoop.clear_current()
+    init_http_client()
+    consumer_id = "%s:%i" % (socket.gethostname(), os.getpid())
+    options.stats_file = get_worker_stats_file(options.stats_file, worker)
+    Leases.partitioned = True
+    budget_channel = BudgetChannel(sock)
 
 
 def blocked_queue_put_nowait(counter_name, priority, exchange):
     global blocked_queues
     if counter_name not in blocked_queues:
         blocked_queues[counter_name] = \
-            toro.PriorityQueue(options.blocked_queue_max_size)
-    blocked_queues[counter_name].put_nowait((priority, exchange))
+            IndexedPriorityQueue(options.blocked_queue_max_size)
+    blocked_queues[counter_name].put_nowait(exchange.request_id, priority,
+                                            exchange)
 
 
 def blocked_queue_get_nowait(counter_name):
     global blocked_queues
     if counter_name not in blocked_queues:
         raise _queue.Empty()
-    return blocked_queues[counter_name].get_nowait()
+    queue = blocked_queues[counter_name]
+    result = queue.get_nowait()
+    if queue.qsize() == 0:
+        # to avoid some memory leaks (dynamic counters)
+        del(blocked_queues[counter_name])
+    return result
+
+
+def blocked_queue_peek_nowait(counter_name):
+    if counter_name not in blocked_queues:
+        raise _queue.Empty()
+    return blocked_queues[counter_name].peek_nowait()
+
+
+def blocked_queue_remove(counter_name, request_id):
+    if counter_name not in blocked_queues:
+        return None
+    queue = blocked_queues[counter_name]
+    result = queue.remove(request_id)
+    if queue.qsize() == 0:
+        del(blocked_queues[counter_name])
+    return result
 
 
 def get_blocked_queue_size(counter_name):
@@ -169,38 +304,507 @@ def format_redis_server(host=None, port=None, unix_domain_socket=None,
         return "redis://%s:%i%s" % (h, p, qs_string)
 
 
+def get_pop_batch_size(queue, redis_queue):
+    """
+    Returns the number of requests to pop in one round trip from a redis
+    queue of the queue (limited by the headroom of the limits applied to
+    the redis queue and of the counters which recently blocked requests of
+    the queue, so we don't pop requests which would be blocked locally)
+
+    The result is cached until a counter or an effective limit changes.
+    """
+    version = get_counters_version()
+    cached = queue.pop_batch_sizes.get(redis_queue, None)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    size = options.pop_batch_size
+    for index in Limits.get_indexes(redis_queue):
+        for name, limit in index.get_static_limits():
+            size = min(size, get_effective_limit(name, limit.limit) -
+                       get_counter(name))
+        for name, limit in index.dynamic:
+            # (the popped requests may share the same hash value)
+            size = min(size, limit.limit)
+    for counter in get_queue_blocking_counters(queue):
+        limit = Limits.get_limit(counter)
+        if limit is not None:
+            size = min(size, get_effective_limit(counter, limit) -
+                       get_counter(counter))
+    size = max(1, size)
+    queue.pop_batch_sizes[redis_queue] = (version, size)
+    return size
+
+
 @tornado.gen.coroutine
 def request_redis_handler(queue, single_iteration=False):
-    global expired_request_counter
+    global expired_request_counter, consumption_pause_counter
     redis = get_redis_client(queue.host, queue.port, queue.unix_domain_socket)
     brpop_args = queue.queues + [BRPOP_TIMEOUT]
+    zset = (queue.queue_type == "zset")
+    pop_command = 'BZPOPMIN' if zset else 'BRPOP'
+    processing_key = None
+    if queue.reliable:
+        # popped requests are moved in a processing list (by consumer)
+        # until their response is pushed
+        processing_key = get_processing_key(queue.queues[0], consumer_id)
+        brpop_args = [queue.queues[0], processing_key, BRPOP_TIMEOUT]
+        pop_command = 'BRPOPLPUSH'
+        yield redis.call('SADD',
+                         get_processing_consumers_key(queue.queues[0]),
+                         consumer_id)
     while stopping < 1:
-        tmp = yield redis.call('BRPOP', *brpop_args)
+        if queue.should_stop_worker():
+            # scale down
+            break
+        if options.pause_consumption and is_queue_saturated(queue):
+            # let's wait for some free capacity (or 1s) before popping
+            consumption_pause_counter += 1
+            try:
+                yield get_capacity_condition().wait(
+                    deadline=timedelta(seconds=1))
+            except toro.Timeout:
+                pass
+            if single_iteration:
+                break
+            continue
+        tmp = yield redis.call(pop_command, *brpop_args)
         if isinstance(tmp, tornadis.ConnectionError):
             logger.warning("connection error while brpoping queues %s "
                            "=> sleeping 5s and retrying",
                            format_redis_server(queue=queue))
             yield tornado.gen.sleep(5)
             continue
+        if tmp and processing_key is not None:
+            # (BRPOPLPUSH returns only the request)
+            tmp = [queue.queues[0], tmp]
         if tmp:
-            redis_queue, request = tmp
-            exchange = HTTPRequestExchange(request, queue, redis_queue)
-            launch_exchange_or_queue_it(exchange)
+            # (BZPOPMIN returns also the score)
+            redis_queue, request = tmp[0], tmp[1]
+            requests = [request]
+            if not isinstance(redis_queue, str):
+                redis_queue = redis_queue.decode('utf-8')
+            batch_size = get_pop_batch_size(queue, redis_queue)
+            if batch_size > 1:
+                # the queue is not empty => let's pop some more requests
+                # in the same round trip
+                if zset:
+                    result = yield redis.call('ZPOPMIN', redis_queue,
+                                              batch_size - 1)
+                    if isinstance(result, list):
+                        # members and scores
+                        result = result[0::2]
+                else:
+                    pipeline = tornadis.Pipeline()
+                    for i in range(0, batch_size - 1):
+                        if processing_key is None:
+                            pipeline.stack_call('RPOP', redis_queue)
+                        else:
+                            pipeline.stack_call('RPOPLPUSH', redis_queue,
+                                                processing_key)
+                    result = yield redis.call(pipeline)
+                if isinstance(result, list):
+                    requests.extend([x for x in result
+                                     if isinstance(x, six.binary_type)])
+            pop_batch_sizes.observe(len(requests))
+            now = time.time()
+            for request in requests:
+                exchange = HTTPRequestExchange(request, queue, redis_queue)
+                exchange.processing_key = processing_key
+                res = launch_exchange_or_queue_it(exchange)
+                if res is not None and res is not True:
+                    for counter in res:
+                        queue.blocking_counters[counter] = now
         if single_iteration:
             break
     logger.info("request_redis_handler %s stopped",
                 format_redis_server(queue=queue))
+    redis.disconnect()
+
+
+def launch_request_redis_handler(queue):
+    global running_request_redis_handler_number
+    queue.running_workers += 1
+    running_request_redis_handler_number += 1
+    callback = functools.partial(request_redis_handler_callback, queue)
+    tornado.ioloop.IOLoop.instance().add_future(request_redis_handler(queue),
+                                                callback)
+
+
+def request_redis_handler_callback(queue, future):
+    global running_request_redis_handler_number
+    queue.running_workers -= 1
+    if stopping == 0 and future.exception() is None:
+        # stopped by a scale down
+        running_request_redis_handler_number -= 1
+    else:
+        stop_loop(future)
+
+
+def get_workers_delta(queue, backlog):
+    """
+    Returns the number of workers to add (1), to stop (-1) or 0
+
+    Args:
+        queue: a :class:`~thr.redis2http.queue.Queue` object
+        backlog: number of requests waiting in the redis queues
+    """
+    running = queue.running_workers - queue.workers_to_stop
+    if is_queue_limited(queue):
+        # limits are the bottleneck of this queue (more workers would only
+        # pop requests to block them locally)
+        return -1 if running > queue.workers else 0
+    if backlog > 0:
+        return 1 if running < queue.max_workers else 0
+    return -1 if running > queue.workers else 0
+
+
+@tornado.gen.coroutine
+def autoscale_handler(single_iteration=False):
+    while stopping < 1:
+        for queue in Queues:
+            if not queue.autoscaled:
+                continue
+            redis_pool = get_redis_pool(queue.host, queue.port,
+                                        queue.unix_domain_socket)
+            command = 'ZCARD' if queue.queue_type == "zset" else 'LLEN'
+            pipeline = tornadis.Pipeline()
+            for redis_queue in queue.queues:
+                pipeline.stack_call(command, redis_queue)
+            with (yield redis_pool.connected_client()) as redis:
+                result = yield redis.call(pipeline)
+            if not isinstance(result, list):
+                continue
+            delta = get_workers_delta(queue, sum(result))
+            if delta > 0:
+                logger.debug("scale up %s", format_redis_server(queue=queue))
+                launch_request_redis_handler(queue)
+            elif delta < 0:
+                logger.debug("scale down %s",
+                             format_redis_server(queue=queue))
+                queue.workers_to_stop += 1
+        if single_iteration:
+            break
+        yield tornado.gen.sleep(options.autoscale_frequency_ms / 1000.0)
+
+
+@tornado.gen.coroutine
+def heartbeat_handler(queue, single_iteration=False):
+    """
+    Publishes (periodically) the liveness of this consumer for the given
+    queues: a sorted set by queue (consumer id => expiration timestamp)
+
+    The consumer is also published in a second sorted set by queue while
+    it has spare capacity for the queue (see :func:`is_queue_saturated`),
+    so http2redis can prefer a fallback queue.
+
+    The consumer stays alive until its running requests are done (stopping
+    mode 4), then it is unregistered.
+    """
+    redis = get_redis_client(queue.host, queue.port, queue.unix_domain_socket)
+    ttl = options.heartbeat_ttl
+    while stopping < 4:
+        now = time.time()
+        saturated = is_queue_saturated(queue)
+        pipeline = tornadis.Pipeline()
+        for redis_queue in queue.queues:
+            key = get_consumers_key(redis_queue)
+            available_key = get_available_consumers_key(redis_queue)
+            pipeline.stack_call('ZADD', key, "%.3f" % (now + ttl),
+                                consumer_id)
+            if saturated:
+                pipeline.stack_call('ZREM', available_key, consumer_id)
+            else:
+                pipeline.stack_call('ZADD', available_key,
+                                    "%.3f" % (now + ttl), consumer_id)
+            for tmp in (key, available_key):
+                pipeline.stack_call('ZREMRANGEBYSCORE', tmp, '-inf',
+                                    "%.3f" % now)
+                pipeline.stack_call('EXPIRE', tmp, ttl)
+        result = yield redis.call(pipeline)
+        if isinstance(result, tornadis.ConnectionError):
+            logger.warning("can't publish heartbeat on %s",
+                           format_redis_server(queue=queue))
+        if single_iteration:
+            break
+        # (sleep by small steps so the stopping mode is seen quickly)
+        while stopping < 4 and time.time() < now + ttl / 3.0:
+            yield tornado.gen.sleep(0.1)
+    if not single_iteration:
+        pipeline = tornadis.Pipeline()
+        for redis_queue in queue.queues:
+            pipeline.stack_call('ZREM', get_consumers_key(redis_queue),
+                                consumer_id)
+            pipeline.stack_call('ZREM',
+                                get_available_consumers_key(redis_queue),
+                                consumer_id)
+        yield redis.call(pipeline)
+    redis.disconnect()
+
+
+def heartbeat_handler_callback(future):
+    global running_heartbeat_handler_number
+    running_heartbeat_handler_number -= 1
+    exception = future.exception()
+    if exception is not None:
+        logging.exception(format_future_exception(future))
+    stop_ioloop_if_done()
+
+
+def is_counter_saturated(counter):
+    """
+    Returns True if the limit of the counter is reached and if its blocked
+    queue is full
+    """
+    if get_blocked_queue_size(counter) < options.blocked_queue_max_size:
+        return False
+    limit = Limits.get_limit(counter)
+    return limit is not None and \
+        get_effective_limit(counter, limit) <= get_counter(counter)
+
+
+def get_saturated_counters():
+    """
+    Returns the list of saturated counters (the limit is reached and the
+    blocked queue is full)
+    """
+    return [x for x in list(blocked_queues.keys())
+            if is_counter_saturated(x)]
+
+
+def get_queue_blocking_counters(queue):
+    """
+    Returns the counters which recently blocked requests of the queue (the
+    old ones are forgotten)
+    """
+    counters = queue.blocking_counters
+    if len(counters) == 0:
+        return []
+    now = time.time()
+    for counter, last_block in list(counters.items()):
+        if now - last_block > BLOCKING_COUNTERS_LIFETIME:
+            del(counters[counter])
+    return list(counters.keys())
+
+
+def is_queue_saturated(queue):
+    """
+    Returns True if all the counters which recently blocked requests of
+    the queue are saturated (so popping a request from the queue would
+    probably end with a reinjection on the bus)
+    """
+    counters = get_queue_blocking_counters(queue)
+    return len(counters) > 0 and \
+        all([is_counter_saturated(x) for x in counters])
+
+
+def is_queue_limited(queue):
+    """
+    Returns True if one of the counters which recently blocked requests of
+    the queue still blocks requests or has no headroom (so popping more
+    requests from the queue would only block them locally)
+    """
+    for counter in get_queue_blocking_counters(queue):
+        if get_blocked_queue_size(counter) > 0:
+            return True
+        limit = Limits.get_limit(counter)
+        if limit is not None and \
+                get_effective_limit(counter, limit) <= get_counter(counter):
+            return True
+    return False
+
+
+def get_capacity_condition():
+    global capacity_condition
+    if capacity_condition is None:
+        capacity_condition = toro.Condition()
+    return capacity_condition
+
+
+@tornado.gen.coroutine
+def saturation_handler(host=None, port=None, unix_domain_socket=None,
+                       single_iteration=False):
+    """
+    Publishes (periodically) the saturated counters in a redis hash
+    (counter name|consumer id => expiration timestamp)
+    """
+    redis = get_redis_client(host=host, port=port,
+                             unix_domain_socket=unix_domain_socket)
+    frequency = options.saturation_publish_ms / 1000.0
+    published = set()
+    while stopping < 1:
+        saturated = set(get_saturated_counters())
+        expiration = time.time() + 3 * frequency
+        pipeline = tornadis.Pipeline()
+        for counter in saturated:
+            pipeline.stack_call('HSET', SATURATION_KEY,
+                                get_saturation_field(counter, consumer_id),
+                                "%.3f" % expiration)
+        for counter in published - saturated:
+            pipeline.stack_call('HDEL', SATURATION_KEY,
+                                get_saturation_field(counter, consumer_id))
+        if pipeline.number_of_stacked_calls > 0:
+            result = yield redis.call(pipeline)
+            if isinstance(result, tornadis.ConnectionError):
+                logger.warning("can't publish saturated counters on %s",
+                               format_redis_server(host, port,
+                                                   unix_domain_socket))
+            else:
+                published = saturated
+        if single_iteration:
+            break
+        yield tornado.gen.sleep(frequency)
+    redis.disconnect()
+
+
+def get_lease_condition():
+    global lease_condition
+    if lease_condition is None:
+        lease_condition = toro.Condition()
+    return lease_condition
+
+
+def request_leases(counters):
+    """
+    Wakes up the lease handler at once for the leased counters which have
+    never been leased (so the first request of an idle counter doesn't
+    wait for the next renewal)
+    """
+    new = [x for x in counters if is_leased(x) and
+           x not in Leases.leases and x not in lease_requests]
+    if len(new) > 0:
+        lease_requests.update(new)
+        get_lease_condition().notify_all()
+
+
+@tornado.gen.coroutine
+def call_lease_script(redis, calls):
+    """
+    Runs the lease script (with EVALSHA, the script is loaded again after
+    a NOSCRIPT error) for each (key, args) tuple of calls in one round trip
+
+    Returns:
+        the list of results (None if the lease redis can't be reached)
+    """
+    global lease_script_sha
+    for attempt in range(0, 2):
+        if lease_script_sha is None:
+            sha = yield redis.call('SCRIPT', 'LOAD', LEASE_SCRIPT)
+            if not isinstance(sha, (six.binary_type, six.text_type)):
+                raise tornado.gen.Return(None)
+            if not isinstance(sha, str):
+                sha = sha.decode('utf-8')
+            lease_script_sha = sha
+        pipeline = tornadis.Pipeline()
+        for key, args in calls:
+            pipeline.stack_call('EVALSHA', lease_script_sha, 1, key, *args)
+        result = yield redis.call(pipeline)
+        if not isinstance(result, list):
+            raise tornado.gen.Return(None)
+        if any([isinstance(x, tornadis.ClientError) and
+                "NOSCRIPT" in str(x) for x in result]):
+            # (the lease redis has been restarted or flushed)
+            lease_script_sha = None
+            continue
+        raise tornado.gen.Return(result)
+    raise tornado.gen.Return(None)
+
+
+@tornado.gen.coroutine
+def lease_handler(single_iteration=False):
+    """
+    Leases (periodically) the slots needed by this process (running +
+    blocked requests + 1 spare slot) and releases the unused ones
+
+    The slots of the distributed limits are leased in redis, the slots of
+    the other limits are asked to the supervisor (multi-process mode). The
+    handler is woken up before the next renewal when a counter without
+    lease blocks a request (see :func:`request_leases`).
+    """
+    host, port, uds = parse_redis_address(options.lease_redis)
+    redis = get_redis_client(host, port, uds)
+    ttl_ms = options.lease_ttl_ms
+    while stopping < 4:
+        now = time.time()
+        counters = set(Leases.counters())
+        counters.update([x for x, q in blocked_queues.items()
+                         if q.qsize() > 0 and is_leased(x)])
+        counters.update([x for x in get_used_counters() if is_leased(x)])
+        requested = set(lease_requests)
+        lease_requests.clear()
+        counters.update(requested)
+        distributed = []
+        calls = []
+        demands = {}
+        wanteds = {}
+        for counter in counters:
+            limit = Limits.get_limit(counter)
+            used = get_counter(counter)
+            needed = used + get_blocked_queue_size(counter)
+            if counter in requested:
+                # (the blocked request may wait in another blocked queue)
+                needed = max(needed, 1)
+            wanted = 0 if needed == 0 else min(limit, needed + 1)
+            wanteds[counter] = wanted
+            if is_distributed(counter):
+                distributed.append(counter)
+                calls.append((get_lease_key(counter),
+                              (consumer_id, wanted, limit, int(now * 1000),
+                               ttl_ms, used)))
+            else:
+                demands[counter] = (limit, used, wanted)
+        grants = {}
+        if len(distributed) > 0:
+            result = yield call_lease_script(redis, calls)
+            if not isinstance(result, list) or \
+                    len(result) != len(distributed):
+                logger.warning("can't renew the leases of the distributed "
+                               "limits on %s", options.lease_redis)
+            else:
+                grants.update(zip(distributed, result))
+        if len(demands) > 0 and budget_channel is not None:
+            result = yield budget_channel.request(demands)
+            if result is None:
+                logger.warning("can't renew the leases of the limits "
+                               "(supervisor gone)")
+            else:
+                grants.update([(x, result.get(x, None)) for x in demands])
+        woken_up = False
+        for counter, granted in grants.items():
+            if not isinstance(granted, six.integer_types):
+                continue
+            before = Leases.get(counter)
+            if wanteds[counter] == 0:
+                Leases.remove(counter)
+            else:
+                Leases.update(counter, granted, now + ttl_ms / 1000.0)
+            if granted > before:
+                reinject_blocking_queue(counter)
+                woken_up = True
+        if woken_up and capacity_condition is not None:
+            capacity_condition.notify_all()
+        if single_iteration:
+            break
+        if len(lease_requests) > 0:
+            # (requested during this iteration)
+            continue
+        try:
+            yield get_lease_condition().wait(
+                deadline=timedelta(milliseconds=options.lease_sync_ms))
+        except toro.Timeout:
+            pass
+    redis.disconnect()
 
 
 @tornado.gen.coroutine
 def process_request(exchange, before):
-    global running_exchanges, total_request_counter
+    global running_exchanges, total_request_counter, mirrored_request_counter
     async_client = tornado.httpclient.AsyncHTTPClient()
     request = exchange.request
     request.connect_timeout = options.timeout
     request.request_timeout = options.timeout
     request.decompress_response = False
     request.follow_redirects = False
+    mirror = exchange.extra_dict.get('mirror', False)
     response_key = exchange.extra_dict['response_key']
     queue = exchange.queue
     rid = exchange.request_id
@@ -232,50 +836,134 @@ def process_request(exchange, before):
                 "for (#%s, %s on %s)", response.code,
                 td_ms, exchange.lifetime_in_local_queue_ms() - td_ms,
                 rid, request.method, request.url)
+    if mirror:
+        # mirrored (shadow) request => nobody is waiting for the response
+        mirrored_request_counter += 1
+        mirrored_status_counters[response.code] = \
+            mirrored_status_counters.get(response.code, 0) + 1
+    pipeline = tornadis.Pipeline()
+    if not mirror:
+        pipeline.stack_call("LPUSH", response_key,
+                            serialize_http_response(response))
+        # job_ttl is set for asynchronous jobs (results are kept longer)
+        expire = exchange.extra_dict.get('job_ttl', options.timeout)
+        pipeline.stack_call("EXPIRE", response_key, expire)
+    stack_acknowledge(pipeline, exchange)
+    if pipeline.number_of_stacked_calls == 0:
+        return
     redis_pool = get_redis_pool(queue.host, queue.port,
                                 queue.unix_domain_socket)
-    pipeline = tornadis.Pipeline()
-    pipeline.stack_call("LPUSH", response_key,
-                        serialize_http_response(response))
-    pipeline.stack_call("EXPIRE", response_key, options.timeout)
     with (yield redis_pool.connected_client()) as redis:
         redis_res = yield redis.call(pipeline)
-        if redis_res is None or \
-                isinstance(redis_res, tornadis.ConnectionError) or \
-                len(redis_res) != 2 or \
-                not isinstance(redis_res[0], six.integer_types) or \
-                not isinstance(redis_res[1], six.integer_types):
+        if not isinstance(redis_res, list) or \
+                len(redis_res) != pipeline.number_of_stacked_calls or \
+                not all(isinstance(x, six.integer_types)
+                        for x in redis_res):
             logger.warning("can't send the result on %s for "
                            "request #%s", format_redis_server(queue=queue),
                            rid)
 
 
+def stack_acknowledge(pipeline, exchange):
+    """
+    Stacks (if needed) the removal of the request from its processing list
+    (reliable mode) in the given pipeline
+    """
+    if exchange.processing_key is not None:
+        pipeline.stack_call('LREM', exchange.processing_key, 1,
+                            exchange.serialized_request)
+
+
+@tornado.gen.coroutine
+def acknowledge(exchange):
+    """
+    Removes the request from its processing list (reliable mode) when it
+    won't be processed (trashed or expired requests)
+    """
+    if exchange.processing_key is None:
+        return
+    queue = exchange.queue
+    redis_pool = get_redis_pool(queue.host, queue.port,
+                                queue.unix_domain_socket)
+    pipeline = tornadis.Pipeline()
+    stack_acknowledge(pipeline, exchange)
+    with (yield redis_pool.connected_client()) as redis:
+        result = yield redis.call(pipeline)
+        if isinstance(result, tornadis.ConnectionError):
+            logger.warning("can't acknowledge request #%s on %s",
+                           exchange.request_id,
+                           format_redis_server(queue=queue))
+
+
+@tornado.gen.coroutine
+def janitor_handler(queue, single_iteration=False):
+    """
+    Requeues (periodically) the in-flight requests of the dead consumers
+    (no heartbeat) of a reliable queue
+    """
+    global recovered_request_counter
+    redis_queue = queue.queues[0]
+    consumers_key = get_processing_consumers_key(redis_queue)
+    redis = get_redis_client(queue.host, queue.port, queue.unix_domain_socket)
+    while stopping < 1:
+        now = time.time()
+        consumers = yield redis.call('SMEMBERS', consumers_key)
+        if not isinstance(consumers, list):
+            consumers = []
+        for consumer in consumers:
+            if isinstance(consumer, six.binary_type):
+                consumer = consumer.decode()
+            if consumer == consumer_id:
+                continue
+            expiration = yield redis.call('ZSCORE',
+                                          get_consumers_key(redis_queue),
+                                          consumer)
+            if isinstance(expiration, tornadis.ConnectionError):
+                break
+            if expiration is not None and float(expiration) >= now:
+                continue
+            processing_key = get_processing_key(redis_queue, consumer)
+            while True:
+                # (one by one to be safe if another janitor is running)
+                result = yield redis.call('RPOPLPUSH', processing_key,
+                                          redis_queue)
+                if not isinstance(result, six.binary_type):
+                    break
+                recovered_request_counter += 1
+            if result is None:
+                yield redis.call('SREM', consumers_key, consumer)
+                logger.warning("in-flight requests of dead consumer %s "
+                               "requeued in %s", consumer, redis_queue)
+        if single_iteration:
+            break
+        yield tornado.gen.sleep(options.heartbeat_ttl)
+    redis.disconnect()
+
+
 def reinject_blocking_queue(counter):
-    choosen_counter = counter + "___reinject"
+    """
+    Wakes up the blocked requests waiting for a slot of the given counter
+    (highest priority first) while the counter is not full
+
+    A woken up request still blocked by another counter is moved to the
+    blocked queue of this other counter.
+    """
     while True:
         try:
-            tmp = blocked_queue_get_nowait(counter)
+            exchange = blocked_queue_peek_nowait(counter)[1]
         except _queue.Empty:
             break
-        ex = tmp[1]
-        res = launch_exchange_or_queue_it(ex, choosen_counter=choosen_counter)
-        if res is not None and res is not True:
-            # The request is not accepted because some counters are full
-            if counter in res:
-                # The current counter is full => stopping the reinject process
-                break
-    # Let's reinject jobs into the blocking queue (from the temporary queue)
-    while True:
-        try:
-            tmp = blocked_queue_get_nowait(choosen_counter)
-        except _queue.Empty:
+        if counter in get_blocking_counters(exchange.conditions):
+            # no more free slot
             break
-        blocked_queue_put_nowait(counter, tmp[0], tmp[1])
+        blocked_queue_get_nowait(counter)
+        launch_exchange_or_queue_it(exchange)
 
 
 def queue_for_bus_reinject(host, port, unix_domain_socket, priority, exchange,
                            remove_from_blocked_exchange=True):
     global blocked_exchanges
+    exchange.reinject_time = time.time()
     get_bus_reinject_queue(host, port,
                            unix_domain_socket).put_nowait((priority, exchange))
     rid = exchange.request_id
@@ -284,6 +972,38 @@ def queue_for_bus_reinject(host, port, unix_domain_socket, priority, exchange,
             del(blocked_exchanges[rid])
 
 
+def make_reinject_pipeline(items):
+    """
+    Returns a pipeline which pushes the given (priority, exchange) items
+    back on the bus (one RPUSH or ZADD by redis queue)
+
+    Reinjected requests are the oldest ones so they are pushed on the
+    consuming end of the list queues, the most urgent one at the very end
+    (so it is popped first). Sorted set queues get back the original
+    score. Reinjected requests of reliable queues are removed from their
+    processing list in the same pipeline.
+    """
+    by_queue = {}
+    for priority, exchange in sorted(items, key=lambda x: x[0],
+                                     reverse=True):
+        key = (exchange.redis_queue, exchange.queue.queue_type)
+        if key not in by_queue:
+            by_queue[key] = []
+        if exchange.queue.queue_type == "zset":
+            by_queue[key].append(exchange.bus_score)
+        by_queue[key].append(exchange.serialized_request)
+    pipeline = tornadis.Pipeline()
+    for (redis_queue, queue_type), args in by_queue.items():
+        if queue_type == "zset":
+            pipeline.stack_call('ZADD', redis_queue, *args)
+        else:
+            pipeline.stack_call('RPUSH', redis_queue, *args)
+    for priority, exchange in items:
+        # reliable mode: they are back on the bus
+        stack_acknowledge(pipeline, exchange)
+    return pipeline
+
+
 @tornado.gen.coroutine
 def bus_reinject_handler(host=None, port=None, unix_domain_socket=None,
                          single_iteration=False):
@@ -296,53 +1016,107 @@ def bus_reinject_handler(host=None, port=None, unix_domain_socket=None,
         if stopping >= 4 and queue.qsize() == 0:
             break
         try:
-            priority, exchange = yield queue.get(deadline=deadline)
+            items = [(yield queue.get(deadline=deadline))]
         except toro.Timeout:
             continue
-        rid = exchange.request_id
-        logger.debug("reinject request #%s on %s", rid,
-                     format_redis_server(host, port, unix_domain_socket,
-                                         queues=[exchange.redis_queue]))
-        result = yield redis.call('LPUSH', exchange.redis_queue,
-                                  exchange.serialized_request)
-        if not isinstance(result, six.integer_types):
-            redis_string = format_redis_server(host, port,
-                                               unix_domain_socket,
-                                               queues=[exchange.redis_queue])
+        # let's drain the queue to push everything in one round trip
+        while len(items) < REINJECT_BATCH_MAX_SIZE:
+            try:
+                items.append(queue.get_nowait())
+            except _queue.Empty:
+                break
+        redis_string = format_redis_server(host, port, unix_domain_socket)
+        logger.debug("reinject %i request(s) on %s", len(items),
+                     redis_string)
+        result = yield redis.call(make_reinject_pipeline(items))
+        if not isinstance(result, list) or \
+                not all([isinstance(x, six.integer_types) for x in result]):
             if stopping >= 4:
-                logger.warning("can't reinject request #%s on "
+                logger.warning("can't reinject %i request(s) on "
                                "%s but we are stopping "
-                               "=> loosing requests", rid, redis_string)
+                               "=> loosing requests", len(items),
+                               redis_string)
                 break
-            logger.warning("can't reinject request #%s on %s "
-                           "=> sleeping 5s and re-queueing the request",
-                           rid, redis_string)
+            logger.warning("can't reinject %i request(s) on %s "
+                           "=> sleeping 5s and re-queueing the requests",
+                           len(items), redis_string)
             yield tornado.gen.sleep(5)
-            queue.put_nowait((priority, exchange))
+            for item in items:
+                queue.put_nowait(item)
         else:
-            bus_reinject_counter += 1
+            bus_reinject_counter += len(items)
+            reinject_batch_sizes.observe(len(items))
+            now = time.time()
+            for priority, exchange in items:
+                if exchange.reinject_time is not None:
+                    reinject_latency.observe(
+                        (now - exchange.reinject_time) * 1000)
         if single_iteration:
             break
     logger.info("bus_reinject_handler %s stopped",
                 format_redis_server(host, port, unix_domain_socket))
 
 
+def get_blocked_deadline(exchange):
+    """
+    Returns the timestamp when a blocked request has to be trashed
+    (max_lifetime) or reuploaded (max_local_queue_lifetime_ms)
+    """
+    now = time.time()
+    # (lifetime is an integer number of seconds)
+    expiration = now + options.max_lifetime + 1 - exchange.lifetime()
+    reupload = exchange.local_queue_time + \
+        options.max_local_queue_lifetime_ms / 1000.0
+    return min(expiration, reupload)
+
+
+def push_blocked_deadline(exchange):
+    """
+    Pushes the deadline of a blocked request in the blocked_deadlines heap
+    (the previous entries of the request become stale)
+    """
+    exchange.blocked_deadline = get_blocked_deadline(exchange)
+    blocked_deadlines.push(exchange.blocked_deadline, exchange.request_id)
+
+
+def is_blocked_deadline_valid(deadline, rid):
+    if rid not in blocked_exchanges:
+        # no more blocked
+        return False
+    # (a later deadline has been pushed since)
+    return blocked_exchanges[rid][1].blocked_deadline <= deadline
+
+
+def compact_blocked_deadlines():
+    """
+    Purges the stale entries of the blocked_deadlines heap when they are
+    much more numerous than the blocked requests
+    """
+    size = len(blocked_deadlines)
+    if size > max(BLOCKED_DEADLINES_COMPACT_MIN_SIZE,
+                  4 * len(blocked_exchanges)):
+        blocked_deadlines.compact(is_blocked_deadline_valid)
+        logger.debug("blocked deadlines compacted: %i => %i entries",
+                     size, len(blocked_deadlines))
+
+
 @tornado.gen.coroutine
 def expiration_handler(single_iteration=False):
     global blocked_exchanges, expired_request_counter
     while stopping < 2:
-        to_trash = []
-        queues_to_find = set()
-        for rid, tmp in blocked_exchanges.items():
-            counter, exchange = tmp
+        for deadline, rid in blocked_deadlines.pop_expired(time.time()):
+            if not is_blocked_deadline_valid(deadline, rid):
+                # lazy invalidation
+                continue
+            counter, exchange = blocked_exchanges[rid]
             lifetime = exchange.lifetime()
             local_queue_ms = exchange.lifetime_in_local_queue_ms()
             if lifetime > options.max_lifetime:
                 logger.warning("expired request #%s (lifetime: %i) blocked "
                                "=> trash it", rid, lifetime)
                 expired_request_counter += 1
-                to_trash.append(rid)
-                queues_to_find.add(counter)
+                tornado.ioloop.IOLoop.instance().spawn_callback(acknowledge,
+                                                                exchange)
             elif local_queue_ms > options.max_local_queue_lifetime_ms:
                 host = exchange.queue.host
                 port = exchange.queue.port
@@ -354,26 +1128,96 @@ def expiration_handler(single_iteration=False):
                             format_redis_server(host, port, uds))
                 queue_for_bus_reinject(host, port, uds, priority, exchange,
                                        remove_from_blocked_exchange=False)
-                to_trash.append(rid)
-                queues_to_find.add(counter)
-        for counter in queues_to_find:
-            to_reinject = []
-            while True:
-                try:
-                    tmp = blocked_queue_get_nowait(counter)
-                except _queue.Empty:
-                    break
-                if tmp[1].request_id not in to_trash:
-                    to_reinject.append(tmp)
-            for tmp in to_reinject:
-                blocked_queue_put_nowait(counter, tmp[0], tmp[1])
-        for trashed_rid in to_trash:
-            del(blocked_exchanges[trashed_rid])
+            else:
+                # not expired yet (rounding of the lifetime)
+                push_blocked_deadline(exchange)
+                continue
+            blocked_queue_remove(counter, rid)
+            del(blocked_exchanges[rid])
+        compact_blocked_deadlines()
+        if single_iteration:
+            break
         yield tornado.gen.sleep(0.1)
     logger.info("expiration_handler stopped")
 
 
-def launch_exchange_or_queue_it(exchange, choosen_counter=None):
+def update_limit_overrides(name, overrides):
+    """
+    Replaces (at runtime) the overridden values of a limit by hash value,
+    updates the conditions of the blocked requests and wakes up the ones
+    which can run with the new limits
+    """
+    set_limit_overrides(name, overrides)
+    counters = set()
+    for counter, exchange in list(blocked_exchanges.values()):
+        conditions = []
+        for condition in exchange.conditions:
+            if condition[2] is not None and condition[3] == name:
+                condition = (condition[0], Limits.get_limit(condition[0]),
+                             condition[2], condition[3])
+            conditions.append(condition)
+        if conditions != exchange.conditions:
+            exchange.conditions = conditions
+            counters.add(counter)
+    for counter in counters:
+        reinject_blocking_queue(counter)
+    if len(counters) > 0 and capacity_condition is not None:
+        capacity_condition.notify_all()
+
+
+def load_limit_overrides(path):
+    """
+    Applies the overridden limits of a JSON file (the overrides of the
+    configuration file are restored for the values which are not in the
+    file anymore)
+    """
+    try:
+        with open(path) as f:
+            content = json.loads(f.read())
+        if not isinstance(content, dict) or \
+                not all([isinstance(x, dict) for x in content.values()]):
+            raise ValueError("not a {limit name: {hash value: limit}} dict")
+        for overrides in content.values():
+            for value in overrides.values():
+                if not isinstance(value, six.integer_types):
+                    raise ValueError("invalid limit: %r" % value)
+    except (IOError, OSError, ValueError) as e:
+        logger.warning("can't load the limit overrides of %s: %s", path, e)
+        return
+    for name in content:
+        if name not in Limits.limits:
+            logger.warning("unknown limit %s in %s", name, path)
+    for name, limit in six.iteritems(Limits.limits):
+        if limit.hash_value != limit.hash_func:
+            continue
+        overrides = dict(limit.initial_overrides)
+        overrides.update(content.get(name, {}))
+        if overrides != limit.overrides:
+            logger.info("new overrides for limit %s: %s", name, overrides)
+            update_limit_overrides(name, overrides)
+
+
+@tornado.gen.coroutine
+def limit_overrides_handler(single_iteration=False):
+    """
+    Reloads the limit_overrides_file when it is modified
+    """
+    path = options.limit_overrides_file
+    mtime = None
+    while stopping < 1:
+        try:
+            new_mtime = os.stat(path).st_mtime
+        except OSError:
+            new_mtime = None
+        if new_mtime is not None and new_mtime != mtime:
+            load_limit_overrides(path)
+        mtime = new_mtime
+        if single_iteration:
+            break
+        yield tornado.gen.sleep(options.limit_overrides_check_ms / 1000.0)
+
+
+def launch_exchange_or_queue_it(exchange):
     global expired_request_counter, blocked_exchanges, running_exchanges
     rid = exchange.request_id
     lifetime = exchange.lifetime()
@@ -382,6 +1226,7 @@ def launch_exchange_or_queue_it(exchange, choosen_counter=None):
         logger.warning("expired request #%s (lifetime: %i) got from "
                        "local queue => trash it", rid, lifetime)
         expired_request_counter += 1
+        tornado.ioloop.IOLoop.instance().spawn_callback(acknowledge, exchange)
         if rid in blocked_exchanges:
             del(blocked_exchanges[rid])
         return None
@@ -394,17 +1239,26 @@ def launch_exchange_or_queue_it(exchange, choosen_counter=None):
             del(blocked_exchanges[rid])
         return None
     if exchange.conditions is None:
-        exchange.conditions = Limits.conditions(exchange.request)
-    accepted, counters = conditional_incr_counters(exchange.conditions)
+        # the request is only unserialized if a hash function has to be
+        # called (hashes precomputed by http2redis are used first)
+        exchange.conditions = Limits.conditions(
+            lambda: exchange.request, hashes=exchange.hashes,
+            queue=exchange.redis_queue,
+            server_message=lambda: exchange.server_request)
+    # (the maximum number of dynamic counters is checked when the counters
+    # are incremented, the bounded conditions are the ones to decrement)
+    conditions = bound_conditions(exchange.conditions)
+    accepted, counters = conditional_incr_counters(conditions)
     if accepted is False:
-        if choosen_counter is None:
-            choosen_counter = min(counters, key=get_blocked_queue_size)
+        request_leases(counters)
+        choosen_counter = min(counters, key=get_blocked_queue_size)
         try:
             blocked_queue_put_nowait(choosen_counter, priority, exchange)
             logger.debug("request %s blocked by %s counter, queued in "
                          "blocking queue", rid, choosen_counter)
             if rid not in blocked_exchanges:
-                blocked_exchanges[rid] = (choosen_counter, exchange)
+                push_blocked_deadline(exchange)
+            blocked_exchanges[rid] = (choosen_counter, exchange)
         except _queue.Full:
             host = exchange.queue.host
             port = exchange.queue.port
@@ -423,18 +1277,21 @@ def launch_exchange_or_queue_it(exchange, choosen_counter=None):
         before = datetime.now()
         running_exchanges[rid] = (before, exchange)
         future = process_request(exchange, before)
-        callback = functools.partial(process_request_callback, rid, counters)
+        callback = functools.partial(process_request_callback, rid,
+                                     conditions)
         tornado.ioloop.IOLoop.instance().add_future(future, callback)
         return True
 
 
-def process_request_callback(rid, counters, future):
+def process_request_callback(rid, conditions, future):
     global running_exchanges, total_request_counter
     del(running_exchanges[rid])
-    decr_counters(counters)
+    decr_conditions(conditions)
     total_request_counter += 1
-    for counter in counters:
-        reinject_blocking_queue(counter)
+    for condition in conditions:
+        reinject_blocking_queue(condition[0])
+    if capacity_condition is not None:
+        capacity_condition.notify_all()
     exception = future.exception()
     if exception is not None:
         logging.exception(format_future_exception(future))
@@ -462,6 +1319,21 @@ def write_stats():
     stats['bus_reinject_counter'] = bus_reinject_counter
     stats['total_request_counter'] = total_request_counter
     stats['expired_request_counter'] = expired_request_counter
+    stats['mirrored_request_counter'] = mirrored_request_counter
+    stats['recovered_request_counter'] = recovered_request_counter
+    stats['pop_batch_sizes'] = pop_batch_sizes.to_dict()
+    stats['reinject_batch_sizes'] = reinject_batch_sizes.to_dict()
+    stats['reinject_latency_ms'] = reinject_latency.to_dict()
+    stats['consumption_pause_counter'] = consumption_pause_counter
+    stats['mirrored_status_counters'] = \
+        {str(x): y for x, y in mirrored_status_counters.items()}
+    stats['workers'] = {}
+    for queue in Queues:
+        key = format_redis_server(queue=queue, queues=queue.queues)
+        stats['workers'][key] = queue.running_workers
+    stats['dynamic_counters'] = get_dynamic_counters_number()
+    stats['overflow_counter'] = get_overflow_counter()
+    stats['leases'] = {x: Leases.get(x) for x in Leases.counters()}
     stats['counters'] = {}
     for name, limit in six.iteritems(Limits.limits):
         if limit.show_in_stats:
@@ -477,6 +1349,16 @@ def write_stats():
                     get_counter(global_name)
                 stats['counters'][name + "_globalblocks"] = \
                     get_counter_blocks(global_name)
+                # (the overridden values are reported separately)
+                for value, value_limit in six.iteritems(limit.overrides):
+                    counter = "%s==%s" % (name, value)
+                    stats['counters'][counter + "_limit"] = value_limit
+                    stats['counters'][counter + "_value"] = \
+                        get_counter(counter)
+                    stats['counters'][counter + "_blocks"] = \
+                        get_counter_blocks(counter)
+                    stats['counters'][counter + "_queue"] = \
+                        get_blocked_queue_size(counter)
 
     with open(options.stats_file, "w") as f:
         f.write(json.dumps(stats, indent=4))
@@ -511,14 +1393,21 @@ def _stop_loop():
                 tornado.ioloop.IOLoop.instance().call_later(1, _stop_loop)
         elif stopping == 4:
             running_bus_reinject_handler_number -= 1
-            if running_bus_reinject_handler_number == 0:
-                stopping += 1
-                logger.info("stopping ioloop...")
-                tornado.ioloop.IOLoop.instance().stop()
+            stop_ioloop_if_done()
         else:
             stopping += 1
 
 
+def stop_ioloop_if_done():
+    # (the bus reinject handlers and the heartbeat handlers are done)
+    global stopping
+    if stopping == 4 and running_bus_reinject_handler_number == 0 and \
+            running_heartbeat_handler_number == 0:
+        stopping += 1
+        logger.info("stopping ioloop...")
+        tornado.ioloop.IOLoop.instance().stop()
+
+
 def sig_handler(sig, frame):
     logging.info('caught signal: %s', sig)
     tornado.ioloop.IOLoop.instance().add_callback_from_signal(shutdown)
@@ -530,11 +1419,24 @@ def shutdown():
 
 
 def main():
-    global running_request_redis_handler_number,\
-        running_bus_reinject_handler_number
+    global running_bus_reinject_handler_number, \
+        running_heartbeat_handler_number
     parse_command_line()
     if options.config is not None:
         exec(open(options.config).read(), {})
+    if options.processes > 1:
+        worker, channel = fork_workers(options.processes)
+        if worker is None:
+            supervise(channel, stats_file=options.stats_file,
+                      stats_frequency_ms=options.stats_frequency_ms)
+            try:
+                os.remove(options.stats_file)
+            except:
+                pass
+            return
+        init_worker(worker, channel)
+    set_max_dynamic_counters(options.max_dynamic_counters)
+    set_overflow_limit(options.overflow_limit)
     loop = tornado.ioloop.IOLoop.instance()
     loop.set_blocking_log_threshold(1)
     launched_bus_reinject_handlers = {}
@@ -542,17 +1444,35 @@ def main():
         host = queue.host
         port = queue.port
         uds = queue.unix_domain_socket
-        workers = queue.workers
-        for i in range(0, workers):
-            loop.add_future(request_redis_handler(queue), stop_loop)
-            running_request_redis_handler_number += 1
-        if "%s:%i" % (host, port) not in launched_bus_reinject_handlers:
+        if options.heartbeat_ttl > 0:
+            # (before the workers so the consumer is alive before it
+            # registers its processing list in reliable mode)
+            loop.add_future(heartbeat_handler(queue),
+                            heartbeat_handler_callback)
+            running_heartbeat_handler_number += 1
+            if queue.reliable:
+                loop.spawn_callback(janitor_handler, queue)
+        for i in range(0, queue.workers):
+            launch_request_redis_handler(queue)
+        redis_server = format_redis_server(queue=queue)
+        if redis_server not in launched_bus_reinject_handlers:
             loop.add_future(bus_reinject_handler(host=host, port=port,
                                                  unix_domain_socket=uds),
                             stop_loop)
-            launched_bus_reinject_handlers["%s:%i" % (host, port)] = True
+            launched_bus_reinject_handlers[redis_server] = True
             running_bus_reinject_handler_number += 1
+            if options.saturation_publish_ms > 0:
+                loop.spawn_callback(saturation_handler, host=host,
+                                    port=port, unix_domain_socket=uds)
     loop.add_future(expiration_handler(), stop_loop)
+    if Leases.partitioned or \
+            any([limit.distributed for limit in Limits.limits.values()]):
+        set_limit_provider(leased_limit)
+        loop.spawn_callback(lease_handler)
+    if any([queue.autoscaled for queue in Queues]):
+        loop.spawn_callback(autoscale_handler)
+    if options.limit_overrides_file is not None:
+        loop.spawn_callback(limit_overrides_handler)
     if options.stats_frequency_ms > 0:
         stats_pc = tornado.ioloop.PeriodicCallback(write_stats,
                                                    options.stats_frequency_ms)
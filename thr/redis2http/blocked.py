@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of thr library released under the MIT license.
+# See the LICENSE file for more information.
+
+import heapq
+from six.moves import queue as _queue
+
+
+class IndexedPriorityQueue(object):
+    """
+    Bounded priority queue (lowest priority first, FIFO for equal
+    priorities) with a O(log n) removal of any item by its key
+
+    Args:
+        maxsize (int): maximum number of items (0 => no limit)
+    """
+
+    def __init__(self, maxsize=0):
+        self.maxsize = maxsize
+        # heap of [priority, sequence, key, item] entries
+        self._heap = []
+        # key => index of the entry in the heap
+        self._positions = {}
+        self._sequence = 0
+
+    def qsize(self):
+        return len(self._heap)
+
+    def __len__(self):
+        return len(self._heap)
+
+    def __contains__(self, key):
+        return key in self._positions
+
+    def full(self):
+        return self.maxsize > 0 and len(self._heap) >= self.maxsize
+
+    def put_nowait(self, key, priority, item):
+        """
+        Adds an item (an item already queued with the same key is replaced)
+
+        Raises:
+            queue.Full: if the queue is full
+        """
+        if key in self._positions:
+            self.remove(key)
+        elif self.full():
+            raise _queue.Full()
+        self._sequence += 1
+        self._heap.append([priority, self._sequence, key, item])
+        self._positions[key] = len(self._heap) - 1
+        self._sift_up(len(self._heap) - 1)
+
+    def get_nowait(self):
+        """
+        Removes and returns the (priority, item) tuple with the lowest
+        priority
+
+        Raises:
+            queue.Empty: if the queue is empty
+        """
+        if len(self._heap) == 0:
+            raise _queue.Empty()
+        entry = self._pop(0)
+        return (entry[0], entry[3])
+
+    def peek_nowait(self):
+        """
+        Returns (without removing it) the (priority, item) tuple with the
+        lowest priority
+
+        Raises:
+            queue.Empty: if the queue is empty
+        """
+        if len(self._heap) == 0:
+            raise _queue.Empty()
+        entry = self._heap[0]
+        return (entry[0], entry[3])
+
+    def remove(self, key):
+        """
+        Removes the item with the given key
+
+        Returns:
+            The removed item (None if there is no item with this key)
+        """
+        index = self._positions.get(key, None)
+        if index is None:
+            return None
+        return self._pop(index)[3]
+
+    def _pop(self, index):
+        heap = self._heap
+        entry = heap[index]
+        last = heap.pop()
+        del(self._positions[entry[2]])
+        if index < len(heap):
+            heap[index] = last
+            self._positions[last[2]] = index
+            self._sift_down(index)
+            self._sift_up(index)
+        return entry
+
+    def _swap(self, i, j):
+        heap = self._heap
+        heap[i], heap[j] = heap[j], heap[i]
+        self._positions[heap[i][2]] = i
+        self._positions[heap[j][2]] = j
+
+    def _less(self, i, j):
+        # (priority, sequence) only, keys and items are never compared
+        return self._heap[i][0:2] < self._heap[j][0:2]
+
+    def _sift_up(self, index):
+        while index > 0:
+            parent = (index - 1) // 2
+            if not self._less(index, parent):
+                break
+            self._swap(index, parent)
+            index = parent
+
+    def _sift_down(self, index):
+        size = len(self._heap)
+        while True:
+            smallest = index
+            for child in (2 * index + 1, 2 * index + 2):
+                if child < size and self._less(child, smallest):
+                    smallest = child
+            if smallest == index:
+                break
+            self._swap(index, smallest)
+            index = smallest
+
+
+class DeadlineHeap(object):
+    """
+    Min-heap of (deadline, key) entries with lazy invalidation
+
+    Entries are not removed before their deadline: the caller has to
+    check that the entries returned by :meth:`pop_expired` are still
+    relevant. So the cost of an expiration check only depends on the number
+    of expired entries. The invalidated entries can be purged with
+    :meth:`compact` when they are too numerous.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._sequence = 0
+
+    def __len__(self):
+        return len(self._heap)
+
+    def push(self, deadline, key):
+        self._sequence += 1
+        heapq.heappush(self._heap, (deadline, self._sequence, key))
+
+    def next_deadline(self):
+        """
+        Returns the earliest deadline (None if the heap is empty)
+        """
+        if len(self._heap) == 0:
+            return None
+        return self._heap[0][0]
+
+    def pop_expired(self, now):
+        """
+        Removes and returns the (deadline, key) entries (list) with a
+        deadline <= now (earliest first)
+        """
+        result = []
+        while len(self._heap) > 0 and self._heap[0][0] <= now:
+            deadline, _, key = heapq.heappop(self._heap)
+            result.append((deadline, key))
+        return result
+
+    def compact(self, is_valid):
+        """
+        Removes the invalidated entries (in O(n))
+
+        Args:
+            is_valid: a function (deadline, key) => False if the entry has
+                been invalidated
+        """
+        self._heap = [x for x in self._heap if is_valid(x[0], x[2])]
+        heapq.heapify(self._heap)
@@ -5,10 +5,175 @@
 # See the LICENSE file for more information.
 
 from collections import defaultdict
+from six.moves import intern
 
 
 counters = defaultdict(int)
 counters_blocks = defaultdict(int)
+limit_provider = None
+# number of dynamic ("name==value") counters in use
+dynamic_counters_number = 0
+# maximum number of dynamic counters in use (0 => no limit)
+max_dynamic_counters = 0
+# limit of the overflow counters (0 => scaled, see set_overflow_limit)
+overflow_limit = 0
+# number of conditions set on an overflow counter
+overflow_counter = 0
+OVERFLOW_VALUE = "__overflow__"
+# dynamic counters of the overridden values (see set_pinned_counters)
+pinned_counters = frozenset()
+# incremented when a counter or an effective limit changes
+counters_version = 0
+
+
+def set_limit_provider(provider):
+    """Sets the function returning the effective limit of a counter.
+
+    Args:
+        provider: a function (counter name, configured limit) => limit
+            applied by this process (None => configured limits).
+    """
+    global limit_provider
+    limit_provider = provider
+
+
+def set_max_dynamic_counters(value):
+    """Sets the maximum number of dynamic counters in use.
+
+    When it is reached, the conditions of new values are set on an overflow
+    counter (one by limit: ``name==__overflow__``, see
+    :func:`bound_conditions`) so the memory stays bounded.
+
+    Args:
+        value (int): the maximum number (0 => no limit).
+    """
+    global max_dynamic_counters
+    max_dynamic_counters = value
+
+
+def set_overflow_limit(value):
+    """Sets the limit of the overflow counters.
+
+    An overflow counter is shared by all the values of a limit which have
+    no counter of their own, so it shouldn't get the limit of a single
+    value.
+
+    Args:
+        value (int): the limit (0 => the limit of a value multiplied by
+            the maximum number of dynamic counters).
+    """
+    global overflow_limit
+    overflow_limit = value
+
+
+def get_overflow_limit(limit):
+    """Returns the limit of an overflow counter.
+
+    Args:
+        limit (int): the limit of a value.
+    """
+    if overflow_limit > 0:
+        return overflow_limit
+    return limit * max(1, max_dynamic_counters)
+
+
+def set_pinned_counters(names):
+    """Sets the dynamic counters of the values with an overridden limit.
+
+    Their blocks are kept when they are not in use (so they can be
+    reported in the stats) and they are never replaced by an overflow
+    counter (their number is bounded by the override tables).
+
+    Args:
+        names: an iterable of counter names (``name==value``).
+    """
+    global pinned_counters
+    pinned_counters = frozenset([_intern(x) for x in names])
+
+
+def _intern(name):
+    if isinstance(name, str):
+        return intern(name)
+    return name
+
+
+def make_condition(name, limit, value=None):
+    """Returns the condition of a limit for a request.
+
+    Args:
+        name (str): limit name.
+        limit (int): limit value.
+        value (str): hash value for a dynamic limit (None for a static
+            one).
+
+    Returns:
+        A (counter name, limit, global counter name, limit name) tuple (the
+        global counter name is None for a static limit).
+    """
+    name = _intern(name)
+    if value is None:
+        return (name, limit, None, name)
+    counter = "%s==%s" % (name, value)
+    return (_intern(counter), limit, _intern(name + "=====global"), name)
+
+
+def bound_conditions(conditions):
+    """Sets the conditions of new values on the overflow counters if the
+    maximum number of dynamic counters would be exceeded.
+
+    The result must be given to :func:`conditional_incr_counters` in the
+    same IOLoop callback (and then to :func:`decr_conditions`).
+
+    Args:
+        conditions: list of conditions (see :func:`make_condition`).
+
+    Returns:
+        A list of conditions.
+    """
+    if max_dynamic_counters <= 0:
+        return conditions
+    result = []
+    number = dynamic_counters_number
+    for condition in conditions:
+        counter, limit, global_counter, name = condition
+        if global_counter is not None and counter not in counters and \
+                counter not in pinned_counters:
+            if number >= max_dynamic_counters:
+                condition = (_intern("%s==%s" % (name, OVERFLOW_VALUE)),
+                             get_overflow_limit(limit), global_counter, name)
+            else:
+                number += 1
+        result.append(condition)
+    return result
+
+
+def _make_conditions(counter_list):
+    # (from counter names, only for the counter list API)
+    result = []
+    for counter in counter_list:
+        name = counter.split('==', 1)[0]
+        result.append((counter, None,
+                       name + "=====global" if '==' in counter else None,
+                       name))
+    return result
+
+
+def touch_counters():
+    """Signals a change of the counters or of the effective limits (so the
+    values cached with :func:`get_counters_version` are recomputed).
+    """
+    global counters_version
+    counters_version += 1
+
+
+def get_counters_version():
+    return counters_version
+
+
+def get_effective_limit(counter, limit):
+    if limit_provider is None:
+        return limit
+    return limit_provider(counter, limit)
 
 
 def get_global_counter_name(counter):
@@ -16,57 +181,110 @@ def get_global_counter_name(counter):
 
 
 def get_counter(counter):
-    return counters[counter]
+    return counters.get(counter, 0)
+
+
+def get_used_counters():
+    return [x for x, y in counters.items() if y > 0]
+
+
+def get_dynamic_counters_number():
+    return dynamic_counters_number
+
+
+def get_overflow_counter():
+    return overflow_counter
 
 
 def set_counter(counter, value):
     global counters
     counters[counter] = value
+    touch_counters()
 
 
-def incr_counters(counter_list):
-    global counters
-    for counter in counter_list:
-        counters[counter] += 1
-        if '==' in counter:
-            global_counter = get_global_counter_name(counter)
+def incr_conditions(conditions):
+    global counters, dynamic_counters_number, overflow_counter
+    touch_counters()
+    for counter, limit, global_counter, _ in conditions:
+        value = counters.get(counter, 0)
+        counters[counter] = value + 1
+        if global_counter is not None:
+            if value == 0:
+                dynamic_counters_number += 1
+            if counter.endswith("==" + OVERFLOW_VALUE):
+                overflow_counter += 1
             counters[global_counter] += 1
 
 
+def incr_counters(counter_list):
+    incr_conditions(_make_conditions(counter_list))
+
+
 def get_counter_blocks(counter):
-    return counters_blocks[counter]
+    return counters_blocks.get(counter, 0)
+
+
+def get_blocking_counters(conditions):
+    """Returns the names of the counters which have reached their limit.
+
+    Unlike :func:`conditional_incr_counters`, nothing is modified (the
+    conditions are bounded, see :func:`bound_conditions`).
+
+    Args:
+        conditions: list of conditions (see :func:`make_condition`).
+
+    Returns:
+        A list of counter names (empty if the conditions are fulfilled).
+    """
+    return [x[0] for x in bound_conditions(conditions)
+            if get_effective_limit(x[0], x[1]) <= counters.get(x[0], 0)]
 
 
 def conditional_incr_counters(conditions):
     global counters, counters_blocks
     blocked_counters = []
-    for counter_name, limit in conditions:
-        if limit <= counters[counter_name]:
+    for counter_name, limit, global_counter, _ in conditions:
+        value = counters.get(counter_name, 0)
+        if get_effective_limit(counter_name, limit) <= value:
             blocked_counters.append(counter_name)
-            counters_blocks[counter_name] += 1
-            if '==' in counter_name:
-                global_counter = get_global_counter_name(counter_name)
+            if global_counter is None or value > 0 or \
+                    counter_name in pinned_counters:
+                # (the blocks of a dynamic counter are forgotten when it
+                # is no more in use, except for the pinned ones)
+                counters_blocks[counter_name] += 1
+            if global_counter is not None:
                 counters_blocks[global_counter] += 1
     if len(blocked_counters) == 0:
-        tmp = [x[0] for x in conditions]
-        incr_counters(tmp)
-        return (True, tmp)
+        incr_conditions(conditions)
+        return (True, [x[0] for x in conditions])
     else:
         return (False, blocked_counters)
 
 
-def decr_counters(counter_list):
-    global counters
-    for counter in counter_list:
-        counters[counter] -= 1
-        if counters[counter] == 0:
-            # to avoir some memory leaks
-            del(counters[counter])
-        if '==' in counter:
-            global_counter = get_global_counter_name(counter)
+def decr_conditions(conditions):
+    global counters, counters_blocks, dynamic_counters_number
+    touch_counters()
+    for counter, limit, global_counter, _ in conditions:
+        value = counters.get(counter, 0) - 1
+        if value <= 0:
+            # to avoid some memory leaks
+            counters.pop(counter, None)
+            if global_counter is not None:
+                dynamic_counters_number -= 1
+                if counter not in pinned_counters:
+                    counters_blocks.pop(counter, None)
+        else:
+            counters[counter] = value
+        if global_counter is not None:
             counters[global_counter] -= 1
 
 
+def decr_counters(counter_list):
+    decr_conditions(_make_conditions(counter_list))
+
+
 def del_counter(counter):
-    global counters
-    counters.pop(counter, None)
+    global counters, dynamic_counters_number
+    if counters.pop(counter, 0) > 0 and '==' in counter and \
+            not counter.endswith("=====global"):
+        dynamic_counters_number -= 1
@@ -4,7 +4,9 @@
 # This file is part of thr library released under the MIT license.
 # See the LICENSE file for more information.
 
-from thr.utils import unserialize_request_message, make_unique_id
+from thr.utils import decode_request_message, request_from_decoded_message
+from thr.utils import server_request_from_decoded_message
+from thr.utils import make_unique_id, make_priority_score
 import time
 
 
@@ -19,22 +21,36 @@ class HTTPRequestExchange(object):
             self.redis_queue = redis_queue
         self.local_queue_time = time.time()
         self.conditions = None
+        self.__decoded = None
         self.__request = None
+        self.__server_request = None
         self.__body_link = None
         self.__extra_dict = None
         self.__request_id = None
         self.__priority = None
         self.creation_time = time.time()
+        # time of the (last) queueing for a reinjection on the bus
+        self.reinject_time = None
+        # processing list of the request (reliable mode)
+        self.processing_key = None
+        # current deadline of the request in the blocked_deadlines heap
+        self.blocked_deadline = None
+
+    def decode_request(self):
+        self.__decoded = decode_request_message(self.serialized_request)
+        self.__extra_dict = self.__decoded.get('extra', {})
 
     def unserialize_request(self):
+        if self.__decoded is None:
+            self.decode_request()
         if self.queue.http_host.startswith('unixsocket_'):
             # This is a unix socket
             force_host = self.queue.http_host
         else:
             force_host = "%s:%i" % (self.queue.http_host, self.queue.http_port)
         self.__request, self.__body_link, self.__extra_dict = \
-            unserialize_request_message(self.serialized_request,
-                                        force_host=force_host)
+            request_from_decoded_message(self.__decoded,
+                                         force_host=force_host)
 
     @property
     def request(self):
@@ -42,6 +58,18 @@ class HTTPRequestExchange(object):
             self.unserialize_request()
         return self.__request
 
+    @property
+    def server_request(self):
+        """
+        The request as a tornado HTTPServerRequest (like in http2redis)
+        """
+        if self.__server_request is None:
+            if self.__decoded is None:
+                self.decode_request()
+            self.__server_request = \
+                server_request_from_decoded_message(self.__decoded)
+        return self.__server_request
+
     @property
     def body_link(self):
         if not self.__request:
@@ -50,36 +78,49 @@ class HTTPRequestExchange(object):
 
     @property
     def extra_dict(self):
-        if not self.__request:
-            self.unserialize_request()
+        # no need to build the HTTPRequest object here
+        if self.__decoded is None:
+            self.decode_request()
         return self.__extra_dict
 
+    @property
+    def hashes(self):
+        """
+        Hashes computed by http2redis (hash name => value)
+        """
+        return self.extra_dict.get('hashes', None)
+
     @property
     def priority(self):
         if not self.__priority:
-            if not self.__request:
-                self.unserialize_request()
-            big = self.__extra_dict.get('priority', 5)
-            little = int(self.creation_time * 1000)
-            self.__priority = big * 10000000000000 + little
+            big = self.extra_dict.get('priority', 5)
+            self.__priority = make_priority_score(big, self.creation_time)
         return self.__priority
 
     @property
     def request_id(self):
         if not self.__request_id:
-            self.unserialize_request()
-            self.__request_id = self.__extra_dict.get('request_id',
-                                                      make_unique_id())
+            self.__request_id = self.extra_dict.get('request_id',
+                                                    make_unique_id())
         return self.__request_id
 
+    @property
+    def bus_score(self):
+        """
+        Score of the request in a sorted set bus (from the priority and
+        the creation time given by http2redis)
+        """
+        extra_dict = self.extra_dict
+        return make_priority_score(extra_dict.get('priority', 5),
+                                   extra_dict.get('creation_time',
+                                                  self.creation_time))
+
     def lifetime_in_local_queue_ms(self):
         return int((time.time() - self.local_queue_time) * 1000)
 
     def lifetime(self):
-        if not self.__request:
-            self.unserialize_request()
         now = time.time()
-        dt = now - self.__extra_dict.get('creation_time', now)
+        dt = now - self.extra_dict.get('creation_time', now)
         # creation_time can be set by another not time synchronized box
         dt = max(0, dt)
         return int(dt)
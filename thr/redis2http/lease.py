@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of thr library released under the MIT license.
+# See the LICENSE file for more information.
+
+import time
+
+from thr.redis2http.limits import Limits
+from thr.redis2http.counter import touch_counters
+
+
+# Grants (atomically) some slots of a fleet-wide limit to a consumer
+#
+# KEYS[1]: lease hash of the counter (consumer id =>
+#          "held slots:wanted slots:expiration_ms")
+# ARGV: consumer id, wanted slots, limit, now (ms), lease ttl (ms),
+#       used slots
+#
+# A consumer never gets more than its max-min fair share of the wanted
+# slots of the live consumers (see supervisor.fair_shares), nor more than
+# the slots released by the others: the running requests of a consumer
+# above its share still hold their slots until they are done, so the
+# consumers converge to their fair share in one renewal. Expired leases
+# (crashed consumers) are removed, the number of granted slots is returned.
+LEASE_SCRIPT = """
+local consumer = ARGV[1]
+local wanted = tonumber(ARGV[2])
+local limit = tonumber(ARGV[3])
+local now = tonumber(ARGV[4])
+local ttl = tonumber(ARGV[5])
+local used = tonumber(ARGV[6])
+local others = 0
+local demands = {wanted}
+local leases = redis.call('HGETALL', KEYS[1])
+for i = 1, #leases, 2 do
+    if leases[i] ~= consumer then
+        local slots, demand, expiration = string.match(leases[i + 1],
+                                                       '^(%d+):(%d+):(%d+)$')
+        if slots == nil then
+            -- (lease of a consumer without fair sharing)
+            slots, expiration = string.match(leases[i + 1], '^(%d+):(%d+)$')
+            demand = slots
+        end
+        if expiration == nil or tonumber(expiration) < now then
+            redis.call('HDEL', KEYS[1], leases[i])
+        else
+            others = others + tonumber(slots)
+            table.insert(demands, tonumber(demand))
+        end
+    end
+end
+table.sort(demands)
+local remaining = limit
+local share = nil
+for i, demand in ipairs(demands) do
+    local fair = math.floor(remaining / (#demands - i + 1))
+    local tmp = math.max(0, math.min(demand, fair))
+    if share == nil and demand == wanted then
+        share = tmp
+    end
+    remaining = remaining - tmp
+end
+local granted = math.max(0, math.min(wanted, share, limit - others))
+local held = math.max(granted, used)
+if wanted > 0 or held > 0 then
+    redis.call('HSET', KEYS[1], consumer,
+               held .. ':' .. wanted .. ':' .. (now + ttl))
+    redis.call('PEXPIRE', KEYS[1], ttl)
+else
+    redis.call('HDEL', KEYS[1], consumer)
+end
+return granted
+"""
+
+
+def get_lease_key(counter):
+    """
+    Returns the redis key of the lease hash of a (distributed) counter
+    """
+    return "thr:lease:%s" % counter
+
+
+def get_leased_limit(counter):
+    # (global counters of the limits by hash value are never leased: no
+    # condition checks their limit)
+    if counter.endswith("=====global"):
+        return None
+    return Limits.limits.get(counter.split('==', 1)[0], None)
+
+
+def is_distributed(counter):
+    """
+    Returns True if the counter belongs to a fleet-wide limit
+    """
+    limit = get_leased_limit(counter)
+    return limit is not None and limit.distributed
+
+
+def is_leased(counter):
+    """
+    Returns True if the limit of the counter is leased (fleet-wide limits
+    and, in multi-process mode, all limits)
+    """
+    limit = get_leased_limit(counter)
+    return limit is not None and (limit.distributed or Leases.partitioned)
+
+
+class Leases(object):
+    """
+    Local cache of the slots leased for the distributed counters
+    (counter name => (slots, expiration timestamp))
+
+    A counter which is still needed stays in the cache with 0 slot when
+    nothing is granted.
+    """
+
+    leases = {}
+    # True in a worker process (the limits are partitioned between the
+    # workers by the supervisor)
+    partitioned = False
+
+    @classmethod
+    def reset(cls):
+        cls.leases = {}
+        cls.partitioned = False
+
+    @classmethod
+    def update(cls, counter, slots, expiration):
+        cls.leases[counter] = (slots, expiration)
+        touch_counters()
+
+    @classmethod
+    def remove(cls, counter):
+        cls.leases.pop(counter, None)
+        touch_counters()
+
+    @classmethod
+    def counters(cls):
+        return list(cls.leases.keys())
+
+    @classmethod
+    def get(cls, counter):
+        """
+        Returns the number of leased slots (0 for an expired lease)
+        """
+        slots, expiration = cls.leases.get(counter, (0, 0))
+        if expiration < time.time():
+            return 0
+        return slots
+
+
+def leased_limit(counter, limit):
+    """
+    Limit provider (see :func:`~thr.redis2http.counter.set_limit_provider`)
+    which reduces the leased limits to the slots leased by this process
+    """
+    if not is_leased(counter):
+        return limit
+    return min(limit, Leases.get(counter))
@@ -5,44 +5,221 @@
 # See the LICENSE file for more information.
 
 
+import re
 import six
+import fnmatch
 from thr.utils import glob, regexp, diff
+from thr.hashes import Hashes
+from thr.redis2http.counter import make_condition, set_pinned_counters
+from thr.redis2http.counter import touch_counters
+from thr.redis2http.counter import get_overflow_limit, OVERFLOW_VALUE
 import logging
 
 logger = logging.getLogger("thr.redis2http.limits")
 
+# backreferences (\1, (?P=name)) and conditional groups ((?(1)...)) of
+# regexp limits (the groups are renumbered when the patterns are merged, so
+# these patterns are never merged)
+GROUP_REFERENCE_REGEXP = re.compile(r"\\[1-9]|\(\?P=|\(\?\(")
+
+
+class LimitIndex(object):
+    """
+    Limits sharing the same hash function, indexed by hash value
+
+    Args:
+        hash_func: the shared hash function (or hash name)
+    """
+
+    def __init__(self, hash_func):
+        self.hash_func = hash_func
+        # hash value => list of (name, limit) (string hash values)
+        self.exact = {}
+        # list of (name, limit) (limits by hash value)
+        self.dynamic = []
+        # list of (name, limit) (glob and regexp hash values)
+        self.patterns = []
+        # list of (name, limit) (other hash values)
+        self.others = []
+        # merged regexp matching (at least) the hash values matched by one
+        # of the patterns (None => no prefiltering)
+        self.prefilter = None
+
+    def add(self, name, limit):
+        hash_value = limit.hash_value
+        if hash_value == limit.hash_func:
+            self.dynamic.append((name, limit))
+        elif isinstance(hash_value, six.string_types):
+            self.exact.setdefault(hash_value, []).append((name, limit))
+        elif isinstance(hash_value, (glob, regexp)):
+            self.patterns.append((name, limit))
+            self.prefilter = None
+        else:
+            self.others.append((name, limit))
+
+    def get_static_limits(self):
+        """
+        Returns the list of (name, limit) of the limits which are not by
+        hash value
+        """
+        result = [x for values in self.exact.values() for x in values]
+        return result + self.patterns + self.others
+
+    def compile(self):
+        patterns = []
+        for name, limit in self.patterns:
+            if isinstance(limit.hash_value, glob):
+                patterns.extend([fnmatch.translate(x)
+                                 for x in limit.hash_value.patterns])
+            else:
+                patterns.extend(limit.hash_value.patterns)
+        if any([GROUP_REFERENCE_REGEXP.search(x) for x in patterns]):
+            # (the prefilter must match at least what the patterns match)
+            self.prefilter = None
+            return
+        try:
+            self.prefilter = re.compile("|".join(["(?:%s)" % x
+                                                  for x in patterns]))
+        except re.error:
+            # (incompatible patterns)
+            self.prefilter = None
+
+    def conditions(self, hash, conditions):
+        """
+        Appends the conditions of the limits matching the given hash value
+        to the conditions list
+        """
+        for name, limit in self.exact.get(hash, ()):
+            conditions.append(make_condition(name, limit.limit))
+        for name, limit in self.dynamic:
+            conditions.append(make_condition(name, limit.get_limit(hash),
+                                             hash))
+        if len(self.patterns) > 0 and \
+                (self.prefilter is None or self.prefilter.match(hash)):
+            for name, limit in self.patterns:
+                if limit.hash_value.match(hash):
+                    conditions.append(make_condition(name, limit.limit))
+        for name, limit in self.others:
+            if limit.check_hash(hash):
+                conditions.append(make_condition(name, limit.limit))
+
 
 class Limits(object):
 
     limits = {}
+    # queue name => list of LimitIndex objects (built on demand)
+    indexes = {}
 
     @classmethod
     def reset(cls):
         cls.limits = {}
+        cls.indexes = {}
+        set_pinned_counters([])
+        touch_counters()
 
     @classmethod
     def add(cls, name, limit):
         cls.limits[name] = limit
+        cls.indexes = {}
+        cls.pin_overridden_values()
+        touch_counters()
+
+    @classmethod
+    def set_overrides(cls, name, overrides):
+        cls.limits[name].set_overrides(overrides)
+        cls.pin_overridden_values()
+        touch_counters()
+
+    @classmethod
+    def pin_overridden_values(cls):
+        set_pinned_counters(["%s==%s" % (name, value)
+                             for name, limit in six.iteritems(cls.limits)
+                             for value in limit.overrides])
+
+    @classmethod
+    def get_limit(cls, counter):
+        """
+        Returns the configured limit of a counter (None for an unknown
+        counter)
+        """
+        name, _, value = counter.partition('==')
+        limit = cls.limits.get(name, None)
+        if limit is None:
+            return None
+        if value == OVERFLOW_VALUE:
+            return get_overflow_limit(limit.limit)
+        return limit.get_limit(value if value != "" else None)
+
+    @classmethod
+    def get_indexes(cls, queue=None):
+        """
+        Returns the LimitIndex objects (one by hash function) of the limits
+        applied to the requests of the given queue
+        """
+        if queue not in cls.indexes:
+            indexes = {}
+            for name in sorted(cls.limits.keys()):
+                limit = cls.limits[name]
+                if limit.queues is not None and queue not in limit.queues:
+                    continue
+                if limit.hash_func not in indexes:
+                    indexes[limit.hash_func] = LimitIndex(limit.hash_func)
+                indexes[limit.hash_func].add(name, limit)
+            for index in indexes.values():
+                index.compile()
+            cls.indexes[queue] = list(indexes.values())
+        return cls.indexes[queue]
 
     @classmethod
-    def conditions(cls, message):
+    def conditions(cls, message, hashes=None, queue=None,
+                   server_message=None):
+        """
+        Returns the list of (counter name, limit, global counter name, limit
+        name) conditions of a request (see
+        :func:`~thr.redis2http.counter.make_condition`)
+
+        Args:
+            message: the request (or a callable returning the request, so
+                the request is only unserialized if a hash function has to
+                be called)
+            hashes: a dict hash name => value of precomputed hashes (named
+                hashes are looked up here before calling the registered
+                hash function)
+            queue: the name of the redis queue of the request (limits
+                scoped to other queues are ignored)
+            server_message: the request as a tornado HTTPServerRequest (or
+                a callable returning it) for the named hashes, see
+                :func:`~thr.hashes.add_hash` (None => message)
+        """
+        if server_message is None:
+            server_message = message
         conditions = []
-        computed_hashes = {}
-        for name, limit in six.iteritems(cls.limits):
-            hash_func = limit.hash_func
-            if hash_func not in computed_hashes:
-                computed_hashes[hash_func] = hash_func(message)
-            hash = computed_hashes[hash_func]
-            if hash is not None:
-                if limit.check_hash(hash):
-                    counter = "%s%s" % (name, limit.counter_suffix(hash))
-                    conditions.append((counter, limit.limit))
+        for index in cls.get_indexes(queue):
+            hash_func = index.hash_func
+            if hashes is not None and hash_func in hashes:
+                hash = hashes[hash_func]
+            elif isinstance(hash_func, six.string_types):
+                if Hashes.get(hash_func) is None:
+                    continue
+                if callable(server_message):
+                    server_message = server_message()
+                hash = Hashes.call(hash_func, server_message)
+            else:
+                if callable(message):
+                    message = message()
+                hash = hash_func(message)
+            if hash is None:
+                continue
+            if '==' in hash:
+                raise Exception("'==' not allowed in hashed_message")
+            index.conditions(hash, conditions)
         return conditions
 
 
 class Limit(object):
 
-    def __init__(self, hash_func, hash_value, limit, show_in_stats=True):
+    def __init__(self, hash_func, hash_value, limit, show_in_stats=True,
+                 distributed=False, queues=None, overrides=None):
         if callable(hash_value):
             if hash_value != hash_func:
                 raise Exception("hash_value is callable and not hash_func")
@@ -50,6 +227,28 @@ class Limit(object):
         self.hash_value = hash_value
         self.limit = limit
         self.show_in_stats = show_in_stats
+        self.distributed = distributed
+        if isinstance(queues, six.string_types):
+            queues = [queues]
+        self.queues = None if queues is None else set(queues)
+        self.overrides = {}
+        self.set_overrides(overrides)
+        # (overrides of the configuration file)
+        self.initial_overrides = dict(self.overrides)
+
+    def set_overrides(self, overrides):
+        if overrides and self.hash_value != self.hash_func:
+            raise Exception("overrides are only allowed for limits by "
+                            "hash value")
+        self.overrides = dict(overrides or {})
+
+    def get_limit(self, hashed_message=None):
+        """
+        Returns the limit of a hash value (the overridden one if any)
+        """
+        if hashed_message is None:
+            return self.limit
+        return self.overrides.get(hashed_message, self.limit)
 
     def counter_suffix(self, hashed_message):
         if self.hash_value == self.hash_func:
@@ -72,19 +271,30 @@ class Limit(object):
 
 
 def add_max_limit(name, hash_func, hash_value, max_limit,
-                  show_in_stats=True):
+                  show_in_stats=True, distributed=False, queues=None,
+                  overrides=None):
     """
     Add a maximum limit for the specified value of the hash function
 
     Args:
         name: a limit name (unique)
-        hash_func: a hash function
+        hash_func: a hash function or the name of a hash registered with
+            :func:`~thr.hashes.add_hash` (computed by http2redis)
         hash_value: a string, :class:`~thr.http2redis.rules.glob` object,
-             compiled regular expression object or function identical to
-             ``hash_func``
+             compiled regular expression object or function (or hash name)
+             identical to ``hash_func``
         max_limit: an int
         show_in_stats: a boolean to hide (False) some limits from
             counter stats (if too many values).
+        distributed: if True, the limit is shared by all redis2http
+            processes (instead of a limit by process): each process leases
+            the slots it needs in redis (see the ``lease_*`` options)
+        queues: a redis queue name or a list of redis queue names (the
+            limit is only applied to the requests of these queues, None =>
+            all queues)
+        overrides: a dict hash value => limit overriding max_limit for
+            some values (only for a limit by hash value, see
+            :func:`set_limit_overrides` to update them at runtime)
 
     Examples:
         >>> def my_hash(request):
@@ -98,7 +308,30 @@ def add_max_limit(name, hash_func, hash_value, max_limit,
         >>> def my_hash(request):
                 return request.headers.get('Foo')
         >>> add_max_limit("toto_limit", my_hash, my_hash, 3)
+
+    With a named hash (computed by http2redis):
+        >>> add_max_limit("user_limit", "user", "user", 3)
+
+    With 50 slots for tenant A, 10 for tenant B and 2 for the others:
+        >>> add_max_limit("tenant_limit", "tenant", "tenant", 2,
+                          overrides={"A": 50, "B": 10})
     """
     if "==" in name:
         raise Exception("'==' not allowed in limit names")
-    Limits.add(name, Limit(hash_func, hash_value, max_limit, show_in_stats))
+    Limits.add(name, Limit(hash_func, hash_value, max_limit, show_in_stats,
+                           distributed, queues, overrides))
+
+
+def set_limit_overrides(name, overrides):
+    """
+    Replace (at runtime) the overridden values of a limit by hash value
+
+    Args:
+        name: the limit name
+        overrides: a dict hash value => limit
+
+    Only the conditions of the next requests are changed (see
+    :func:`thr.redis2http.app.update_limit_overrides` to update the
+    blocked requests too).
+    """
+    Limits.set_overrides(name, overrides)
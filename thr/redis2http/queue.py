@@ -7,7 +7,7 @@
 import six
 
 from thr import DEFAULT_HTTP_PORT
-from thr.utils import UnixResolver
+from thr.utils import UnixResolver, parse_redis_address
 
 
 # Trick to be able to iter over Queues
@@ -39,7 +39,8 @@ class Queue(object):
     def __init__(self, queues, host="localhost", port=6379,
                  http_host="localhost",
                  http_port=DEFAULT_HTTP_PORT, workers=1,
-                 unix_domain_socket=None):
+                 unix_domain_socket=None, max_workers=None,
+                 queue_type="list", reliable=False):
         self.host = host
         self.port = port
         self.unix_domain_socket = unix_domain_socket
@@ -47,11 +48,41 @@ class Queue(object):
         self.http_host = http_host
         self.http_port = http_port
         self.workers = workers
+        self.queue_type = queue_type
+        self.reliable = reliable
+        if max_workers is None:
+            self.max_workers = workers
+        else:
+            self.max_workers = max(workers, max_workers)
+        # number of running request_redis_handler coroutines
+        self.running_workers = 0
+        # number of request_redis_handler coroutines asked to stop
+        self.workers_to_stop = 0
+        # counter name => last time a request of this queue was blocked
+        # by this counter
+        self.blocking_counters = {}
+        # redis queue => (counters version, pop batch size)
+        self.pop_batch_sizes = {}
+
+    @property
+    def autoscaled(self):
+        return self.max_workers > self.workers
+
+    def should_stop_worker(self):
+        """
+        Returns True (only once by stop request) if the calling worker
+        has to stop (because of a scale down)
+        """
+        if self.workers_to_stop > 0:
+            self.workers_to_stop -= 1
+            return True
+        return False
 
 
 def add_queue(queues, host="localhost", port=6379, http_host="localhost",
               http_port=DEFAULT_HTTP_PORT, workers=1,
-              unix_domain_socket=None):
+              unix_domain_socket=None, bus_pool=None, max_workers=None,
+              queue_type="list", reliable=False):
     """
     Register a Redis queue
 
@@ -64,7 +95,24 @@ def add_queue(queues, host="localhost", port=6379, http_host="localhost",
         http_host: upstream HTTP host
         http_port: upstream http port
         workers: number of coroutines popping requests from the queue
+            (minimum number if max_workers is set)
         unix_domain_socket: unix domain socket file path
+        bus_pool: a list of redis addresses ("host:port" or unix domain
+            socket path) backing the queue (overrides host, port and
+            unix_domain_socket), each instance is consumed by its own
+            ``workers`` coroutines (so all instances are consumed fairly)
+        max_workers: if greater than workers, the number of coroutines is
+            adapted between workers and max_workers (depending on the
+            backlog in the queue and the local blocked requests)
+        queue_type: "list" (default) or "zset" (sorted sets by priority
+            and creation time, see the ``set_redis_queue_type`` http2redis
+            action)
+        reliable: if True, popped requests are moved atomically in a
+            processing list (by consumer) until their response is pushed,
+            the requests of dead consumers (expired heartbeat) are
+            requeued (only for a single "list" queue, requests can be
+            processed twice if a consumer is considered as dead while it
+            is still processing them)
     """
     if http_host.startswith('/'):
         # This is an unix socket
@@ -72,11 +120,18 @@ def add_queue(queues, host="localhost", port=6379, http_host="localhost",
     else:
         new_http_host = http_host
     if isinstance(queues, six.string_types):
-        Queues.add(Queue([queues], host=host, port=port,
-                         http_host=new_http_host,
-                         http_port=http_port, workers=workers,
-                         unix_domain_socket=unix_domain_socket))
+        queues = [queues]
+    if reliable and (len(queues) != 1 or queue_type != "list"):
+        raise Exception("reliable mode is only available for a single "
+                        "list queue")
+    if bus_pool is None:
+        redis_addresses = [(host, port, unix_domain_socket)]
     else:
-        Queues.add(Queue(queues, host=host, port=port, http_host=new_http_host,
+        redis_addresses = [parse_redis_address(x) for x in bus_pool]
+    for (redis_host, redis_port, redis_uds) in redis_addresses:
+        Queues.add(Queue(queues, host=redis_host or host,
+                         port=redis_port or port, http_host=new_http_host,
                          http_port=http_port, workers=workers,
-                         unix_domain_socket=unix_domain_socket))
+                         unix_domain_socket=redis_uds,
+                         max_workers=max_workers, queue_type=queue_type,
+                         reliable=reliable))
@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of thr library released under the MIT license.
+# See the LICENSE file for more information.
+
+import os
+import json
+import socket
+import signal
+import logging
+import six
+import tornado.ioloop
+from tornado.gen import coroutine, Return
+from tornado.iostream import IOStream, StreamClosedError
+
+logger = logging.getLogger("thr.redis2http.supervisor")
+
+# stats merged with max() instead of a sum
+MAX_STATS = ("epoch", "stopping_mode")
+
+
+def fair_shares(limit, wanted):
+    """Max-min fair partition of a limit.
+
+    Args:
+        limit (int): the budget to share.
+        wanted (dict): key => number of wanted slots.
+
+    Returns:
+        A dict key => share (the sum of the shares is <= limit).
+
+    >>> sorted(fair_shares(10, {0: 2, 1: 20, 2: 20}).items())
+    [(0, 2), (1, 4), (2, 4)]
+    """
+    shares = {}
+    remaining = limit
+    items = sorted(wanted.items(), key=lambda x: (x[1], x[0]))
+    for i, (key, value) in enumerate(items):
+        share = max(0, min(value, remaining // (len(items) - i)))
+        shares[key] = share
+        remaining -= share
+    return shares
+
+
+class Budgets(object):
+    """
+    Partition of the limits between the worker processes (supervisor side)
+
+    A worker never gets more than its max-min fair share of the wanted
+    slots, nor more than the slots released by the others: the running
+    requests of a worker above its share still hold their slots until
+    they are done (the worker doesn't launch new requests above its
+    grant meanwhile), so the sum of the used slots of a counter never
+    exceeds its limit.
+    """
+
+    def __init__(self):
+        # counter => {worker: wanted slots}
+        self.wanted = {}
+        # counter => {worker: held slots (max of granted and used slots)}
+        self.granted = {}
+
+    def update(self, worker, demands):
+        """
+        Grants some slots to a worker
+
+        Args:
+            worker: the worker id
+            demands: a dict counter => (limit, used slots, wanted slots)
+
+        Returns:
+            A dict counter => granted slots
+        """
+        result = {}
+        for counter, (limit, used, wanted) in six.iteritems(demands):
+            if wanted <= 0:
+                self.release(worker, counter)
+                result[counter] = 0
+                continue
+            wanteds = self.wanted.setdefault(counter, {})
+            granted = self.granted.setdefault(counter, {})
+            wanteds[worker] = wanted
+            target = fair_shares(limit, wanteds)[worker]
+            others = sum([y for x, y in granted.items() if x != worker])
+            grant = max(0, min(wanted, target, limit - others))
+            granted[worker] = max(grant, used)
+            result[counter] = grant
+        return result
+
+    def release(self, worker, counter=None):
+        """
+        Releases the slots of a worker (for all counters if counter is None)
+        """
+        counters = list(self.wanted.keys()) if counter is None else [counter]
+        for name in counters:
+            self.wanted.get(name, {}).pop(worker, None)
+            self.granted.get(name, {}).pop(worker, None)
+            if len(self.wanted.get(name, {})) == 0:
+                self.wanted.pop(name, None)
+                self.granted.pop(name, None)
+
+
+class BudgetChannel(object):
+    """
+    Worker side of the budget channel (a socket connected to the
+    supervisor)
+    """
+
+    def __init__(self, sock):
+        self.stream = IOStream(sock)
+
+    @coroutine
+    def request(self, demands):
+        """
+        Asks some slots to the supervisor
+
+        Args:
+            demands: a dict counter => (limit, used slots, wanted slots)
+
+        Returns:
+            A dict counter => granted slots (None if the supervisor is gone)
+        """
+        try:
+            yield self.stream.write(json.dumps(demands).encode() + b"\n")
+            line = yield self.stream.read_until(b"\n")
+        except StreamClosedError:
+            raise Return(None)
+        raise Return(json.loads(line.decode()))
+
+
+@coroutine
+def serve_worker(worker, stream, budgets):
+    """
+    Supervisor side of the budget channel of a worker
+    """
+    try:
+        while True:
+            line = yield stream.read_until(b"\n")
+            grants = budgets.update(worker, json.loads(line.decode()))
+            yield stream.write(json.dumps(grants).encode() + b"\n")
+    except StreamClosedError:
+        pass
+    budgets.release(worker)
+    logger.info("budget channel of worker #%i closed", worker)
+
+
+def merge_stats(total, stats):
+    """
+    Merges (in place) the stats of a worker in the total stats (numbers
+    are summed, limits, epoch and stopping mode are maxed)
+    """
+    for key, value in six.iteritems(stats):
+        if isinstance(value, dict):
+            merge_stats(total.setdefault(key, {}), value)
+        elif isinstance(value, (int, float)) and \
+                not isinstance(value, bool):
+            if key in MAX_STATS or key.endswith("_limit"):
+                total[key] = max(total.get(key, value), value)
+            else:
+                total[key] = total.get(key, 0) + value
+        else:
+            total[key] = value
+    return total
+
+
+def get_worker_stats_file(stats_file, worker):
+    return "%s.%i" % (stats_file, worker)
+
+
+def write_aggregated_stats(stats_file, workers):
+    total = {}
+    for worker in range(0, workers):
+        try:
+            with open(get_worker_stats_file(stats_file, worker)) as f:
+                stats = json.loads(f.read())
+        except (IOError, OSError, ValueError):
+            continue
+        merge_stats(total, stats)
+        total['processes'] = total.get('processes', 0) + 1
+    with open(stats_file, "w") as f:
+        f.write(json.dumps(total, indent=4))
+
+
+def fork_workers(processes):
+    """
+    Forks the worker processes (each one is connected to the supervisor
+    by a socket)
+
+    Returns:
+        (worker id, socket) in a worker, (None, list of (pid, socket)) in
+        the supervisor
+    """
+    children = []
+    for worker in range(0, processes):
+        parent_socket, child_socket = socket.socketpair()
+        pid = os.fork()
+        if pid == 0:
+            parent_socket.close()
+            for _, sock in children:
+                sock.close()
+            return (worker, child_socket)
+        child_socket.close()
+        children.append((pid, parent_socket))
+    return (None, children)
+
+
+def supervise(children, stats_file=None, stats_frequency_ms=0):
+    """
+    Serves the budget channels of the workers, forwards the SIGTERM signal
+    and aggregates the stats until all workers are stopped
+    """
+    loop = tornado.ioloop.IOLoop.instance()
+    budgets = Budgets()
+    alive = {}
+    for worker, (pid, sock) in enumerate(children):
+        alive[pid] = worker
+        loop.spawn_callback(serve_worker, worker, IOStream(sock), budgets)
+
+    def reap():
+        while len(alive) > 0:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError:
+                alive.clear()
+                break
+            if pid == 0:
+                break
+            worker = alive.pop(pid, None)
+            logger.info("worker #%s (pid: %i) exited with status %i",
+                        worker, pid, status)
+        if len(alive) == 0:
+            loop.stop()
+
+    def forward_signal(sig, frame):
+        logger.info("caught signal: %s => forwarding it to workers", sig)
+        for pid in list(alive.keys()):
+            try:
+                os.kill(pid, sig)
+            except OSError:
+                pass
+
+    signal.signal(signal.SIGTERM, forward_signal)
+    tornado.ioloop.PeriodicCallback(reap, 200).start()
+    if stats_file is not None and stats_frequency_ms > 0:
+        tornado.ioloop.PeriodicCallback(
+            lambda: write_aggregated_stats(stats_file, len(children)),
+            stats_frequency_ms).start()
+    logger.info("supervisor of %i workers started", len(children))
+    loop.start()
+    logger.info("supervisor stopped")
@@ -11,10 +11,11 @@ import json
 import six
 import socket
 import re
+from bisect import bisect_left
 from fnmatch import fnmatch
 from six.moves.urllib.parse import urlencode
 from tornado.httpclient import HTTPRequest
-from tornado.httputil import HTTPHeaders
+from tornado.httputil import HTTPHeaders, HTTPServerRequest
 from tornado.netutil import Resolver
 from tornado.gen import coroutine, Return
 
@@ -115,6 +116,58 @@ class diff(object):
         return all([x != string for x in self.patterns])
 
 
+class Histogram(object):
+    """
+    Fixed-bucket histogram
+
+    The buckets are allocated once, so observing a value is only a bisect
+    and a few additions (cheap enough to be done for each request).
+
+    Args:
+        buckets: a sorted sequence of bucket upper bounds
+
+    >>> histogram = Histogram((1, 10, 100))
+    >>> histogram.observe(5)
+    >>> histogram.observe(500)
+    >>> histogram.counts
+    [0, 1, 0, 1]
+    >>> histogram.cumulative_counts()
+    [0, 1, 1, 2]
+    """
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        """
+        Args:
+            value: the value to add to the histogram.
+        """
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative_counts(self):
+        """
+        Return:
+            a list of cumulative counts (one per bucket, plus +Inf)
+        """
+        result = []
+        total = 0
+        for count in self.counts:
+            total += count
+            result.append(total)
+        return result
+
+    def to_dict(self):
+        buckets = [str(x) for x in self.buckets] + ["+Inf"]
+        return {"count": self.count, "sum": self.sum,
+                "buckets": dict(zip(buckets, self.counts))}
+
+
 def make_unique_id():
     """Returns a unique id with only alphanumeric chars.
 
@@ -124,6 +177,148 @@ def make_unique_id():
     return str(uuid.uuid4()).replace('-', '')
 
 
+def parse_redis_address(address):
+    """Parses a redis server address.
+
+    Args:
+        address (str): "host:port", "host" (default port) or the path of
+            a unix domain socket (starting with /).
+
+    Returns:
+        A tuple (host, port, unix_domain_socket).
+
+    >>> parse_redis_address("10.0.0.1:6380")
+    ('10.0.0.1', 6380, None)
+    >>> parse_redis_address("/tmp/redis.sock")
+    (None, None, '/tmp/redis.sock')
+    """
+    if address.startswith('/'):
+        return (None, None, address)
+    if ':' in address:
+        host, port = address.rsplit(':', 1)
+        return (host, int(port), None)
+    return (address, 6379, None)
+
+
+def make_priority_score(priority, timestamp):
+    """Returns a score sorting requests by priority then by age.
+
+    The lower score is the most urgent one.
+
+    Args:
+        priority (int): request priority (1 => high, 99 => low).
+        timestamp (float): request creation timestamp.
+
+    Returns:
+        The score (int).
+
+    >>> make_priority_score(1, 1400000000.5)
+    11400000000500
+    """
+    return priority * 10000000000000 + int(timestamp * 1000)
+
+
+def get_consumers_key(queue):
+    """Returns the redis key of the live consumers of a queue.
+
+    This key is a sorted set: consumer id => expiration timestamp (the
+    consumers of the queue refresh it periodically).
+
+    Args:
+        queue (str): redis queue name.
+
+    Returns:
+        The redis key (str) of the sorted set.
+
+    >>> get_consumers_key("thr:queue:foo")
+    'thr:consumers:thr:queue:foo'
+    """
+    return "thr:consumers:%s" % queue
+
+
+def get_available_consumers_key(queue):
+    """Returns the redis key of the consumers of a queue with spare
+    capacity.
+
+    This key is a sorted set: consumer id => expiration timestamp (a
+    consumer is removed when the limits which block the requests of the
+    queue are saturated, see :func:`get_consumers_key`).
+
+    Args:
+        queue (str): redis queue name.
+
+    Returns:
+        The redis key (str) of the sorted set.
+
+    >>> get_available_consumers_key("thr:queue:foo")
+    'thr:available:thr:queue:foo'
+    """
+    return "thr:available:%s" % queue
+
+
+def get_processing_key(queue, consumer_id):
+    """Returns the redis key of the processing list of a consumer.
+
+    In reliable mode, popped requests are moved in this list until they
+    are processed (so they can be requeued if the consumer dies).
+
+    Args:
+        queue (str): redis queue name.
+        consumer_id (str): consumer id.
+
+    Returns:
+        The redis key (str) of the list.
+
+    >>> get_processing_key("thr:queue:foo", "host:123")
+    'thr:processing:thr:queue:foo:host:123'
+    """
+    return "thr:processing:%s:%s" % (queue, consumer_id)
+
+
+def get_saturation_field(counter, consumer_id):
+    """Returns the field of a saturated counter in the saturation hash.
+
+    Each redis2http consumer publishes its own fields (so a consumer never
+    overwrites or removes the field of another one).
+
+    Args:
+        counter (str): redis2http counter name.
+        consumer_id (str): consumer id.
+
+    Returns:
+        The field (str) of the saturation hash.
+
+    >>> get_saturation_field("limit_foo==bar", "host:123")
+    'limit_foo==bar|host:123'
+    """
+    return "%s|%s" % (counter, consumer_id)
+
+
+def parse_saturation_field(field):
+    """Parses a field of the saturation hash.
+
+    Returns:
+        A tuple (counter name, consumer id).
+
+    >>> parse_saturation_field("limit_foo==bar|host:123")
+    ('limit_foo==bar', 'host:123')
+    """
+    counter, consumer_id = field.rsplit('|', 1)
+    return (counter, consumer_id)
+
+
+def get_processing_consumers_key(queue):
+    """Returns the redis key of the set of consumers with a processing list.
+
+    Args:
+        queue (str): redis queue name.
+
+    Returns:
+        The redis key (str) of the set.
+    """
+    return "thr:processing_consumers:%s" % queue
+
+
 def get_ip():
     """Try to get and return the host ip.
 
@@ -231,21 +426,92 @@ def unserialize_request_message(message, force_host=None):
     Raises:
         ValueError: when there is a "unserialize exception".
     """
+    return request_from_decoded_message(decode_request_message(message),
+                                        force_host=force_host)
+
+
+def decode_request_message(message):
+    """Decodes (JSON) a request message without building the HTTPRequest.
+
+    Args:
+        message (str): the message to decode.
+
+    Returns:
+        The decoded message (dict), the extra (not HTTP) keys/values injected
+        during serialization are available under the "extra" key.
+
+    Raises:
+        ValueError: when there is a "decode exception".
+    """
+    return json.loads(message.decode('utf-8'))
+
+
+def get_decoded_query_string(decoded):
+    """Returns the query string of a decoded request message."""
+    if six.PY2:
+        new_qa = {}
+        for key, values in decoded.get('query_arguments', {}).items():
+            new_qa[key] = [x.encode('utf-8') for x in values]
+    else:
+        new_qa = decoded.get('query_arguments', {})
+    return urlencode(new_qa, doseq=True)
+
+
+def server_request_from_decoded_message(decoded):
+    """Builds a tornado HTTPServerRequest object from a decoded request
+    message.
+
+    This is the request type of the http2redis side (so the named hashes,
+    see :func:`~thr.hashes.add_hash`, get the same object in redis2http).
+    The remote_ip attribute is the first address of the X-Forwarded-For
+    header (the body_link is ignored).
+
+    Args:
+        decoded (dict): the decoded message
+            (see :func:`decode_request_message`).
+
+    Returns:
+        An HTTPServerRequest object.
+    """
+    uri = decoded['path']
+    if 'query_arguments' in decoded:
+        uri = "%s?%s" % (uri, get_decoded_query_string(decoded))
+    headers = HTTPHeaders()
+    for name, value in decoded.get('headers', []):
+        headers.add(name, value)
+    body = b''
+    if 'body' in decoded:
+        body = base64.standard_b64decode(decoded['body'].encode('ascii'))
+    request = HTTPServerRequest(method=decoded['method'], uri=uri,
+                                headers=headers, body=body,
+                                host=decoded['host'])
+    forwarded_for = headers.get('X-Forwarded-For', None)
+    if forwarded_for:
+        request.remote_ip = forwarded_for.split(',')[0].strip()
+    return request
+
+
+def request_from_decoded_message(decoded, force_host=None):
+    """Builds a tornado HTTPRequest object from a decoded request message.
+
+    Args:
+        decoded (dict): the decoded message
+            (see :func:`decode_request_message`).
+        force_host (str): a host:port string to force the "Host:" header
+            value.
+
+    Returns:
+        A tuple (object, body_link, extra_dict), see
+        :func:`unserialize_request_message`.
+    """
     body_link = None
     extra_dict = {}
-    decoded = json.loads(message.decode('utf-8'))
     if force_host:
         host = force_host
     else:
         host = decoded['host']
     if 'query_arguments' in decoded:
-        if six.PY2:
-            new_qa = {}
-            for key, values in decoded['query_arguments'].items():
-                new_qa[key] = [x.encode('utf-8') for x in values]
-        else:
-            new_qa = decoded['query_arguments']
-        query_string = urlencode(new_qa, doseq=True)
+        query_string = get_decoded_query_string(decoded)
         url = "http://%s%s?%s" % (host, decoded['path'], query_string)
     else:
         url = "http://%s%s" % (host, decoded['path'])
@@ -303,7 +569,7 @@ def serialize_http_response(response, body_link=None, dict_to_inject=None):
         res['body_link'] = body_link
     else:
         if response.body is None:
-            tmp = ""
+            tmp = b""
         else:
             tmp = base64.standard_b64encode(response.body)
         if six.PY3: